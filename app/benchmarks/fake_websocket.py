@@ -0,0 +1,45 @@
+import asyncio
+import json
+import time
+from typing import Optional
+
+
+class FakeWebSocket:
+    """
+    Stands in for the websocket of a Session: hands out the given events and records everything sent, with the
+    time it was sent. After the last event, receive_json() waits until close() is called and then raises,
+    like a disconnecting client.
+    """
+    events: list[dict]
+    sent: list[tuple[float, str | bytes]]
+    closed: Optional[asyncio.Event]
+
+    def __init__(self, events: list[dict]):
+        self.events = list(events)
+        self.sent = []
+        self.closed = None
+
+    async def receive_json(self) -> dict:
+        if self.events:
+            return self.events.pop(0)
+        if self.closed is None:
+            self.closed = asyncio.Event()
+        await self.closed.wait()
+        raise ConnectionError("Fake websocket closed")
+
+    async def send_json(self, data):
+        self.sent.append((time.perf_counter(), data))
+
+    async def send_bytes(self, data: bytes):
+        self.sent.append((time.perf_counter(), data))
+
+    def close(self):
+        """must be called from the event loop"""
+        if self.closed is None:
+            self.closed = asyncio.Event()
+        self.closed.set()
+
+    def get_sent_events(self) -> list[tuple[float, dict]]:
+        """the JSON messages sent so far. The session sends them as JSON encoded strings"""
+        return [(sent_at, json.loads(data) if isinstance(data, str) else data) for sent_at, data in self.sent
+                if not isinstance(data, bytes)]
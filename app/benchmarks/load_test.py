@@ -0,0 +1,205 @@
+"""
+Load test of the websocket API: starts the app with uvicorn and opens more and more concurrent sessions,
+each tracking several boxes on a synthetic video, to find how many sessions an instance can serve:
+
+    python -m benchmarks.load_test --sessions 1,2,4,8 --boxes 4 --duration 10 --slo-ms 200 --output load.json
+
+For every level the report has the latency from a frame being decoded to its update being received (p50/p95/p99),
+the cadence of the updates and the share of frames the clients got no update for. The capacity is the highest
+level whose p95 latency is within --slo-ms.
+
+Every session watches a video of its own, so that they neither share a decoder nor replay cached tracks,
+unless --shared-video is given. Without --real-time the decoders are only paced by the trackers.
+"""
+import argparse
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+import numpy as np
+import websockets
+
+from benchmarks.synthetic_video import generate_video
+from models.dto import BoundingBox, EventType, TrackerType
+
+APP_DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SERVER_START_TIMEOUT = 30
+
+
+class SessionStatistics:
+    """What one client saw of its session"""
+    # seconds from decoding a frame to receiving its update
+    latencies: list[float]
+    received_at: list[float]
+    update_count: int
+    missed_frame_count: int
+    failure_count: int
+
+    def __init__(self):
+        self.latencies = []
+        self.received_at = []
+        self.update_count = 0
+        self.missed_frame_count = 0
+        self.failure_count = 0
+
+
+def percentiles(values: list[float], scale: float = 1000) -> dict:
+    if not values:
+        return {'count': 0}
+    scaled = np.array(values) * scale
+    return {'count': len(values), 'p50': float(np.percentile(scaled, 50)), 'p95': float(np.percentile(scaled, 95)),
+            'p99': float(np.percentile(scaled, 99)), 'max': float(scaled.max())}
+
+
+def parse_message(text: str) -> dict:
+    message = json.loads(text)
+    # the app sends the events as JSON encoded strings
+    return json.loads(message) if isinstance(message, str) else message
+
+
+async def receive_answer(websocket, statistics: SessionStatistics) -> dict:
+    """wait for the answer to a request, counting the updates which arrive meanwhile"""
+    while True:
+        message = parse_message(await websocket.recv())
+        if message['event_type'] in (EventType.SUCCESS, EventType.FAILURE):
+            if message['event_type'] == EventType.FAILURE:
+                statistics.failure_count += 1
+            return message
+        handle_message(message, statistics)
+
+
+def handle_message(message: dict, statistics: SessionStatistics):
+    received_at = time.time()
+    if message['event_type'] == EventType.UPDATE_TRACKING:
+        statistics.update_count += 1
+        statistics.missed_frame_count += message.get('dropped_frames', 0)
+        statistics.received_at.append(received_at)
+        if message.get('decoded_at') is not None:
+            statistics.latencies.append(received_at - message['decoded_at'])
+    elif message['event_type'] == EventType.TRACKING_ERROR:
+        statistics.failure_count += 1
+
+
+async def run_session(server_url: str, video_path: str, bounding_boxes: list[BoundingBox], tracker_type: TrackerType,
+                      real_time: bool, duration: float) -> SessionStatistics:
+    statistics = SessionStatistics()
+    async with websockets.connect(f"{server_url}/websocket/{uuid.uuid4()}", max_size=None) as websocket:
+        request_id = str(uuid.uuid4())
+        await websocket.send(json.dumps({'event_type': EventType.START_CONTROL_LOOP, 'request_id': request_id,
+                                         'video_source': video_path, 'real_time': real_time}))
+        await receive_answer(websocket, statistics)
+        for bounding_box in bounding_boxes:
+            await websocket.send(json.dumps({'event_type': EventType.ADD_BOUNDING_BOX, 'request_id': request_id,
+                                             'frame_number': 1, 'tracker': tracker_type,
+                                             'bounding_box': bounding_box.model_dump()}))
+            await receive_answer(websocket, statistics)
+        end = time.monotonic() + duration
+        while (remaining := end - time.monotonic()) > 0:
+            try:
+                message = parse_message(await asyncio.wait_for(websocket.recv(), remaining))
+            except asyncio.TimeoutError:
+                break
+            handle_message(message, statistics)
+    return statistics
+
+
+async def run_level(server_url: str, videos: list[tuple[str, list[BoundingBox]]], tracker_type: TrackerType,
+                    real_time: bool, duration: float, session_count: int) -> dict:
+    all_statistics: list[SessionStatistics] = await asyncio.gather(*(
+        run_session(server_url, *videos[index % len(videos)], tracker_type, real_time, duration)
+        for index in range(session_count)))
+    latencies = [latency for statistics in all_statistics for latency in statistics.latencies]
+    intervals = [interval for statistics in all_statistics for interval in np.diff(statistics.received_at)]
+    update_count = sum(statistics.update_count for statistics in all_statistics)
+    missed_frame_count = sum(statistics.missed_frame_count for statistics in all_statistics)
+    return {'sessions': session_count, 'boxes': session_count * len(videos[0][1]),
+            'updates_per_second_per_session': update_count / session_count / duration,
+            'latency_ms': percentiles(latencies), 'update_interval_ms': percentiles(intervals),
+            'missed_frame_share': missed_frame_count / (missed_frame_count + update_count)
+            if missed_frame_count + update_count else 0.0,
+            'failures': sum(statistics.failure_count for statistics in all_statistics)}
+
+
+def get_free_port() -> int:
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        return probe.getsockname()[1]
+
+
+def start_server(port: int) -> subprocess.Popen:
+    server = subprocess.Popen([sys.executable, '-m', 'uvicorn', 'main:app', '--port', str(port), '--log-level',
+                               'warning'], cwd=APP_DIRECTORY, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + SERVER_START_TIMEOUT
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError(f"The server exited with {server.returncode}")
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=0.5).close()
+            return server
+        except OSError:
+            time.sleep(0.2)
+    server.terminate()
+    raise RuntimeError(f"The server did not start within {SERVER_START_TIMEOUT} seconds")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Find how many websocket sessions one instance can serve")
+    parser.add_argument('--sessions', default='1,2,4,8', help="comma separated session counts, one level each")
+    parser.add_argument('--boxes', type=int, default=4, help="boxes per session")
+    parser.add_argument('--tracker', type=TrackerType, default=TrackerType.CSRT)
+    parser.add_argument('--duration', type=float, default=10, help="seconds to receive updates per level")
+    parser.add_argument('--real-time', action=argparse.BooleanOptionalAction, default=True)
+    parser.add_argument('--shared-video', action='store_true', help="all sessions watch the same video")
+    parser.add_argument('--width', type=int, default=1280)
+    parser.add_argument('--height', type=int, default=720)
+    parser.add_argument('--fps', type=float, default=30)
+    parser.add_argument('--slo-ms', type=float, default=200, help="p95 latency a level must stay within")
+    parser.add_argument('--server-url', help="test a running server, e.g. ws://localhost:8000, instead of starting one")
+    parser.add_argument('--output', help="also write the report to this file")
+    args = parser.parse_args()
+    session_counts = [int(session_count) for session_count in args.sessions.split(',')]
+    # long enough that the video does not end during a level
+    frame_count = int(args.fps * (args.duration + 10))
+
+    with tempfile.TemporaryDirectory() as directory:
+        video_count = 1 if args.shared_video else max(session_counts)
+        videos = []
+        for seed in range(video_count):
+            video_path = os.path.join(directory, f"synthetic_{seed}.mp4")
+            videos.append((video_path, generate_video(video_path, args.width, args.height, args.fps, frame_count,
+                                                      args.boxes, seed)))
+
+        server = None
+        server_url = args.server_url
+        if server_url is None:
+            port = get_free_port()
+            server = start_server(port)
+            server_url = f"ws://127.0.0.1:{port}"
+        try:
+            levels = []
+            for session_count in session_counts:
+                level = asyncio.run(run_level(server_url, videos, args.tracker, args.real_time, args.duration,
+                                              session_count))
+                print(f"{session_count} sessions: p95 latency {level['latency_ms'].get('p95', float('nan')):.1f} ms, "
+                      f"{level['updates_per_second_per_session']:.1f} updates/s per session", file=sys.stderr)
+                levels.append(level)
+        finally:
+            if server is not None:
+                server.terminate()
+                server.wait()
+    within_slo = [level['sessions'] for level in levels if level['latency_ms'].get('p95', float('inf')) <= args.slo_ms]
+    report = {'config': vars(args), 'levels': levels, 'capacity_sessions': max(within_slo, default=0)}
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            output_file.write(text)
+
+
+if __name__ == '__main__':
+    main()
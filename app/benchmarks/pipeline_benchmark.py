@@ -0,0 +1,286 @@
+"""
+Benchmarks the stages of the tracking pipeline in isolation and together, on a synthetic video:
+
+    python -m benchmarks.pipeline_benchmark --width 1280 --height 720 --objects 4 --trackers csrt,kcf --output run.json
+
+Stages:
+    decode       the producer alone, with one reader which releases every frame right away
+    tracking     the update of every consumer on every frame, one tracker type after the other, without threads
+    aggregation  the TrackingUpdateSenderThread alone: time from the last box of a frame to its update being published
+    end-to-end   a Session with a fake websocket: time from a frame being published to its update being sent
+
+The report is printed as JSON, together with the peak RSS of the process and the most threads seen in a stage.
+DEBUG logging is disabled unless --debug-logging is given, since it costs more than some of the stages.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import resource
+import tempfile
+import threading
+import time
+import uuid
+
+import cv2
+import numpy as np
+
+from benchmarks.fake_websocket import FakeWebSocket
+from benchmarks.synthetic_video import generate_video
+from business.frame_ring_buffer import FrameRingBuffer
+from business.session import Session
+from business.tracked_boxes import TrackedBox, TrackingUpdate
+from business.tracker_process_pool import shutdown_tracker_process_pool
+from business.tracker_scheduler import shutdown_tracker_scheduler
+from business.tracking_update_sender import TrackingUpdateSenderThread
+from business.video_frame_consumer import VideoFrameConsumer
+from business.video_frame_producer import VideoFrameProducerThread, decode_frame
+from business.video_frame_producer_registry import get_video_frame_producer_registry
+from config.constants import TRACKER_EXECUTION_MODE, TrackerExecutionMode
+from models.dto import BoundingBox, TrackerType, EventType
+
+STAGES = ('decode', 'tracking', 'aggregation', 'end-to-end')
+# the end to end stage is over when no update has been sent for this many seconds after the video ended
+END_TO_END_IDLE_TIMEOUT = 2.0
+
+
+class ThreadCountSampler:
+    """Remembers the most threads that were alive at any sample"""
+    peak_thread_count: int
+
+    def __init__(self):
+        self.peak_thread_count = threading.active_count()
+
+    def sample(self):
+        self.peak_thread_count = max(self.peak_thread_count, threading.active_count())
+
+
+def summarize(durations: list[float]) -> dict:
+    """:param durations: seconds"""
+    if not durations:
+        return {'count': 0}
+    milliseconds = np.array(durations) * 1000
+    return {'count': len(durations), 'mean_ms': float(milliseconds.mean()),
+            'p50_ms': float(np.percentile(milliseconds, 50)), 'p95_ms': float(np.percentile(milliseconds, 95)),
+            'p99_ms': float(np.percentile(milliseconds, 99)), 'max_ms': float(milliseconds.max())}
+
+
+def get_peak_rss_bytes() -> int:
+    # kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def benchmark_decode(video_path: str, thread_count_sampler: ThreadCountSampler) -> dict:
+    video_frame_producer = VideoFrameProducerThread()
+    video_frame_producer.load(video_path)
+    frame_reader = video_frame_producer.add_reader()
+    has_finished = threading.Event()
+    video_frame_producer.add_quit_listener(lambda event: has_finished.set())
+    frame_count = 0
+    start = time.perf_counter()
+    video_frame_producer.start()
+    try:
+        while not (has_finished.is_set()
+                   and frame_reader.next_frame_number > video_frame_producer.frame_ring_buffer.latest_frame_number):
+            try:
+                frame = frame_reader.read(timeout=0.1)
+            except TimeoutError:
+                continue
+            if frame is None:
+                break
+            frame_reader.release()
+            frame_count += 1
+        elapsed_seconds = time.perf_counter() - start
+        thread_count_sampler.sample()
+    finally:
+        video_frame_producer.quit()
+    return {'frames': frame_count, 'seconds': elapsed_seconds,
+            'fps': frame_count / elapsed_seconds if elapsed_seconds else 0.0}
+
+
+def benchmark_tracking(video_path: str, bounding_boxes: list[BoundingBox], tracker_type: TrackerType,
+                       thread_count_sampler: ThreadCountSampler) -> dict:
+    video_capture = cv2.VideoCapture(video_path)
+    frame_ring_buffer = FrameRingBuffer(2, use_shared_memory=TRACKER_EXECUTION_MODE == TrackerExecutionMode.PROCESS)
+    failures = []
+    video_frame_consumers = [VideoFrameConsumer(bounding_box.id, frame_ring_buffer.add_reader(start_frame_number=1),
+                                                lambda bounding_box: None, failures.append, tracker_type)
+                             for bounding_box in bounding_boxes]
+    init_durations = []
+    update_durations = []
+    try:
+        if decode_frame(video_capture, frame_ring_buffer, 1) is None:
+            raise ValueError(f"Cannot read {video_path}")
+        frame_ring_buffer.publish(1)
+        for video_frame_consumer, bounding_box in zip(video_frame_consumers, bounding_boxes):
+            start = time.perf_counter()
+            video_frame_consumer.start(bounding_box)
+            init_durations.append(time.perf_counter() - start)
+        frame_number = 2
+        while decode_frame(video_capture, frame_ring_buffer, frame_number) is not None:
+            frame_ring_buffer.publish(frame_number)
+            for video_frame_consumer in video_frame_consumers:
+                if video_frame_consumer.has_failed:
+                    # lost objects still have to release their frames
+                    video_frame_consumer.frame_reader.close()
+                    continue
+                start = time.perf_counter()
+                video_frame_consumer.step()
+                update_durations.append(time.perf_counter() - start)
+            frame_number += 1
+        thread_count_sampler.sample()
+    finally:
+        for video_frame_consumer in video_frame_consumers:
+            video_frame_consumer.quit()
+            video_frame_consumer.close()
+        video_capture.release()
+        frame_ring_buffer.free()
+    return {'init': summarize(init_durations), 'update': summarize(update_durations), 'failures': len(failures)}
+
+
+def benchmark_aggregation(object_count: int, frame_count: int, thread_count_sampler: ThreadCountSampler) -> dict:
+    published_at: dict[int, float] = {}
+    is_published = threading.Event()
+
+    def on_publish(tracking_update: TrackingUpdate):
+        published_at[tracking_update.frame_number] = time.perf_counter()
+        is_published.set()
+
+    tracking_update_sender = TrackingUpdateSenderThread(on_publish)
+    for object_id in range(object_count):
+        tracking_update_sender.add_tracker(object_id)
+    tracking_update_sender.start()
+    durations = []
+    try:
+        for frame_number in range(1, frame_count + 1):
+            is_published.clear()
+            for object_id in range(object_count):
+                tracking_update_sender.submit(TrackedBox(object_id, frame_number, 0, 0, 1, 1))
+            completed_at = time.perf_counter()
+            # one frame at a time, otherwise the sender would rightly skip to the newest complete one
+            if is_published.wait(1.0) and frame_number in published_at:
+                durations.append(published_at[frame_number] - completed_at)
+        thread_count_sampler.sample()
+    finally:
+        tracking_update_sender.quit()
+    return {'latency': summarize(durations), 'published_frames': len(published_at)}
+
+
+async def run_session(video_path: str, bounding_boxes: list[BoundingBox], tracker_type: TrackerType,
+                      thread_count_sampler: ThreadCountSampler) -> dict:
+    # the session joins this producer, which lets the benchmark see when frames are published
+    video_frame_producer_registry = get_video_frame_producer_registry()
+    video_frame_producer = video_frame_producer_registry.acquire(video_path)
+    published_at: dict[int, float] = {}
+    has_finished = threading.Event()
+    video_frame_producer.frame_ring_buffer.add_publish_listener(
+        lambda frame_number: published_at.setdefault(frame_number, time.perf_counter()))
+    video_frame_producer.add_quit_listener(lambda event: has_finished.set())
+    request_id = str(uuid.uuid4())
+    events = [{'event_type': EventType.START_CONTROL_LOOP, 'request_id': request_id, 'video_source': video_path}]
+    events += [{'event_type': EventType.ADD_BOUNDING_BOX, 'request_id': request_id, 'frame_number': 1,
+                'tracker': tracker_type, 'bounding_box': bounding_box.model_dump()} for bounding_box in bounding_boxes]
+    fake_websocket = FakeWebSocket(events)
+    session = Session(uuid.uuid4(), fake_websocket)
+    # measure the trackers, not replays of their tracks from earlier runs
+    session.track_cache = None
+    start = time.perf_counter()
+    consumer_task = asyncio.create_task(session.consume_websocket_events())
+    try:
+        while True:
+            await asyncio.sleep(0.1)
+            thread_count_sampler.sample()
+            last_sent_at = fake_websocket.sent[-1][0] if fake_websocket.sent else start
+            if consumer_task.done() or (has_finished.is_set()
+                                        and time.perf_counter() - last_sent_at > END_TO_END_IDLE_TIMEOUT):
+                break
+    finally:
+        fake_websocket.close()
+        try:
+            await consumer_task
+        except ConnectionError:
+            pass
+        await session.cleanup_session()
+        video_frame_producer_registry.release(video_frame_producer)
+    updates = [(sent_at, event) for sent_at, event in fake_websocket.get_sent_events()
+               if event['event_type'] == EventType.UPDATE_TRACKING]
+    latencies = [sent_at - published_at[event['frame_number']] for sent_at, event in updates
+                 if event['frame_number'] in published_at]
+    elapsed_seconds = (updates[-1][0] if updates else time.perf_counter()) - start
+    failures = [event for _, event in fake_websocket.get_sent_events()
+                if event['event_type'] in (EventType.FAILURE, EventType.TRACKING_ERROR)]
+    return {'frames': len(published_at), 'updates': len(updates), 'seconds': elapsed_seconds,
+            'updates_per_second': len(updates) / elapsed_seconds if elapsed_seconds else 0.0,
+            'latency': summarize(latencies), 'failures': len(failures)}
+
+
+def benchmark_end_to_end(video_path: str, bounding_boxes: list[BoundingBox], tracker_type: TrackerType,
+                         thread_count_sampler: ThreadCountSampler) -> dict:
+    return asyncio.run(run_session(video_path, bounding_boxes, tracker_type, thread_count_sampler))
+
+
+def run_benchmarks(video_path: str, bounding_boxes: list[BoundingBox], tracker_types: list[TrackerType],
+                   stages: list[str], frame_count: int) -> dict:
+    thread_count_sampler = ThreadCountSampler()
+    report = {}
+    if 'decode' in stages:
+        report['decode'] = benchmark_decode(video_path, thread_count_sampler)
+    if 'tracking' in stages:
+        report['tracking'] = {tracker_type.value: benchmark_tracking(video_path, bounding_boxes, tracker_type,
+                                                                     thread_count_sampler)
+                              for tracker_type in tracker_types}
+    if 'aggregation' in stages:
+        report['aggregation'] = benchmark_aggregation(len(bounding_boxes), frame_count, thread_count_sampler)
+    if 'end-to-end' in stages:
+        report['end_to_end'] = {tracker_type.value: benchmark_end_to_end(video_path, bounding_boxes, tracker_type,
+                                                                         thread_count_sampler)
+                                for tracker_type in tracker_types}
+    report['peak_rss_bytes'] = get_peak_rss_bytes()
+    report['peak_thread_count'] = thread_count_sampler.peak_thread_count
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the tracking pipeline on a synthetic video")
+    parser.add_argument('--width', type=int, default=1280)
+    parser.add_argument('--height', type=int, default=720)
+    parser.add_argument('--fps', type=float, default=30)
+    parser.add_argument('--frames', type=int, default=300)
+    parser.add_argument('--objects', type=int, default=4)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--trackers', default=TrackerType.CSRT.value, help="comma separated tracker types")
+    parser.add_argument('--stages', default=','.join(STAGES), help=f"comma separated, of {', '.join(STAGES)}")
+    parser.add_argument('--output', help="also write the report to this file")
+    parser.add_argument('--debug-logging', action='store_true')
+    args = parser.parse_args()
+    if not args.debug_logging:
+        logging.disable(logging.DEBUG)
+    tracker_types = [TrackerType(tracker_type) for tracker_type in args.trackers.split(',')]
+    stages = args.stages.split(',')
+    unknown_stages = set(stages) - set(STAGES)
+    if unknown_stages:
+        parser.error(f"unknown stages {', '.join(unknown_stages)}")
+
+    with tempfile.TemporaryDirectory() as directory:
+        video_path = os.path.join(directory, 'synthetic.mp4')
+        start = time.perf_counter()
+        bounding_boxes = generate_video(video_path, args.width, args.height, args.fps, args.frames, args.objects,
+                                        args.seed)
+        generation_seconds = time.perf_counter() - start
+        try:
+            report = run_benchmarks(video_path, bounding_boxes, tracker_types, stages, args.frames)
+        finally:
+            shutdown_tracker_scheduler()
+            shutdown_tracker_process_pool()
+    report = {'config': {**vars(args), 'tracker_execution_mode': TRACKER_EXECUTION_MODE.value,
+                         'cpu_count': os.cpu_count(), 'generation_seconds': generation_seconds}, **report}
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            output_file.write(text)
+
+
+if __name__ == '__main__':
+    main()
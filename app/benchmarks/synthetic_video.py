@@ -0,0 +1,74 @@
+import random
+
+import cv2
+import numpy as np
+
+from models.dto import BoundingBox
+
+
+class MovingRectangle:
+    """A filled rectangle which moves with constant velocity and bounces off the borders of the frame"""
+    x: float
+    y: float
+    width: int
+    height: int
+    velocity_x: float
+    velocity_y: float
+    color: tuple[int, int, int]
+
+    def __init__(self, frame_width: int, frame_height: int, rng: random.Random):
+        self.width = rng.randint(max(8, frame_width // 20), max(9, frame_width // 8))
+        self.height = rng.randint(max(8, frame_height // 20), max(9, frame_height // 8))
+        self.x = rng.uniform(0, frame_width - self.width)
+        self.y = rng.uniform(0, frame_height - self.height)
+        self.velocity_x = rng.uniform(-4, 4)
+        self.velocity_y = rng.uniform(-4, 4)
+        self.color = (rng.randint(64, 255), rng.randint(64, 255), rng.randint(64, 255))
+
+    def move(self, frame_width: int, frame_height: int):
+        self.x += self.velocity_x
+        self.y += self.velocity_y
+        if not 0 <= self.x <= frame_width - self.width:
+            self.velocity_x = -self.velocity_x
+            self.x = min(max(self.x, 0), frame_width - self.width)
+        if not 0 <= self.y <= frame_height - self.height:
+            self.velocity_y = -self.velocity_y
+            self.y = min(max(self.y, 0), frame_height - self.height)
+
+    def draw(self, img: np.ndarray):
+        top_left = (round(self.x), round(self.y))
+        bottom_right = (round(self.x) + self.width, round(self.y) + self.height)
+        cv2.rectangle(img, top_left, bottom_right, self.color, -1)
+        # some texture, so that the trackers have features to follow
+        cv2.line(img, top_left, bottom_right, (0, 0, 0), 2)
+
+    def get_bounding_box(self, object_id: int, frame_number: int) -> BoundingBox:
+        return BoundingBox(id=object_id, frame_number=frame_number, x=round(self.x), y=round(self.y),
+                           width=self.width, height=self.height)
+
+
+def generate_video(path: str, width: int = 1280, height: int = 720, fps: float = 30, frame_count: int = 300,
+                   object_count: int = 4, seed: int = 0) -> list[BoundingBox]:
+    """
+    write a video of moving rectangles on a noisy background
+    :param path: file to write, the codec is chosen by its extension (mp4v for .mp4, MJPG otherwise)
+    :return: the boxes of the rectangles in the first frame
+    """
+    rng = random.Random(seed)
+    background = np.random.default_rng(seed).integers(0, 48, (height, width, 3), dtype=np.uint8)
+    rectangles = [MovingRectangle(width, height, rng) for _ in range(object_count)]
+    fourcc = cv2.VideoWriter_fourcc(*('mp4v' if path.endswith('.mp4') else 'MJPG'))
+    video_writer = cv2.VideoWriter(path, fourcc, fps, (width, height))
+    if not video_writer.isOpened():
+        raise ValueError(f"Cannot write {path}")
+    initial_bounding_boxes = [rectangle.get_bounding_box(object_id, 1) for object_id, rectangle in enumerate(rectangles)]
+    try:
+        for _ in range(frame_count):
+            img = background.copy()
+            for rectangle in rectangles:
+                rectangle.draw(img)
+                rectangle.move(width, height)
+            video_writer.write(img)
+    finally:
+        video_writer.release()
+    return initial_bounding_boxes
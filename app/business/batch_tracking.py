@@ -0,0 +1,149 @@
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor, Future, wait
+from typing import Optional
+
+import cv2
+
+from business import trackers
+from business.frame_ring_buffer import FrameRingBuffer, FrameReader
+from business.track_cache import Track, get_track_cache
+from business.video_frame_consumer import VideoFrameConsumer
+from business.video_frame_producer import decode_frame
+from config.constants import LOG_FORMAT, LOG_LEVEL, BATCH_TRACKING_WORKERS, TRACKER_EXECUTION_MODE, \
+    TrackerExecutionMode
+from models.dto import BoundingBox, ThreadingEvent, TrackerType
+from models.errors import TrackingError
+
+logging.basicConfig(format=LOG_FORMAT)
+logger = logging.getLogger(__name__)
+logger.setLevel(LOG_LEVEL)
+
+
+class BatchTrackingResult:
+    tracks: dict[int, Track]
+    frame_count: int
+    elapsed_seconds: float
+
+    def __init__(self, tracks: dict[int, Track], frame_count: int, elapsed_seconds: float):
+        self.tracks = tracks
+        self.frame_count = frame_count
+        self.elapsed_seconds = elapsed_seconds
+
+    @property
+    def fps(self) -> float:
+        return self.frame_count / self.elapsed_seconds if self.elapsed_seconds else 0.0
+
+
+class BatchBox:
+    """A box to track and the consumer which tracks it"""
+    bounding_box: BoundingBox
+    start_frame_number: int
+    track: Track
+    video_frame_consumer: VideoFrameConsumer
+    is_started: bool
+    # where the track is stored in the track cache
+    track_cache_key: Optional[str]
+
+    def __init__(self, bounding_box: BoundingBox, frame_reader: FrameReader, tracker_type: TrackerType,
+                 expected_frame_count: int, track_cache_key: Optional[str] = None):
+        self.bounding_box = bounding_box
+        self.start_frame_number = max(1, bounding_box.frame_number or 1)
+        self.track = Track(bounding_box.id, expected_frame_count - self.start_frame_number + 1)
+        self.video_frame_consumer = VideoFrameConsumer(bounding_box.id, frame_reader, self.track.append, self.on_error,
+                                                       tracker_type)
+        self.is_started = False
+        self.track_cache_key = track_cache_key
+
+    def start(self):
+        self.video_frame_consumer.start(self.bounding_box)
+        self.track.append(self.bounding_box.model_copy(update={'frame_number': self.start_frame_number}))
+
+    def is_active(self) -> bool:
+        """not started yet or still tracking"""
+        return not self.video_frame_consumer.has_failed
+
+    def on_error(self, event: ThreadingEvent):
+        # the frame the tracker failed on has already been released
+        self.track.lost_frame_number = self.video_frame_consumer.frame_reader.next_frame_number - 1
+
+
+def track_video(video_source: str, bounding_boxes: list[BoundingBox], tracker_type: TrackerType = TrackerType.CSRT,
+                tracking_scale: float | str = 1.0, grayscale: bool = False,
+                worker_count: int = BATCH_TRACKING_WORKERS) -> BatchTrackingResult:
+    """
+    Track boxes through a whole recorded video as fast as possible, without pacing or a websocket.
+    The video is decoded once. The trackers of all boxes run in parallel on every frame, while the next frame is
+    decoded, and the next frame is only published when all of them are done (OpenCV releases the GIL while tracking).
+    :param bounding_boxes: the frame_number of each box is the frame it is drawn on and tracked from
+    :return: the positions of every box and the throughput
+    """
+    video_capture = cv2.VideoCapture(video_source)
+    if not video_capture.isOpened():
+        raise TrackingError(f"Cannot open {video_source}")
+    expected_frame_count = int(video_capture.get(cv2.CAP_PROP_FRAME_COUNT))
+    track_cache = get_track_cache()
+    video_hash = track_cache.hash_video(video_source) if track_cache is not None else None
+    # two slots: one being tracked and one being decoded
+    frame_ring_buffer = FrameRingBuffer(2, use_shared_memory=TRACKER_EXECUTION_MODE == TrackerExecutionMode.PROCESS)
+    batch_boxes: list[BatchBox] = []
+    for bounding_box in bounding_boxes:
+        frame_variant = trackers.choose_frame_variant(bounding_box.width, bounding_box.height, tracking_scale,
+                                                      grayscale)
+        start_frame_number = max(1, bounding_box.frame_number or 1)
+        frame_reader = frame_ring_buffer.add_reader(frame_variant, start_frame_number)
+        track_cache_key = None
+        if video_hash is not None:
+            track_cache_key = track_cache.make_key(video_hash, bounding_box, start_frame_number, tracker_type,
+                                                   frame_variant)
+        batch_boxes.append(BatchBox(bounding_box, frame_reader, tracker_type, expected_frame_count, track_cache_key))
+    logger.info(f"Tracking {len(batch_boxes)} boxes through {video_source} with {worker_count} workers")
+    start = time.perf_counter()
+    frame_number = 1
+    frame_count = 0
+    try:
+        with ThreadPoolExecutor(worker_count, thread_name_prefix="batch-tracker") as executor:
+            has_frame = decode_frame(video_capture, frame_ring_buffer, frame_number) is not None
+            while has_frame and any(batch_box.is_active() for batch_box in batch_boxes):
+                frame_ring_buffer.publish(frame_number)
+                futures: dict[Future, BatchBox] = {}
+                for batch_box in batch_boxes:
+                    if batch_box.is_started:
+                        if batch_box.is_active():
+                            futures[executor.submit(batch_box.video_frame_consumer.step)] = batch_box
+                    elif batch_box.start_frame_number == frame_number:
+                        batch_box.is_started = True
+                        futures[executor.submit(batch_box.start)] = batch_box
+                # all readers are done with the previous frame, so its slot can be decoded into meanwhile
+                has_frame = decode_frame(video_capture, frame_ring_buffer, frame_number + 1) is not None
+                wait(futures)
+                for future, batch_box in futures.items():
+                    if future.exception() is not None:
+                        logger.warning(f"Box {batch_box.bounding_box.id} could not be initialized: "
+                                       f"{future.exception()}")
+                        batch_box.video_frame_consumer.has_failed = True
+                        batch_box.track.lost_frame_number = frame_number
+                    if not batch_box.is_active():
+                        # nobody reads its frames anymore
+                        batch_box.video_frame_consumer.quit()
+                frame_count += 1
+                frame_number += 1
+    except ValueError as e:
+        # raised by decode_frame()
+        raise TrackingError(f"{video_source}: {e}")
+    finally:
+        for batch_box in batch_boxes:
+            batch_box.video_frame_consumer.quit()
+            batch_box.video_frame_consumer.close()
+        video_capture.release()
+        frame_ring_buffer.free()
+    elapsed_seconds = time.perf_counter() - start
+    for batch_box in batch_boxes:
+        # every track is complete: tracked to the end of the video or lost
+        if batch_box.track_cache_key is not None and batch_box.track.position_count:
+            track_cache.put(batch_box.track_cache_key, batch_box.track)
+    result = BatchTrackingResult({batch_box.track.object_id: batch_box.track for batch_box in batch_boxes},
+                                 frame_count, elapsed_seconds)
+    logger.info(f"Tracked {result.frame_count} frames of {video_source} in {elapsed_seconds:.2f} s "
+                f"({result.fps:.1f} fps)")
+    return result
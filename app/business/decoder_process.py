@@ -0,0 +1,347 @@
+import logging
+import multiprocessing
+import threading
+import time
+from collections import deque
+from multiprocessing import shared_memory, resource_tracker
+from multiprocessing.connection import Connection
+from typing import Optional
+
+import cv2
+import numpy as np
+
+from business.metrics import RESOURCE_CREATION_SECONDS, RESOURCES_ACQUIRED, RESOURCE_CREATION_SECONDS_SAVED, \
+    SPARE_DECODER_PROCESSES
+from config.constants import LOG_FORMAT, LOG_LEVEL, DECODER_PREFETCH_FRAMES, DECODER_THREAD_COUNT, \
+    DECODER_PROCESS_TIMEOUT, DECODER_SPARE_PROCESSES
+
+logging.basicConfig(format=LOG_FORMAT)
+logger = logging.getLogger(__name__)
+logger.setLevel(LOG_LEVEL)
+
+DECODER_PROCESS = "decoder_process"
+
+# messages of the decoder process
+READY = "ready"
+PROPERTIES = "properties"
+FRAME = "frame"
+SHAPE = "shape"
+END = "end"
+ERROR = "error"
+
+# sent by the decoder process once it has opened the video and read by PrefetchingVideoCapture.get(), all other
+# properties are 0
+PROBED_PROPERTIES = (cv2.CAP_PROP_FPS, cv2.CAP_PROP_FRAME_COUNT, cv2.CAP_PROP_FRAME_WIDTH, cv2.CAP_PROP_FRAME_HEIGHT)
+
+
+def open_video_capture(video_source: str, thread_count: int = DECODER_THREAD_COUNT) -> cv2.VideoCapture:
+    """
+    :param thread_count: threads FFmpeg decodes with, 0 for its default
+    """
+    if not thread_count:
+        return cv2.VideoCapture(video_source)
+    return cv2.VideoCapture(video_source, cv2.CAP_ANY, [cv2.CAP_PROP_N_THREADS, thread_count])
+
+
+def run_decoder(connection: Connection):
+    """
+    Main loop of a decoder process: decodes ahead into the free slots of the prefetch buffer.
+    Sends (READY, time.monotonic()) as soon as it runs and waits for (video_source, thread_count, prefetch_count), or
+    None to exit without decoding anything, so that it can be started before the video is known. Sends
+    (PROPERTIES, PROBED_PROPERTIES by value, whether the video could be opened) once it has opened the video.
+    Receives the name of the shared memory block once it has sent the shape of the frames, then the indices of
+    slots which may be overwritten again and None to exit. Sends (FRAME, slot index) for every decoded frame and
+    (END, None) or (ERROR, message) when it stops.
+    """
+    try:
+        connection.send((READY, time.monotonic()))
+        request = connection.recv()
+    except (EOFError, BrokenPipeError):
+        return
+    if request is None:
+        return
+    video_source, thread_count, prefetch_count = request
+    video_capture = open_video_capture(video_source, thread_count)
+    free_slot_indices = deque(range(prefetch_count))
+    prefetch_memory: Optional[shared_memory.SharedMemory] = None
+    slots: Optional[np.ndarray] = None
+    try:
+        connection.send((PROPERTIES, {video_property: video_capture.get(video_property)
+                                      for video_property in PROBED_PROPERTIES}, video_capture.isOpened()))
+        while True:
+            # wait for a free slot, but take every release which is there already
+            while not free_slot_indices or connection.poll():
+                message = connection.recv()
+                if message is None:
+                    return
+                free_slot_indices.append(message)
+            slot = slots[free_slot_indices[0]] if slots is not None else None
+            success, img = video_capture.read(slot)
+            if not success:
+                connection.send((END, None))
+                return
+            if slots is None:
+                connection.send((SHAPE, img.shape, img.dtype.str))
+                prefetch_memory_name = connection.recv()
+                if prefetch_memory_name is None:
+                    # released before the first frame was read
+                    return
+                prefetch_memory = shared_memory.SharedMemory(name=prefetch_memory_name)
+                # attaching registers the block at the resource tracker as if this process owned it (bpo-38119),
+                # which would warn about a leak after the producer has unlinked it
+                resource_tracker.unregister(prefetch_memory._name, "shared_memory")
+                slots = np.ndarray((prefetch_count, *img.shape), dtype=img.dtype, buffer=prefetch_memory.buf)
+                slots[free_slot_indices[0]] = img
+            elif img is not slot:
+                connection.send((ERROR, f"{video_source} has a frame of unexpected shape {img.shape}"))
+                return
+            connection.send((FRAME, free_slot_indices.popleft()))
+    except (EOFError, BrokenPipeError):
+        # the producer is gone
+        pass
+    finally:
+        video_capture.release()
+        slots = None
+        if prefetch_memory is not None:
+            prefetch_memory.close()
+
+
+class DecoderProcess:
+    """A started decoder process, which has not been given a video yet"""
+    process: multiprocessing.Process
+    connection: Connection
+    started_at: float
+    # None until its READY message has been received
+    ready_at: Optional[float]
+
+    def __init__(self):
+        # fork would copy the locks held by the threads of this process
+        context = multiprocessing.get_context("spawn")
+        self.connection, decoder_connection = context.Pipe()
+        self.process = context.Process(target=run_decoder, args=(decoder_connection,), name="decoder", daemon=True)
+        self.started_at = time.monotonic()
+        self.ready_at = None
+        self.process.start()
+        decoder_connection.close()
+
+    def on_ready(self, ready_at: float):
+        self.ready_at = ready_at
+        RESOURCE_CREATION_SECONDS.labels(DECODER_PROCESS).observe(ready_at - self.started_at)
+
+    def poll_ready(self) -> bool:
+        """receive the READY message, if it is there. Only while no video has been sent"""
+        if self.ready_at is None and self.connection.poll():
+            try:
+                _, ready_at = self.connection.recv()
+            except (EOFError, OSError):
+                return False
+            self.on_ready(ready_at)
+        return self.ready_at is not None
+
+    def stop(self):
+        try:
+            self.connection.send(None)
+        except (BrokenPipeError, OSError):
+            pass
+        self.process.join(DECODER_PROCESS_TIMEOUT)
+        if self.process.is_alive():
+            logger.warning("Decoder process did not exit, terminating it")
+            self.process.terminate()
+        self.connection.close()
+
+
+class DecoderProcessPool:
+    """
+    Keeps spare_count decoder processes started, so that a PrefetchingVideoCapture does not wait for a new process to
+    import Python, NumPy and OpenCV, which takes far longer than opening the video. Every process decodes one video and
+    exits, a taken process is replaced right away.
+    """
+    spare_count: int
+    spare_processes: deque[DecoderProcess]
+    lock: threading.Lock
+    is_shut_down: bool
+
+    def __init__(self, spare_count: int = DECODER_SPARE_PROCESSES):
+        self.spare_count = spare_count
+        self.spare_processes = deque()
+        self.lock = threading.Lock()
+        self.is_shut_down = False
+        with self.lock:
+            self.__start_spare_processes()
+        SPARE_DECODER_PROCESSES.set_callback(self.get_spare_process_count)
+
+    def __start_spare_processes(self):
+        """needs the lock. Starting a process only takes the parent a moment, the child warms up on its own"""
+        while not self.is_shut_down and len(self.spare_processes) < self.spare_count:
+            self.spare_processes.append(DecoderProcess())
+
+    def take(self) -> DecoderProcess:
+        """a started decoder process, which the caller has to send a video to"""
+        with self.lock:
+            decoder_process = self.spare_processes.popleft() if self.spare_processes else None
+            self.__start_spare_processes()
+        if decoder_process is not None and not decoder_process.process.is_alive():
+            logger.warning(f"Spare decoder process exited with {decoder_process.process.exitcode}")
+            decoder_process.connection.close()
+            decoder_process = None
+        if decoder_process is None:
+            RESOURCES_ACQUIRED.labels(DECODER_PROCESS, "created").inc()
+            return DecoderProcess()
+        RESOURCES_ACQUIRED.labels(DECODER_PROCESS, "pooled").inc()
+        if decoder_process.poll_ready():
+            RESOURCE_CREATION_SECONDS_SAVED.labels(DECODER_PROCESS).inc(
+                decoder_process.ready_at - decoder_process.started_at)
+        else:
+            # still warming up, but it has had a head start
+            RESOURCE_CREATION_SECONDS_SAVED.labels(DECODER_PROCESS).inc(time.monotonic() - decoder_process.started_at)
+        return decoder_process
+
+    def get_spare_process_count(self) -> int:
+        return len(self.spare_processes)
+
+    def shutdown(self):
+        SPARE_DECODER_PROCESSES.set_callback(None)
+        with self.lock:
+            self.is_shut_down = True
+            spare_processes = list(self.spare_processes)
+            self.spare_processes.clear()
+        for decoder_process in spare_processes:
+            decoder_process.stop()
+
+
+class PrefetchingVideoCapture:
+    """
+    Stands in for the cv2.VideoCapture of a producer, but decodes in a process of its own, up to prefetch_count frames
+    ahead into shared memory. Decoding does not hold the GIL of the server and, as long as the decoder keeps ahead,
+    does not add to the latency of a frame: reading one is a copy from the prefetch buffer into the slot of the ring.
+    The decoder process is taken from the DecoderProcessPool. It opens the video and reports its properties, so the
+    container is not opened by the server process at all.
+    Only read(), grab(), get() for the properties in PROBED_PROPERTIES, isOpened() and release() are supported.
+    Not thread safe, it belongs to the producer thread.
+    """
+    properties: dict[int, float]
+    is_opened: bool
+    prefetch_count: int
+    decoder_process: DecoderProcess
+    connection: Connection
+    prefetch_memory: Optional[shared_memory.SharedMemory]
+    slots: Optional[np.ndarray]
+    is_finished: bool
+
+    def __init__(self, video_source: str, prefetch_count: int = DECODER_PREFETCH_FRAMES,
+                 thread_count: int = DECODER_THREAD_COUNT):
+        """waits until the decoder process has opened the video, because its properties are needed right away"""
+        self.properties = {}
+        self.is_opened = False
+        self.prefetch_count = prefetch_count
+        self.prefetch_memory = None
+        self.slots = None
+        self.is_finished = False
+        self.decoder_process = get_decoder_process_pool().take()
+        self.connection = self.decoder_process.connection
+        try:
+            self.connection.send((video_source, thread_count, prefetch_count))
+            self.__receive_properties()
+        except (EOFError, OSError):
+            logger.error(f"Decoder process exited with {self.decoder_process.process.exitcode}")
+            self.is_finished = True
+
+    def __receive_properties(self):
+        while True:
+            if not self.connection.poll(DECODER_PROCESS_TIMEOUT):
+                logger.error(f"Decoder process did not open the video within {DECODER_PROCESS_TIMEOUT} seconds")
+                self.is_finished = True
+                return
+            message = self.connection.recv()
+            if message[0] == READY:
+                self.decoder_process.on_ready(message[1])
+            elif message[0] == PROPERTIES:
+                self.properties, self.is_opened = message[1], message[2]
+                return
+            else:
+                if message[0] == ERROR:
+                    logger.error(message[1])
+                self.is_finished = True
+                return
+
+    def isOpened(self) -> bool:
+        return self.is_opened
+
+    def get(self, video_property: int) -> float:
+        return self.properties.get(video_property, 0.0)
+
+    def __allocate(self, shape: tuple, dtype: str):
+        dtype = np.dtype(dtype)
+        size = self.prefetch_count * int(np.prod(shape)) * dtype.itemsize
+        self.prefetch_memory = shared_memory.SharedMemory(create=True, size=size)
+        self.slots = np.ndarray((self.prefetch_count, *shape), dtype=dtype, buffer=self.prefetch_memory.buf)
+        self.connection.send(self.prefetch_memory.name)
+
+    def __next_slot_index(self) -> Optional[int]:
+        """wait for the next decoded frame. None at the end of the video or if the decoder failed"""
+        while not self.is_finished:
+            try:
+                message = self.connection.recv()
+            except (EOFError, OSError):
+                logger.error(f"Decoder process exited with {self.decoder_process.process.exitcode}")
+                self.is_finished = True
+                break
+            if message[0] == FRAME:
+                return message[1]
+            if message[0] == SHAPE:
+                self.__allocate(*message[1:])
+            else:
+                if message[0] == ERROR:
+                    logger.error(message[1])
+                self.is_finished = True
+        return None
+
+    def read(self, image: Optional[np.ndarray] = None) -> tuple[bool, Optional[np.ndarray]]:
+        """like cv2.VideoCapture.read(): the frame is copied into image if it has the right shape"""
+        slot_index = self.__next_slot_index()
+        if slot_index is None:
+            return False, image
+        source = self.slots[slot_index]
+        if image is not None and image.shape == source.shape and image.dtype == source.dtype:
+            np.copyto(image, source)
+        else:
+            image = source.copy()
+        self.connection.send(slot_index)
+        return True, image
+
+    def grab(self) -> bool:
+        """skip a frame. It has been decoded already, but is not copied"""
+        slot_index = self.__next_slot_index()
+        if slot_index is None:
+            return False
+        self.connection.send(slot_index)
+        return True
+
+    def release(self):
+        self.decoder_process.stop()
+        self.is_finished = True
+        self.slots = None
+        if self.prefetch_memory is not None:
+            self.prefetch_memory.close()
+            self.prefetch_memory.unlink()
+            self.prefetch_memory = None
+
+
+__decoder_process_pool: Optional[DecoderProcessPool] = None
+__decoder_process_pool_lock = threading.Lock()
+
+
+def get_decoder_process_pool() -> DecoderProcessPool:
+    global __decoder_process_pool
+    with __decoder_process_pool_lock:
+        if __decoder_process_pool is None:
+            __decoder_process_pool = DecoderProcessPool()
+        return __decoder_process_pool
+
+
+def shutdown_decoder_process_pool():
+    global __decoder_process_pool
+    with __decoder_process_pool_lock:
+        if __decoder_process_pool is not None:
+            __decoder_process_pool.shutdown()
+            __decoder_process_pool = None
@@ -0,0 +1,355 @@
+import logging
+import threading
+from multiprocessing import shared_memory
+from typing import Optional, Callable, NamedTuple
+
+import cv2
+import numpy as np
+
+from config.constants import LOG_FORMAT, LOG_LEVEL
+
+logging.basicConfig(format=LOG_FORMAT)
+logger = logging.getLogger(__name__)
+logger.setLevel(LOG_LEVEL)
+
+
+class FrameVariant(NamedTuple):
+    """A reduced version of the decoded frames, which trackers can run on instead of the full resolution frames"""
+    scale: float = 1.0
+    grayscale: bool = False
+
+
+SOURCE = FrameVariant()
+
+
+class Frame:
+    """A published frame. img is a view into the ring and only valid until the reader releases it"""
+    __slots__ = ('frame_number', 'img', 'slot_index', 'shared_memory_name', 'scale')
+    frame_number: int
+    img: np.ndarray
+    slot_index: int
+    shared_memory_name: Optional[str]
+    # factors from source to img coordinates in x and y direction
+    scale: tuple[float, float]
+
+    def __init__(self, frame_number: int, img: np.ndarray, slot_index: int, shared_memory_name: Optional[str],
+                 scale: tuple[float, float]):
+        self.frame_number = frame_number
+        self.img = img
+        self.slot_index = slot_index
+        self.shared_memory_name = shared_memory_name
+        self.scale = scale
+
+    def get_shared_reference(self) -> tuple[str, int, tuple, str]:
+        """
+        describe where this frame lives, so that another process can attach to it
+        :return: name of the shared memory block, byte offset, shape and dtype of the image
+        """
+        if self.shared_memory_name is None:
+            raise ValueError(f"Frame {self.frame_number} is not stored in shared memory")
+        return self.shared_memory_name, self.slot_index * self.img.nbytes, self.img.shape, self.img.dtype.str
+
+
+class FrameReader:
+    """Cursor of one consumer into a FrameRingBuffer. Frames before next_frame_number are no longer needed by it."""
+    frame_ring_buffer: 'FrameRingBuffer'
+    frame_variant: FrameVariant
+    next_frame_number: int
+    # the frame between read() and release(), which must not be overwritten even if stale frames are dropped
+    held_frame_number: Optional[int]
+    # started on an older frame of the ring: reads every frame up to the newest one, even if stale frames are dropped
+    is_catching_up: bool
+    is_closed: bool
+
+    def __init__(self, frame_ring_buffer: 'FrameRingBuffer', frame_variant: FrameVariant, next_frame_number: int,
+                 is_catching_up: bool = False):
+        self.frame_ring_buffer = frame_ring_buffer
+        self.frame_variant = frame_variant
+        self.next_frame_number = next_frame_number
+        self.held_frame_number = None
+        self.is_catching_up = is_catching_up
+        self.is_closed = False
+
+    def read(self, timeout: Optional[float] = None) -> Optional[Frame]:
+        """
+        wait for the next frame of this reader. If the ring drops stale frames, this is the newest published frame
+        :param timeout: seconds to wait for the producer before raising TimeoutError
+        :return: the frame (valid until release() is called) or None if closed
+        """
+        return self.frame_ring_buffer.read(self, timeout)
+
+    def poll(self) -> Optional[Frame]:
+        """like read(), but returns None instead of waiting if the next frame has not been published yet"""
+        try:
+            return self.frame_ring_buffer.read(self, 0)
+        except TimeoutError:
+            return None
+
+    def release(self):
+        """mark the frame returned by the last read() as processed, so the producer may overwrite it"""
+        self.frame_ring_buffer.release(self)
+
+    def close(self):
+        self.frame_ring_buffer.remove_reader(self)
+
+
+class VariantSlots:
+    """The slots of one frame variant and which frame each of them currently holds"""
+    frame_variant: FrameVariant
+    shared_memory: Optional[shared_memory.SharedMemory]
+    slots: Optional[np.ndarray]
+    slot_frame_numbers: list[int]
+    scale: tuple[float, float]
+    # intermediate image for variants which are both scaled and converted
+    resized: Optional[np.ndarray]
+
+    def __init__(self, frame_variant: FrameVariant, capacity: int, source_shape: tuple, dtype: np.dtype,
+                 use_shared_memory: bool):
+        self.frame_variant = frame_variant
+        height = max(1, round(source_shape[0] * frame_variant.scale))
+        width = max(1, round(source_shape[1] * frame_variant.scale))
+        shape = (height, width) if frame_variant.grayscale else (height, width, *source_shape[2:])
+        slots_shape = (capacity, *shape)
+        if use_shared_memory:
+            self.shared_memory = shared_memory.SharedMemory(create=True, size=int(np.prod(slots_shape)) * dtype.itemsize)
+            self.slots = np.ndarray(slots_shape, dtype=dtype, buffer=self.shared_memory.buf)
+        else:
+            self.shared_memory = None
+            self.slots = np.empty(slots_shape, dtype=dtype)
+        self.slot_frame_numbers = [-1] * capacity
+        self.scale = (width / source_shape[1], height / source_shape[0])
+        needs_resized = frame_variant.grayscale and frame_variant.scale != 1.0
+        self.resized = np.empty((height, width, *source_shape[2:]), dtype=dtype) if needs_resized else None
+        logger.debug(f"Allocated {capacity} frame slots of shape {shape} for {frame_variant} ({self.slots.nbytes} bytes)")
+
+    def compute(self, source: np.ndarray, slot_index: int):
+        """derive this variant from a source frame"""
+        target = self.slots[slot_index]
+        if self.frame_variant.scale != 1.0:
+            resized = self.resized if self.frame_variant.grayscale else target
+            cv2.resize(source, (target.shape[1], target.shape[0]), dst=resized, interpolation=cv2.INTER_AREA)
+            source = resized
+        if self.frame_variant.grayscale:
+            cv2.cvtColor(source, cv2.COLOR_BGR2GRAY, dst=target)
+
+    def free(self):
+        self.slots = None
+        self.resized = None
+        if self.shared_memory is not None:
+            self.shared_memory.unlink()
+            try:
+                self.shared_memory.close()
+            except BufferError:
+                # a consumer still holds a view; the mapping is released once that view is garbage collected
+                pass
+            self.shared_memory = None
+
+
+class FrameRingBuffer:
+    """
+    Preallocated frame slots shared by the producer and all consumers of the sessions watching its video.
+    Frame n is stored in slot n % capacity. The producer decodes directly into the slots and only has to wait
+    when the slot it wants to overwrite still holds a frame that some reader has not processed yet.
+    With drop_stale_frames the producer never waits for slow readers: it only avoids the frames which are being read
+    right now and readers always skip ahead to the newest frame.
+    The ring also serves as a short history: a reader may start on any frame which is still in it.
+    Readers may ask for a reduced FrameVariant. Each variant that has readers is computed once per frame when it is
+    published and shared by all of them.
+    With use_shared_memory the slots live in multiprocessing.shared_memory blocks, so that worker processes
+    can read the frames without copying them.
+    """
+    capacity: int
+    drop_stale_frames: bool
+    use_shared_memory: bool
+    source_shape: Optional[tuple]
+    dtype: Optional[np.dtype]
+    variant_slots: dict[FrameVariant, VariantSlots]
+    reader_counts: dict[FrameVariant, int]
+    latest_frame_number: int
+    readers: list[FrameReader]
+    publish_listeners: list[Callable[[int], None]]
+    condition: threading.Condition
+    is_closed: bool
+
+    def __init__(self, capacity: int, use_shared_memory: bool = False):
+        self.capacity = capacity
+        self.drop_stale_frames = False
+        self.use_shared_memory = use_shared_memory
+        self.source_shape = None
+        self.dtype = None
+        self.variant_slots = {}
+        self.reader_counts = {}
+        self.latest_frame_number = 0
+        self.readers = []
+        self.publish_listeners = []
+        self.condition = threading.Condition()
+        self.is_closed = False
+
+    def is_allocated(self) -> bool:
+        return SOURCE in self.variant_slots
+
+    def allocate(self, shape: tuple, dtype=np.uint8):
+        """allocate memory for all slots at once. Must be called before the first frame is written"""
+        with self.condition:
+            if self.is_closed:
+                return
+            self.source_shape = shape
+            self.dtype = np.dtype(dtype)
+            for frame_variant in {SOURCE, *self.reader_counts}:
+                self.__allocate_variant(frame_variant)
+
+    def __allocate_variant(self, frame_variant: FrameVariant):
+        self.variant_slots[frame_variant] = VariantSlots(frame_variant, self.capacity, self.source_shape, self.dtype,
+                                                         self.use_shared_memory)
+
+    def __holds_frame(self, frame_number: int) -> bool:
+        if not self.is_allocated() or frame_number <= 0:
+            return False
+        return self.variant_slots[SOURCE].slot_frame_numbers[frame_number % self.capacity] == frame_number
+
+    def add_reader(self, frame_variant: FrameVariant = SOURCE, start_frame_number: Optional[int] = None) -> FrameReader:
+        """
+        create a reader which starts with the next frame to be published
+        :param start_frame_number: start with this frame instead, if it is still in the ring or not published yet.
+                                   Otherwise the reader starts with the next frame and its next_frame_number tells so
+        """
+        with self.condition:
+            next_frame_number = self.latest_frame_number + 1
+            is_catching_up = False
+            if start_frame_number is not None:
+                if start_frame_number > self.latest_frame_number:
+                    next_frame_number = start_frame_number
+                elif self.__holds_frame(start_frame_number):
+                    next_frame_number = start_frame_number
+                    is_catching_up = True
+            reader = FrameReader(self, frame_variant, next_frame_number, is_catching_up)
+            self.readers.append(reader)
+            self.reader_counts[frame_variant] = self.reader_counts.get(frame_variant, 0) + 1
+            if self.is_allocated() and frame_variant not in self.variant_slots:
+                self.__allocate_variant(frame_variant)
+            return reader
+
+    def remove_reader(self, reader: FrameReader):
+        with self.condition:
+            if not reader.is_closed:
+                reader.is_closed = True
+                self.readers.remove(reader)
+                # the slots stay allocated in case another reader wants the variant later
+                self.reader_counts[reader.frame_variant] -= 1
+                if not self.reader_counts[reader.frame_variant]:
+                    self.reader_counts.pop(reader.frame_variant)
+            self.condition.notify_all()
+
+    def get_queued_frame_count(self) -> int:
+        """how many published frames the slowest reader has not read yet"""
+        with self.condition:
+            if not self.readers:
+                return 0
+            return max(0, self.latest_frame_number + 1 - min(reader.next_frame_number for reader in self.readers))
+
+    def add_publish_listener(self, listener: Callable[[int], None]):
+        """listener is called with the frame number whenever a new frame has been published"""
+        # replaced instead of modified, so that publish() can iterate over it without the lock
+        with self.condition:
+            self.publish_listeners = [*self.publish_listeners, listener]
+
+    def remove_publish_listener(self, listener: Callable[[int], None]):
+        with self.condition:
+            self.publish_listeners = [other for other in self.publish_listeners if other != listener]
+
+    def acquire_slot(self, frame_number: int) -> Optional[np.ndarray]:
+        """
+        wait until frame_number may be written and return its slot
+        :return: the slot to decode into or None if the ring has been closed
+        """
+        overwritten_frame_number = frame_number - self.capacity
+        slot_index = frame_number % self.capacity
+
+        def can_overwrite():
+            if self.drop_stale_frames:
+                return all(reader.held_frame_number != overwritten_frame_number for reader in self.readers)
+            return all(reader.next_frame_number > overwritten_frame_number for reader in self.readers)
+
+        with self.condition:
+            self.condition.wait_for(lambda: self.is_closed or can_overwrite())
+            if self.is_closed:
+                return None
+            # readers must not mistake the half written slot for the frame it held before
+            for variant_slots in self.variant_slots.values():
+                variant_slots.slot_frame_numbers[slot_index] = -1
+            return self.variant_slots[SOURCE].slots[slot_index]
+
+    def publish(self, frame_number: int):
+        """compute the variants which have readers and make the frame visible to the readers"""
+        slot_index = frame_number % self.capacity
+        with self.condition:
+            if self.is_closed:
+                return
+            source = self.variant_slots[SOURCE].slots[slot_index]
+            wanted_variant_slots = [self.variant_slots[frame_variant] for frame_variant in self.reader_counts
+                                    if frame_variant != SOURCE]
+        # nobody reads the slot before it has been published, so the variants can be computed without the lock
+        for variant_slots in wanted_variant_slots:
+            variant_slots.compute(source, slot_index)
+        with self.condition:
+            if self.is_closed:
+                return
+            for variant_slots in [self.variant_slots[SOURCE], *wanted_variant_slots]:
+                variant_slots.slot_frame_numbers[slot_index] = frame_number
+            self.latest_frame_number = frame_number
+            self.condition.notify_all()
+        for listener in self.publish_listeners:
+            listener(frame_number)
+
+    def read(self, reader: FrameReader, timeout: Optional[float] = None) -> Optional[Frame]:
+        def is_available():
+            if self.drop_stale_frames:
+                return self.latest_frame_number >= reader.next_frame_number
+            if not self.is_allocated():
+                return False
+            source_slot_frame_numbers = self.variant_slots[SOURCE].slot_frame_numbers
+            return source_slot_frame_numbers[reader.next_frame_number % self.capacity] == reader.next_frame_number
+
+        with self.condition:
+            if not self.condition.wait_for(lambda: self.is_closed or reader.is_closed or is_available(), timeout):
+                raise TimeoutError(f"No frame {reader.next_frame_number} within {timeout} seconds")
+            if self.is_closed or reader.is_closed:
+                return None
+            if self.drop_stale_frames:
+                # catching up only as long as the producer has not overwritten the next frame yet
+                if not reader.is_catching_up or not self.__holds_frame(reader.next_frame_number):
+                    reader.next_frame_number = self.latest_frame_number
+                reader.is_catching_up = reader.next_frame_number < self.latest_frame_number
+            frame_number = reader.next_frame_number
+            slot_index = frame_number % self.capacity
+            reader.held_frame_number = frame_number
+            variant_slots = self.variant_slots[reader.frame_variant]
+            if variant_slots.slot_frame_numbers[slot_index] != frame_number:
+                # the reader was added while the producer was already publishing this frame
+                variant_slots.compute(self.variant_slots[SOURCE].slots[slot_index], slot_index)
+                variant_slots.slot_frame_numbers[slot_index] = frame_number
+        shared_memory_name = variant_slots.shared_memory.name if variant_slots.shared_memory is not None else None
+        # the frame may be shared with the readers of other sessions
+        img = variant_slots.slots[slot_index].view()
+        img.flags.writeable = False
+        return Frame(frame_number, img, slot_index, shared_memory_name, variant_slots.scale)
+
+    def release(self, reader: FrameReader):
+        with self.condition:
+            reader.next_frame_number = reader.held_frame_number + 1
+            reader.held_frame_number = None
+            self.condition.notify_all()
+
+    def close(self):
+        """wake up and stop everyone waiting on this ring"""
+        with self.condition:
+            self.is_closed = True
+            self.condition.notify_all()
+
+    def free(self):
+        """close the ring and give its memory back. Views which are still referenced keep ordinary memory alive"""
+        self.close()
+        with self.condition:
+            for variant_slots in self.variant_slots.values():
+                variant_slots.free()
+            self.variant_slots = {}
@@ -0,0 +1,266 @@
+"""
+Process wide metrics in the Prometheus text format, served on /metrics.
+Kept free of dependencies and cheap enough for the per frame paths: recording a value takes one uncontended lock.
+Label values are resolved once with labels() and the child is kept by the code that records, so the hot paths do not
+look anything up. Gauges which describe state, e.g. the number of sessions, are read from callbacks when scraped.
+"""
+import bisect
+import math
+import threading
+from abc import ABC, abstractmethod
+from typing import Callable, Optional
+
+from config.constants import METRICS_LATENCY_BUCKETS
+
+METRIC_NAME_PREFIX = "everything_tracker_"
+
+
+def format_labels(label_names: tuple[str, ...], label_values: tuple[str, ...], extra: str = "") -> str:
+    labels = [f'{name}="{escape_label_value(value)}"' for name, value in zip(label_names, label_values)]
+    if extra:
+        labels.append(extra)
+    return "{" + ",".join(labels) + "}" if labels else ""
+
+
+def escape_label_value(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value))
+
+
+class CounterValue:
+    value: float
+    lock: threading.Lock
+
+    def __init__(self):
+        self.value = 0.0
+        self.lock = threading.Lock()
+
+    def inc(self, amount: float = 1):
+        with self.lock:
+            self.value += amount
+
+
+class HistogramValue:
+    upper_bounds: tuple[float, ...]
+    # per bucket, not cumulative. The last one counts the values above all bounds
+    bucket_counts: list[int]
+    sum: float
+    count: int
+    lock: threading.Lock
+
+    def __init__(self, upper_bounds: tuple[float, ...]):
+        self.upper_bounds = upper_bounds
+        self.bucket_counts = [0] * (len(upper_bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def observe(self, value: float):
+        index = bisect.bisect_left(self.upper_bounds, value)
+        with self.lock:
+            self.bucket_counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+
+class Metric(ABC):
+    """A metric family: one value per combination of label values"""
+    metric_type: str = "untyped"
+    name: str
+    documentation: str
+    label_names: tuple[str, ...]
+    children: dict[tuple[str, ...], object]
+    # the only child of a metric without labels
+    unlabelled: Optional[object]
+    lock: threading.Lock
+
+    def __init__(self, name: str, documentation: str, label_names: tuple[str, ...] = ()):
+        self.name = METRIC_NAME_PREFIX + name
+        self.documentation = documentation
+        self.label_names = label_names
+        self.children = {}
+        self.lock = threading.Lock()
+        self.unlabelled = None if label_names else self.labels()
+
+    @abstractmethod
+    def create_child(self):
+        pass
+
+    def labels(self, *label_values: str):
+        """the value for these label values, created on first use. Keep it instead of calling this per frame"""
+        if len(label_values) != len(self.label_names):
+            raise ValueError(f"{self.name} expects the labels {self.label_names}")
+        with self.lock:
+            child = self.children.get(label_values)
+            if child is None:
+                child = self.create_child()
+                self.children[label_values] = child
+            return child
+
+    @abstractmethod
+    def render_samples(self) -> list[str]:
+        pass
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.metric_type}",
+                 *self.render_samples()]
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    metric_type = "counter"
+
+    def create_child(self) -> CounterValue:
+        return CounterValue()
+
+    def inc(self, amount: float = 1):
+        """for counters without labels"""
+        self.unlabelled.inc(amount)
+
+    def render_samples(self) -> list[str]:
+        with self.lock:
+            children = list(self.children.items())
+        return [f"{self.name}_total{format_labels(self.label_names, label_values)} {format_value(child.value)}"
+                for label_values, child in children]
+
+
+class Histogram(Metric):
+    metric_type = "histogram"
+    upper_bounds: tuple[float, ...]
+
+    def __init__(self, name: str, documentation: str, label_names: tuple[str, ...] = (),
+                 upper_bounds: tuple[float, ...] = METRICS_LATENCY_BUCKETS):
+        # needed by create_child() in the constructor of Metric already
+        self.upper_bounds = tuple(sorted(upper_bounds))
+        super().__init__(name, documentation, label_names)
+
+    def create_child(self) -> HistogramValue:
+        return HistogramValue(self.upper_bounds)
+
+    def observe(self, value: float):
+        """for histograms without labels"""
+        self.unlabelled.observe(value)
+
+    def render_samples(self) -> list[str]:
+        with self.lock:
+            children = list(self.children.items())
+        lines = []
+        for label_values, child in children:
+            with child.lock:
+                bucket_counts = list(child.bucket_counts)
+                total, count = child.sum, child.count
+            cumulative_count = 0
+            for upper_bound, bucket_count in zip((*self.upper_bounds, math.inf), bucket_counts):
+                cumulative_count += bucket_count
+                labels = format_labels(self.label_names, label_values, f'le="{format_value(upper_bound)}"')
+                lines.append(f"{self.name}_bucket{labels} {cumulative_count}")
+            labels = format_labels(self.label_names, label_values)
+            lines.append(f"{self.name}_sum{labels} {format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+class CallbackGauge(Metric):
+    """A gauge which is read from a callback when scraped. Without a callback it is not exported"""
+    metric_type = "gauge"
+    callback: Optional[Callable[[], float]]
+
+    def __init__(self, name: str, documentation: str, callback: Optional[Callable[[], float]] = None):
+        super().__init__(name, documentation)
+        self.callback = callback
+
+    def create_child(self):
+        return None
+
+    def set_callback(self, callback: Optional[Callable[[], float]]):
+        """replaces the previous callback, e.g. when a process wide component has been recreated"""
+        self.callback = callback
+
+    def render(self) -> str:
+        if self.callback is None:
+            return ""
+        return super().render()
+
+    def render_samples(self) -> list[str]:
+        callback = self.callback
+        return [f"{self.name} {format_value(callback())}"] if callback is not None else []
+
+
+class MetricsRegistry:
+    metrics: list[Metric]
+    lock: threading.Lock
+
+    def __init__(self):
+        self.metrics = []
+        self.lock = threading.Lock()
+
+    def register(self, metric: Metric) -> Metric:
+        with self.lock:
+            self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        """all metrics in the Prometheus text exposition format"""
+        with self.lock:
+            metrics = list(self.metrics)
+        return "".join(f"{text}\n" for text in (metric.render() for metric in metrics) if text)
+
+
+metrics_registry = MetricsRegistry()
+
+STAGE_SECONDS: Histogram = metrics_registry.register(Histogram(
+    "stage_seconds", "Seconds spent on one frame per pipeline stage: decode, tracking (one box), aggregation (first "
+                     "box of a frame until its update is complete) and send (writing an update to the websocket)",
+    ("stage",)))
+DECODE_SECONDS: HistogramValue = STAGE_SECONDS.labels("decode")
+TRACKING_SECONDS: HistogramValue = STAGE_SECONDS.labels("tracking")
+AGGREGATION_SECONDS: HistogramValue = STAGE_SECONDS.labels("aggregation")
+SEND_SECONDS: HistogramValue = STAGE_SECONDS.labels("send")
+
+FRAMES_DECODED: Counter = metrics_registry.register(Counter("frames_decoded", "Frames decoded by the producers"))
+FRAMES_DROPPED: Counter = metrics_registry.register(Counter(
+    "frames_dropped", "Frames without an update: skipped by real time decoders without decoding them (decode) or "
+                      "not sent to a client because its trackers or websocket were too slow (update)", ("stage",)))
+DECODER_DROPPED_FRAMES: CounterValue = FRAMES_DROPPED.labels("decode")
+UPDATE_DROPPED_FRAMES: CounterValue = FRAMES_DROPPED.labels("update")
+PREDICTED_BOXES: Counter = metrics_registry.register(Counter(
+    "predicted_boxes", "Boxes predicted from the motion of their object instead of being tracked"))
+UPDATES_SENT: Counter = metrics_registry.register(Counter("updates_sent", "Tracking updates written to websockets"))
+STALE_BOXES: Counter = metrics_registry.register(Counter(
+    "stale_boxes", "Boxes sent with their last known position because their tracker missed the aggregation deadline"))
+TRACKER_FAILURES: Counter = metrics_registry.register(Counter(
+    "tracker_failures", "Trackers which lost their object or failed otherwise", ("tracker",)))
+
+SESSIONS: CallbackGauge = metrics_registry.register(CallbackGauge("sessions", "Open websocket sessions of all workers"))
+THREADS: CallbackGauge = metrics_registry.register(CallbackGauge("threads", "Live threads of the process",
+                                                                 threading.active_count))
+FRAMES_QUEUED: CallbackGauge = metrics_registry.register(CallbackGauge(
+    "frames_queued", "Decoded frames which the slowest tracker of their decoder has not read yet, of all decoders"))
+DECODERS: CallbackGauge = metrics_registry.register(CallbackGauge("decoders", "Running shared video decoders"))
+CPU_BUDGET: CallbackGauge = metrics_registry.register(CallbackGauge(
+    "tracker_cpu_budget", "CPUs the trackers of all sessions may use by the estimates of the resource governor"))
+CPU_COMMITTED: CallbackGauge = metrics_registry.register(CallbackGauge(
+    "tracker_cpu_committed", "Estimated CPUs needed by the trackers of all admitted boxes"))
+ADMISSION_DECISIONS: Counter = metrics_registry.register(Counter(
+    "admission_decisions", "Sessions, boxes and batch jobs admitted, degraded to a cheaper tracker, scale or fewer "
+                           "workers, or rejected by the resource governor", ("kind", "decision")))
+TRACKER_TASKS_READY: CallbackGauge = metrics_registry.register(CallbackGauge(
+    "tracker_tasks_ready", "Trackers waiting for a scheduler worker"))
+RESOURCE_CREATION_SECONDS: Histogram = metrics_registry.register(Histogram(
+    "resource_creation_seconds", "Seconds until a resource could be used: opening a video capture or starting a "
+                                 "decoder process", ("resource",)))
+RESOURCES_ACQUIRED: Counter = metrics_registry.register(Counter(
+    "resources_acquired", "Video captures and decoder processes handed out, created on demand or taken from a pool",
+    ("resource", "origin")))
+RESOURCE_CREATION_SECONDS_SAVED: Counter = metrics_registry.register(Counter(
+    "resource_creation_seconds_saved", "Creation time which was not waited for, because the resource came from a pool",
+    ("resource",)))
+IDLE_VIDEO_CAPTURES: CallbackGauge = metrics_registry.register(CallbackGauge(
+    "idle_video_captures", "Open video captures kept for the next reader of their video"))
+SPARE_DECODER_PROCESSES: CallbackGauge = metrics_registry.register(CallbackGauge(
+    "spare_decoder_processes", "Decoder processes started ahead of time"))
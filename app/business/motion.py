@@ -0,0 +1,98 @@
+from typing import Optional
+
+import numpy as np
+
+from config.constants import KEYFRAME_MAX_MOTION
+
+
+class KeyframeSchedule:
+    """
+    Lets a box be tracked on every k-th frame only and predicts it on the frames in between, assuming it keeps the
+    velocity it had between the last two tracked frames. k adapts to the motion of the object: it is halved as soon as
+    the object moves more than KEYFRAME_MAX_MOTION of its size between two tracked frames and grows by one while it
+    moves less than half of that, up to max_interval.
+    Boxes are (x, y, width, height) in source coordinates.
+    """
+    max_interval: int
+    interval: int
+    last_frame_number: int
+    last_box: Optional[np.ndarray]
+    # change of x and y per frame
+    velocity: np.ndarray
+
+    def __init__(self, max_interval: int = 1):
+        self.max_interval = max(1, max_interval)
+        self.interval = 1
+        self.last_frame_number = 0
+        self.last_box = None
+        self.velocity = np.zeros(2)
+
+    def start(self, frame_number: int, box: tuple):
+        self.last_frame_number = frame_number
+        self.last_box = np.array(box, dtype=float)
+        self.velocity = np.zeros(2)
+
+    def is_keyframe(self, frame_number: int) -> bool:
+        return self.last_box is None or frame_number - self.last_frame_number >= self.interval
+
+    def predict(self, frame_number: int) -> tuple[int, int, int, int]:
+        x, y = self.last_box[:2] + self.velocity * (frame_number - self.last_frame_number)
+        return round(x), round(y), round(self.last_box[2]), round(self.last_box[3])
+
+    def update(self, frame_number: int, box: tuple):
+        """the tracked box of a keyframe"""
+        box = np.array(box, dtype=float)
+        if self.last_box is not None and frame_number > self.last_frame_number:
+            self.velocity = (box[:2] - self.last_box[:2]) / (frame_number - self.last_frame_number)
+            size = max(1.0, min(box[2], box[3]))
+            motion_per_frame = float(np.hypot(*self.velocity)) / size
+            if motion_per_frame * self.interval > KEYFRAME_MAX_MOTION:
+                self.interval = max(1, self.interval // 2)
+            elif motion_per_frame * (self.interval + 1) < KEYFRAME_MAX_MOTION / 2:
+                self.interval = min(self.max_interval, self.interval + 1)
+        self.last_frame_number = frame_number
+        self.last_box = box
+
+
+class CentreKalmanFilter:
+    """Constant velocity Kalman filter on the centre of a box. Steps are measured in frames and may skip frames"""
+    # x, y, velocity x, velocity y
+    state: np.ndarray
+    covariance: np.ndarray
+    process_noise: float
+    measurement_noise: float
+    last_frame_number: int
+
+    def __init__(self, process_noise: float = 1.0, measurement_noise: float = 4.0):
+        self.state = np.zeros(4)
+        self.covariance = np.eye(4)
+        self.process_noise = process_noise
+        self.measurement_noise = measurement_noise
+        self.last_frame_number = 0
+
+    def start(self, frame_number: int, centre: tuple[float, float]):
+        self.state = np.array([*centre, 0.0, 0.0])
+        # the velocity is unknown
+        self.covariance = np.diag([self.measurement_noise, self.measurement_noise, 100.0, 100.0])
+        self.last_frame_number = frame_number
+
+    def predict(self, frame_number: int) -> tuple[float, float]:
+        """advance to frame_number and return the expected centre"""
+        steps = max(0, frame_number - self.last_frame_number)
+        transition = np.eye(4)
+        transition[0, 2] = transition[1, 3] = steps
+        self.state = transition @ self.state
+        self.covariance = transition @ self.covariance @ transition.T + np.eye(4) * self.process_noise * steps
+        self.last_frame_number = frame_number
+        return self.state[0], self.state[1]
+
+    def correct(self, centre: tuple[float, float]) -> float:
+        """
+        :return: the distance between the measured and the predicted centre
+        """
+        innovation = np.array(centre) - self.state[:2]
+        innovation_covariance = self.covariance[:2, :2] + np.eye(2) * self.measurement_noise
+        gain = self.covariance[:, :2] @ np.linalg.inv(innovation_covariance)
+        self.state = self.state + gain @ innovation
+        self.covariance = self.covariance - gain @ self.covariance[:2, :]
+        return float(np.hypot(*innovation))
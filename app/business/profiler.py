@@ -0,0 +1,160 @@
+import collections
+import logging
+import os
+import sys
+import threading
+import time
+from types import FrameType
+from typing import Callable, Hashable, Optional
+
+from config.constants import LOG_FORMAT, LOG_LEVEL, PROFILE_DIRECTORY, PROFILER_SAMPLE_INTERVAL
+
+logging.basicConfig(format=LOG_FORMAT)
+logger = logging.getLogger(__name__)
+logger.setLevel(LOG_LEVEL)
+
+# threads which are shared by all sessions, like the scheduler workers, are marked with the session they are working
+# for: thread ident -> session id
+__thread_sessions: dict[int, Hashable] = {}
+
+
+def mark_thread(session_id: Hashable):
+    """the calling thread works for this session until unmark_thread() is called. Cheap enough for every step"""
+    __thread_sessions[threading.get_ident()] = session_id
+
+
+def unmark_thread():
+    __thread_sessions.pop(threading.get_ident(), None)
+
+
+def get_marked_threads(session_id: Hashable) -> set[int]:
+    return {ident for ident, marked_session_id in __thread_sessions.copy().items() if marked_session_id == session_id}
+
+
+def fold_stack(frame: Optional[FrameType], thread_name: str) -> str:
+    """the stack of a frame in the folded format, outermost first and prefixed with the thread name"""
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+        frame = frame.f_back
+    names.append(thread_name)
+    # ; separates the frames
+    return ";".join(name.replace(";", ":") for name in reversed(names))
+
+
+class SessionProfile:
+    session_id: Hashable
+    # the threads which belong to the session alone, the marked threads are sampled as well
+    get_thread_idents: Callable[[], set[int]]
+    end_time: float
+    path: str
+    # number of samples per folded stack
+    stacks: collections.Counter
+    sample_count: int
+
+    def __init__(self, session_id: Hashable, get_thread_idents: Callable[[], set[int]], seconds: float, path: str):
+        self.session_id = session_id
+        self.get_thread_idents = get_thread_idents
+        self.end_time = time.monotonic() + seconds
+        self.path = path
+        self.stacks = collections.Counter()
+        self.sample_count = 0
+
+    def sample(self, frames: dict[int, FrameType], thread_names: dict[int, str]):
+        for ident in self.get_thread_idents() | get_marked_threads(self.session_id):
+            frame = frames.get(ident)
+            if frame is not None:
+                self.stacks[fold_stack(frame, thread_names.get(ident, str(ident)))] += 1
+        self.sample_count += 1
+
+    def write(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        temporary_path = f"{self.path}.tmp"
+        with open(temporary_path, "w") as file:
+            for stack, count in self.stacks.most_common():
+                file.write(f"{stack} {count}\n")
+        os.replace(temporary_path, self.path)
+        logger.info(f"Profile of session '{self.session_id}' with {self.sample_count} samples written to {self.path}")
+
+
+class SamplingProfiler:
+    """
+    Samples the Python stacks of the threads of profiled sessions every PROFILER_SAMPLE_INTERVAL seconds and writes
+    them as folded stacks when the profile is over. The sampling thread only runs while there are profiles, so the
+    profiler costs nothing but the thread marks of the scheduler workers while it is off.
+    Native code, like an OpenCV tracker update, shows up as the Python function which called it. Trackers in worker
+    processes (TrackerExecutionMode.PROCESS) and decoder processes are not sampled.
+    """
+    profiles: dict[Hashable, SessionProfile]
+    lock: threading.Lock
+    thread: Optional[threading.Thread]
+
+    def __init__(self):
+        self.profiles = {}
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def start_profile(self, session_id: Hashable, seconds: float,
+                      get_thread_idents: Callable[[], set[int]]) -> SessionProfile:
+        """
+        :param get_thread_idents: returns the threads of the session which are not marked, e.g. its sender thread
+        :raise ValueError: if the session is being profiled already
+        """
+        path = os.path.join(PROFILE_DIRECTORY, f"{session_id}-{time.strftime('%Y%m%d-%H%M%S')}.folded")
+        profile = SessionProfile(session_id, get_thread_idents, seconds, path)
+        with self.lock:
+            if session_id in self.profiles:
+                raise ValueError(f"Session '{session_id}' is being profiled already")
+            self.profiles[session_id] = profile
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name="sampling-profiler", daemon=True)
+                self.thread.start()
+        logger.info(f"Profiling session '{session_id}' for {seconds} seconds")
+        return profile
+
+    def stop_profile(self, session_id: Hashable):
+        """end a profile early, e.g. because the session has been closed. It is written by the sampling thread"""
+        with self.lock:
+            profile = self.profiles.get(session_id)
+            if profile is not None:
+                profile.end_time = 0.0
+
+    def run(self):
+        while True:
+            with self.lock:
+                if not self.profiles:
+                    self.thread = None
+                    return
+                profiles = list(self.profiles.values())
+            frames = sys._current_frames()
+            thread_names = {thread.ident: thread.name for thread in threading.enumerate()}
+            now = time.monotonic()
+            for profile in profiles:
+                profile.sample(frames, thread_names)
+            # the frames keep their stacks alive
+            del frames
+            finished_profiles = [profile for profile in profiles if now >= profile.end_time]
+            if finished_profiles:
+                with self.lock:
+                    for profile in finished_profiles:
+                        self.profiles.pop(profile.session_id)
+                # profiles are only removed here, so nobody else samples them anymore
+                for profile in finished_profiles:
+                    try:
+                        profile.write()
+                    except OSError as e:
+                        logger.error(f"Profile of session '{profile.session_id}' could not be written: {e}")
+            time.sleep(PROFILER_SAMPLE_INTERVAL)
+
+
+__sampling_profiler: Optional[SamplingProfiler] = None
+__sampling_profiler_lock = threading.Lock()
+
+
+def get_sampling_profiler() -> SamplingProfiler:
+    global __sampling_profiler
+    with __sampling_profiler_lock:
+        if __sampling_profiler is None:
+            __sampling_profiler = SamplingProfiler()
+        return __sampling_profiler
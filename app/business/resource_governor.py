@@ -0,0 +1,179 @@
+import logging
+import threading
+from typing import Hashable, NamedTuple, Optional
+
+from business.frame_ring_buffer import FrameVariant
+from business.metrics import ADMISSION_DECISIONS, CPU_BUDGET, CPU_COMMITTED
+from business.tracker_registry import AUTO_TRACKER_FALLBACK_ORDER, TRACKER_COST_ESTIMATES
+from config.constants import LOG_FORMAT, LOG_LEVEL, TRACKER_CPU_BUDGET, FAIR_SHARE_THRESHOLD, \
+    DEGRADE_BOXES_OVER_BUDGET, AUTO_TRACKING_SCALES, AUTO_TRACKING_MIN_OBJECT_SIZE
+from models.dto import TrackerType
+from models.errors import OutOfResourcesError
+
+logging.basicConfig(format=LOG_FORMAT)
+logger = logging.getLogger(__name__)
+logger.setLevel(LOG_LEVEL)
+
+
+class BoxAdmission(NamedTuple):
+    """How an admitted box is tracked. Differs from what was asked for if the box had to be degraded"""
+    tracker_type: TrackerType
+    frame_variant: FrameVariant
+    # estimated seconds of tracker updates per second
+    cost: float
+
+    def describe(self) -> str:
+        return f"{self.tracker_type.value} tracker at tracking scale {self.frame_variant.scale}"
+
+
+def estimate_cost(tracker_type: TrackerType, width: int, height: int, scale: float, fps: float) -> float:
+    """
+    :param width: width of the object in the source frame
+    :param height: height of the object in the source frame
+    :return: estimated seconds of tracker updates per second of video
+    """
+    fixed_cost, cost_per_megapixel = TRACKER_COST_ESTIMATES[tracker_type]
+    return (fixed_cost + cost_per_megapixel * width * height * scale * scale / 1e6) * fps
+
+
+class ResourceGovernor:
+    """
+    Admits sessions and boxes against an estimated CPU budget for the trackers of all sessions, so that a new box
+    cannot slow down the boxes which are tracked already. The cost of a box is estimated from its tracker type and
+    its size in the tracked frame, see TRACKER_COST_ESTIMATES.
+    Up to FAIR_SHARE_THRESHOLD of the budget is first come, first served. Beyond that a session only gets new boxes
+    while it stays within its fair share, the budget divided by the number of sessions, and new sessions are rejected.
+    A box which does not fit is degraded to a smaller tracking scale or a cheaper tracker if that fits, and rejected
+    otherwise. Batch jobs, which track as fast as they can, reserve a CPU for each of their workers instead.
+    """
+    cpu_budget: float
+    # estimated cost of every admitted box by session and object id, or of a batch job by session and job id
+    session_costs: dict[Hashable, dict[Hashable, float]]
+    lock: threading.Lock
+
+    def __init__(self, cpu_budget: float = TRACKER_CPU_BUDGET):
+        self.cpu_budget = cpu_budget
+        self.session_costs = {}
+        self.lock = threading.Lock()
+        CPU_BUDGET.set_callback(lambda: self.cpu_budget)
+        CPU_COMMITTED.set_callback(self.get_committed_cost)
+
+    def get_committed_cost(self) -> float:
+        with self.lock:
+            return self.__committed_cost()
+
+    def __committed_cost(self) -> float:
+        return sum(sum(box_costs.values()) for box_costs in self.session_costs.values())
+
+    def add_session(self, session_id: Hashable):
+        """
+        :raise OutOfResourcesError: if the host is so busy that the session could not get a box of its own
+        """
+        with self.lock:
+            if session_id in self.session_costs:
+                return
+            committed_cost = self.__committed_cost()
+            if committed_cost > self.cpu_budget * FAIR_SHARE_THRESHOLD:
+                ADMISSION_DECISIONS.labels("session", "rejected").inc()
+                raise OutOfResourcesError(f"The server is busy: the trackers of the other sessions need "
+                                          f"{committed_cost:.2f} of {self.cpu_budget:.2f} CPUs")
+            self.session_costs[session_id] = {}
+        ADMISSION_DECISIONS.labels("session", "admitted").inc()
+
+    def remove_session(self, session_id: Hashable):
+        with self.lock:
+            self.session_costs.pop(session_id, None)
+
+    def __fits(self, session_id: Hashable, cost: float) -> bool:
+        committed_cost = self.__committed_cost()
+        if committed_cost + cost > self.cpu_budget:
+            return False
+        if committed_cost + cost <= self.cpu_budget * FAIR_SHARE_THRESHOLD:
+            return True
+        fair_share = self.cpu_budget / len(self.session_costs)
+        return sum(self.session_costs[session_id].values()) + cost <= fair_share
+
+    @staticmethod
+    def __degraded_options(tracker_type: TrackerType, frame_variant: FrameVariant,
+                           width: int, height: int) -> list[tuple[TrackerType, FrameVariant]]:
+        """cheaper ways to track the box, in the order they are tried: smaller scales first, then cheaper trackers"""
+        scales = [frame_variant.scale, *(scale for scale in sorted(AUTO_TRACKING_SCALES, reverse=True)
+                                         if scale < frame_variant.scale
+                                         and min(width, height) * scale >= AUTO_TRACKING_MIN_OBJECT_SIZE)]
+        requested_cost = TRACKER_COST_ESTIMATES[tracker_type]
+        tracker_types = [tracker_type, *(other for other in AUTO_TRACKER_FALLBACK_ORDER
+                                         if TRACKER_COST_ESTIMATES[other] < requested_cost)]
+        return [(other_tracker_type, frame_variant._replace(scale=scale))
+                for other_tracker_type in tracker_types for scale in scales][1:]
+
+    def admit_box(self, session_id: Hashable, object_id: int, tracker_type: TrackerType, frame_variant: FrameVariant,
+                  width: int, height: int, fps: float) -> BoxAdmission:
+        """
+        reserve the estimated cost of a box until release_box() is called
+        :param width: width of the object in the source frame
+        :param height: height of the object in the source frame
+        :param fps: frames per second the box is tracked at
+        :raise OutOfResourcesError: if neither the box nor a degraded version of it fits into the budget
+        """
+        options = [(tracker_type, frame_variant)]
+        if DEGRADE_BOXES_OVER_BUDGET:
+            options += self.__degraded_options(tracker_type, frame_variant, width, height)
+        with self.lock:
+            if session_id not in self.session_costs:
+                raise OutOfResourcesError(f"Session '{session_id}' has not been admitted")
+            for option_tracker_type, option_frame_variant in options:
+                cost = estimate_cost(option_tracker_type, width, height, option_frame_variant.scale, fps)
+                if self.__fits(session_id, cost):
+                    self.session_costs[session_id][object_id] = cost
+                    break
+            else:
+                ADMISSION_DECISIONS.labels("box", "rejected").inc()
+                raise OutOfResourcesError(f"The server is busy: not enough CPU left to track box {object_id}")
+        admission = BoxAdmission(option_tracker_type, option_frame_variant, cost)
+        is_degraded = (option_tracker_type, option_frame_variant) != (tracker_type, frame_variant)
+        ADMISSION_DECISIONS.labels("box", "degraded" if is_degraded else "admitted").inc()
+        if is_degraded:
+            logger.info(f"Session '{session_id}': box {object_id} degraded to {admission.describe()}")
+        return admission
+
+    def release_box(self, session_id: Hashable, object_id: int):
+        with self.lock:
+            self.session_costs.get(session_id, {}).pop(object_id, None)
+
+    def admit_workers(self, session_id: Hashable, job_id: Hashable, worker_count: int) -> int:
+        """
+        reserve a CPU for each worker of a batch job until release_workers() is called. A worker needs at most the
+        whole budget, so that hosts with a budget of less than a CPU can still run batch jobs
+        :return: how many of the workers fit into the budget
+        :raise OutOfResourcesError: if not even one worker fits
+        """
+        cost_per_worker = min(1.0, self.cpu_budget)
+        with self.lock:
+            if session_id not in self.session_costs:
+                raise OutOfResourcesError(f"Session '{session_id}' has not been admitted")
+            admitted_count = next((count for count in range(worker_count, 0, -1)
+                                   if self.__fits(session_id, count * cost_per_worker)), 0)
+            if not admitted_count:
+                ADMISSION_DECISIONS.labels("batch", "rejected").inc()
+                raise OutOfResourcesError("The server is busy: not enough CPU left to track the video")
+            self.session_costs[session_id][job_id] = admitted_count * cost_per_worker
+        ADMISSION_DECISIONS.labels("batch", "admitted" if admitted_count == worker_count else "degraded").inc()
+        if admitted_count < worker_count:
+            logger.info(f"Session '{session_id}': batch job {job_id} runs {admitted_count} of {worker_count} workers")
+        return admitted_count
+
+    def release_workers(self, session_id: Hashable, job_id: Hashable):
+        with self.lock:
+            self.session_costs.get(session_id, {}).pop(job_id, None)
+
+
+__resource_governor: Optional[ResourceGovernor] = None
+__resource_governor_lock = threading.Lock()
+
+
+def get_resource_governor() -> ResourceGovernor:
+    global __resource_governor
+    with __resource_governor_lock:
+        if __resource_governor is None:
+            __resource_governor = ResourceGovernor()
+        return __resource_governor
@@ -1,14 +1,30 @@
+import asyncio
+import collections
+import functools
 import logging
+import time
+from typing import Optional
 from uuid import UUID
 
 from fastapi import WebSocket
 
+from business import trackers, batch_tracking
+from business.profiler import get_sampling_profiler
+from business.resource_governor import ResourceGovernor, get_resource_governor
+from business.track_cache import TrackCache, TrackRecorder, get_track_cache
+from business.track_replay_consumer import TrackReplayConsumer
+from business.tracked_boxes import TrackingUpdate
+from business.tracker_scheduler import TrackerScheduler, get_tracker_scheduler
+from business.tracking_update_publisher import TrackingUpdatePublisher
 from business.tracking_update_sender import TrackingUpdateSenderThread
-from business.video_frame_consumer import VideoFrameConsumerThread
+from business.video_frame_consumer import VideoFrameConsumer
 from business.video_frame_producer import VideoFrameProducerThread
-from config.constants import LOG_LEVEL, LOG_FORMAT
+from business.video_frame_producer_registry import VideoFrameProducerRegistry, get_video_frame_producer_registry
+from config.constants import LOG_LEVEL, LOG_FORMAT, MAX_UPDATE_RATE, DECODE_TIME_HISTORY, DEFAULT_FPS, \
+    SESSION_TEARDOWN_TIMEOUT, BATCH_TRACKING_WORKERS
 from models import dto
 from models.dto import EventType
+from models.errors import TrackingError, OutOfResourcesError
 
 logging.basicConfig(format=LOG_FORMAT)
 logger = logging.getLogger(__name__)
@@ -18,42 +34,278 @@ logger.setLevel(LOG_LEVEL)
 class Session:
     session_id: UUID
     websocket: WebSocket
-    video_frame_producer: VideoFrameProducerThread
-    video_frame_consumers: dict[int, VideoFrameConsumerThread]
+    loop: asyncio.AbstractEventLoop
+    video_frame_producer_registry: VideoFrameProducerRegistry
+    # shared with the other sessions on the same video, None until the control loop has been started
+    video_frame_producer: Optional[VideoFrameProducerThread]
+    video_frame_consumers: dict[int, VideoFrameConsumer | TrackReplayConsumer]
+    track_cache: Optional[TrackCache]
+    # content hash of the video, if its tracks can be cached
+    video_hash: Optional[str]
+    track_recorders: dict[int, TrackRecorder]
+    # frame number and wall clock time each recent frame was published at, frame n is at n % DECODE_TIME_HISTORY
+    frame_decode_times: list[tuple[int, float]]
+    tracker_scheduler: TrackerScheduler
+    resource_governor: ResourceGovernor
     tracking_update_sender: TrackingUpdateSenderThread
+    tracking_update_publisher: TrackingUpdatePublisher
+    tracking_scale: float | str
+    grayscale: bool
+    keyframe_interval: int
 
-    def __init__(self, session_id: UUID, websocket: WebSocket):
+    def __init__(self, session_id: UUID, websocket: WebSocket, wire_format: dto.WireFormat = dto.WireFormat.JSON):
+        """must be called from the event loop which serves the websocket"""
         self.session_id = session_id
         self.websocket = websocket
-        self.video_frame_producer = VideoFrameProducerThread(self.on_video_frame_producer_quits)
+        self.loop = asyncio.get_running_loop()
+        self.video_frame_producer_registry = get_video_frame_producer_registry()
+        self.video_frame_producer = None
         self.video_frame_consumers = {}
-        self.tracking_update_sender = TrackingUpdateSenderThread(self.websocket)
+        self.track_cache = get_track_cache()
+        self.video_hash = None
+        self.track_recorders = {}
+        self.frame_decode_times = [(-1, 0.0)] * DECODE_TIME_HISTORY
+        self.tracker_scheduler = get_tracker_scheduler()
+        self.resource_governor = get_resource_governor()
+        self.tracking_scale = 1.0
+        self.grayscale = False
+        self.keyframe_interval = 1
+        self.tracking_update_publisher = TrackingUpdatePublisher(self.websocket, self.loop, wire_format,
+                                                                 MAX_UPDATE_RATE)
+        self.tracking_update_publisher.start()
+        self.tracking_update_sender = TrackingUpdateSenderThread(self.publish_update)
         logger.debug(f"Session '{session_id}' created")
 
-    def cleanup_session(self):
+    async def cleanup_session(self):
         logger.debug(f"Destroying Session '{self.session_id}'")
-        self.video_frame_producer.quit()
-        for consumer in self.video_frame_consumers.values():
+        for consumer in list(self.video_frame_consumers.values()):
             consumer.quit()
+            self.tracker_scheduler.unregister(self.session_id, consumer)
+            await self.store_track(consumer.object_id)
+        await self.release_video_frame_producer()
+        self.resource_governor.remove_session(self.session_id)
         self.tracking_update_sender.quit()
+        # it may be publishing an update, which must not reach the publisher after it has quit. Joined by an executor
+        # thread, so the other websockets of this worker are served meanwhile
+        await self.loop.run_in_executor(None, self.tracking_update_sender.join, SESSION_TEARDOWN_TIMEOUT)
+        self.tracking_update_publisher.quit()
+        get_sampling_profiler().stop_profile(self.session_id)
         logger.debug(f"Session '{self.session_id}' destroyed")
 
-    def start_control_loop(self, event: dto.StartControlLoopEvent):
-        self.video_frame_producer.load(video_source=event.video_source)
+    def get_thread_idents(self) -> set[int]:
+        """
+        the threads which work for this session alone or, like its decoder, for it among others. The scheduler workers
+        are marked while they run its trackers, see profiler.mark_thread()
+        """
+        threads = [self.tracking_update_sender.thread]
+        if self.video_frame_producer is not None:
+            threads.append(self.video_frame_producer.thread)
+        return {thread.ident for thread in threads if thread.is_alive()}
+
+    async def release_video_frame_producer(self):
+        if self.video_frame_producer is None:
+            return
+        video_frame_producer, self.video_frame_producer = self.video_frame_producer, None
+        video_frame_producer.frame_ring_buffer.remove_publish_listener(self.on_frame_published)
+        video_frame_producer.remove_quit_listener(self.on_video_frame_producer_quits)
+        # the last session quits the producer, which may have to wait for the registry lock and close the video
+        await self.loop.run_in_executor(None, self.video_frame_producer_registry.release, video_frame_producer)
+
+    async def reset_tracking_updates(self):
+        """
+        forget the frames of the previous video, the frame numbers of the next one start over. The sender is replaced,
+        so that none of its pending frames or an update it is publishing right now reaches the client afterwards
+        """
+        self.tracking_update_sender.quit()
+        await self.loop.run_in_executor(None, self.tracking_update_sender.join, SESSION_TEARDOWN_TIMEOUT)
+        self.tracking_update_sender = TrackingUpdateSenderThread(self.publish_update)
+        self.tracking_update_publisher.reset()
+        self.frame_decode_times = [(-1, 0.0)] * DECODE_TIME_HISTORY
+
+    async def start_control_loop(self, event: dto.StartControlLoopEvent):
+        try:
+            self.resource_governor.add_session(self.session_id)
+        except OutOfResourcesError as e:
+            logger.warning(e)
+            return dto.FailureEvent(event_type=EventType.FAILURE, request_id=event.request_id, message=str(e))
+        if self.video_frame_consumers:
+            logger.warning(f"Session '{self.session_id}' keeps its video source while boxes are tracked")
+        else:
+            if self.video_frame_producer is not None:
+                await self.release_video_frame_producer()
+                await self.reset_tracking_updates()
+            # opening the video, or waiting for a decoder process to open it, must not block the event loop
+            self.video_frame_producer = await self.loop.run_in_executor(
+                None, self.video_frame_producer_registry.acquire, event.video_source, event.real_time)
+            self.video_frame_producer.frame_ring_buffer.add_publish_listener(self.on_frame_published)
+            self.video_frame_producer.add_quit_listener(self.on_video_frame_producer_quits)
+            self.video_hash = None
+            # trackers skip frames in real time mode, so their tracks cannot be replayed
+            if self.track_cache is not None and not event.real_time:
+                self.video_hash = await self.loop.run_in_executor(None, self.track_cache.hash_video,
+                                                                  event.video_source)
+        self.tracking_scale = event.tracking_scale
+        self.grayscale = event.grayscale
+        self.keyframe_interval = event.keyframe_interval
+        if event.max_update_rate is not None:
+            self.tracking_update_publisher.set_max_update_rate(event.max_update_rate)
         return dto.SuccessEvent(event_type=EventType.SUCCESS, request_id=event.request_id, message="OK.")
 
-    def add_bounding_box(self, event: dto.AddBoundingBoxEvent):
-        video_frame_consumer = VideoFrameConsumerThread(event.bounding_box.id, self.on_video_frame_consumer_error)
-        self.video_frame_producer.add_queue(video_frame_consumer.input_queue)
-        if not self.video_frame_producer.is_running():
+    async def add_bounding_box(self, event: dto.AddBoundingBoxEvent) -> dto.AnswerEvent:
+        """
+        the reader of past frames is opened and the tracker is initialized by an executor thread, the event loop keeps
+        serving the websockets meanwhile
+        """
+        prepared = self.__prepare_bounding_box(event)
+        if isinstance(prepared, dto.AnswerEvent):
+            return prepared
+        return await self.__start_video_frame_consumer(event, *prepared)
+
+    async def add_bounding_boxes(self, event: dto.AddBoundingBoxesEvent) -> dto.AddBoundingBoxesResultEvent:
+        """
+        add several boxes of the same frame with one answer. All readers are added before any tracker is initialized,
+        so they share the frame in the ring, and the trackers are initialized in parallel.
+        Boxes whose id occurs more than once in the event all fail, it is unclear which of them the id refers to
+        """
+        box_events = [dto.AddBoundingBoxEvent(
+            event_type=EventType.ADD_BOUNDING_BOX, request_id=event.request_id, frame_number=event.frame_number,
+            bounding_box=bounding_box, tracker=event.tracker, tracking_scale=event.tracking_scale,
+            grayscale=event.grayscale, keyframe_interval=event.keyframe_interval)
+            for bounding_box in event.bounding_boxes]
+        id_counts = collections.Counter(bounding_box.id for bounding_box in event.bounding_boxes)
+        prepared_boxes = [
+            self.__prepare_bounding_box(box_event) if id_counts[box_event.bounding_box.id] == 1
+            else dto.FailureEvent(event_type=EventType.FAILURE, request_id=event.request_id,
+                                  message=f"Box {box_event.bounding_box.id} occurs more than once")
+            for box_event in box_events]
+
+        async def finish(box_event: dto.AddBoundingBoxEvent, prepared) -> dto.AnswerEvent:
+            if isinstance(prepared, dto.AnswerEvent):
+                return prepared
+            return await self.__start_video_frame_consumer(box_event, *prepared)
+
+        answers = await asyncio.gather(*(finish(box_event, prepared)
+                                         for box_event, prepared in zip(box_events, prepared_boxes)),
+                                       return_exceptions=True)
+        results = [dto.BoundingBoxResult(id=box_event.bounding_box.id, success=isinstance(answer, dto.SuccessEvent),
+                                         message=str(answer) if isinstance(answer, BaseException) else answer.message)
+                   for box_event, answer in zip(box_events, answers)]
+        failure_count = sum(not result.success for result in results)
+        message = f"{failure_count} of {len(results)} boxes failed" if failure_count else "OK."
+        return dto.AddBoundingBoxesResultEvent(event_type=EventType.ADD_BOUNDING_BOXES_RESULT,
+                                               request_id=event.request_id, message=message, results=results)
+
+    def __prepare_bounding_box(self, event: dto.AddBoundingBoxEvent) \
+            -> dto.AnswerEvent | tuple[VideoFrameConsumer, str]:
+        """
+        everything of adding a box which does not block: admission, the reader of the live frames and the consumer.
+        The reader of past frames is opened when the consumer is started
+        :return: the answer if the box is already done with, otherwise the consumer to start and the success message
+        """
+        if self.video_frame_producer is None:
+            return dto.FailureEvent(event_type=EventType.FAILURE, request_id=event.request_id,
+                                    message="The control loop has not been started")
+        if event.bounding_box.id in self.video_frame_consumers:
+            return dto.FailureEvent(event_type=EventType.FAILURE, request_id=event.request_id,
+                                    message=f"Box {event.bounding_box.id} is already tracked")
+        frame_variant = trackers.choose_frame_variant(
+            event.bounding_box.width, event.bounding_box.height,
+            event.tracking_scale if event.tracking_scale is not None else self.tracking_scale,
+            event.grayscale if event.grayscale is not None else self.grayscale)
+        keyframe_interval = event.keyframe_interval if event.keyframe_interval is not None else self.keyframe_interval
+        # frame numbers start with 1, anything else means the next frame
+        start_frame_number = event.frame_number if event.frame_number > 0 else None
+        track_cache_key = None
+        # predicted boxes are not cached, so that a replayed track is always as good as a tracked one
+        if self.video_hash is not None and start_frame_number is not None and keyframe_interval <= 1:
+            track_cache_key = self.track_cache.make_key(self.video_hash, event.bounding_box, start_frame_number,
+                                                        event.tracker, frame_variant)
+            positions = self.track_cache.get(track_cache_key)
+            if positions is not None:
+                return self.replay_track(event, positions)
+        try:
+            admission = self.resource_governor.admit_box(
+                self.session_id, event.bounding_box.id, event.tracker, frame_variant, event.bounding_box.width,
+                event.bounding_box.height, self.video_frame_producer.fps or DEFAULT_FPS)
+        except OutOfResourcesError as e:
+            logger.warning(e)
+            return dto.FailureEvent(event_type=EventType.FAILURE, request_id=event.request_id, message=str(e))
+        message = "OK."
+        if (admission.tracker_type, admission.frame_variant) != (event.tracker, frame_variant):
+            message = f"OK. Tracked with {admission.describe()} to stay within the CPU budget of the server"
+            frame_variant = admission.frame_variant
+            if track_cache_key is not None:
+                track_cache_key = self.track_cache.make_key(self.video_hash, event.bounding_box, start_frame_number,
+                                                            admission.tracker_type, frame_variant)
+        frame_reader = self.video_frame_producer.add_reader(frame_variant, start_frame_number)
+        open_past_frame_reader = None
+        if start_frame_number is not None and start_frame_number < frame_reader.next_frame_number:
+            open_past_frame_reader = functools.partial(self.video_frame_producer.read_past_frames, start_frame_number,
+                                                       frame_reader.next_frame_number, frame_variant)
+        output_callback = self.tracking_update_sender.submit
+        if track_cache_key is not None:
+            track_recorder = TrackRecorder(track_cache_key, event.bounding_box, start_frame_number, output_callback)
+            self.track_recorders[event.bounding_box.id] = track_recorder
+            output_callback = track_recorder.submit
+        video_frame_consumer = VideoFrameConsumer(event.bounding_box.id, frame_reader, output_callback,
+                                                  self.on_video_frame_consumer_error, admission.tracker_type,
+                                                  open_past_frame_reader, keyframe_interval)
+        if not self.video_frame_producer.has_started():
             self.video_frame_producer.start()
-        video_frame_consumer.start(event.bounding_box)
-        self.tracking_update_sender.add_queue(video_frame_consumer.output_queue)
+        return video_frame_consumer, message
+
+    async def __start_video_frame_consumer(self, event: dto.AddBoundingBoxEvent,
+                                           video_frame_consumer: VideoFrameConsumer, message: str) -> dto.AnswerEvent:
+        try:
+            await self.loop.run_in_executor(None, video_frame_consumer.start, event.bounding_box)
+        except Exception as e:
+            # any failure only fails this box: its readers must not hold back the producer
+            video_frame_consumer.quit()
+            video_frame_consumer.close()
+            self.track_recorders.pop(event.bounding_box.id, None)
+            self.resource_governor.release_box(self.session_id, event.bounding_box.id)
+            logger.error(f"Box {event.bounding_box.id} could not be added: {e}")
+            return dto.FailureEvent(event_type=EventType.FAILURE, request_id=event.request_id, message=str(e))
+        self.tracking_update_sender.add_tracker(video_frame_consumer.object_id)
+        self.tracker_scheduler.register(self.session_id, video_frame_consumer)
         if not self.tracking_update_sender.is_running():
             self.tracking_update_sender.start()
         self.video_frame_consumers[video_frame_consumer.object_id] = video_frame_consumer
+        return dto.SuccessEvent(event_type=EventType.SUCCESS, request_id=event.request_id, message=message)
+
+    def replay_track(self, event: dto.AddBoundingBoxEvent, positions):
+        """follow the box with a track from the TrackCache instead of a tracker"""
+        # the cached positions start on the frame of the box, so the replay can start on any later frame
+        frame_reader = self.video_frame_producer.add_reader(start_frame_number=event.frame_number)
+        track_replay_consumer = TrackReplayConsumer(event.bounding_box.id, frame_reader, positions, event.bounding_box,
+                                                    self.tracking_update_sender.submit,
+                                                    self.on_video_frame_consumer_error)
+        if not self.video_frame_producer.has_started():
+            self.video_frame_producer.start()
+        self.tracking_update_sender.add_tracker(track_replay_consumer.object_id)
+        self.tracker_scheduler.register(self.session_id, track_replay_consumer)
+        if not self.tracking_update_sender.is_running():
+            self.tracking_update_sender.start()
+        self.video_frame_consumers[track_replay_consumer.object_id] = track_replay_consumer
+        logger.info(f"Session '{self.session_id}' replays a cached track for {track_replay_consumer.object_id}")
         return dto.SuccessEvent(event_type=EventType.SUCCESS, request_id=event.request_id, message="OK.")
 
+    async def store_track(self, object_id: int, is_lost: bool = False):
+        """
+        put the track of a box into the TrackCache, if it is complete: lost or tracked until the video ended.
+        The file is written by an executor thread
+        """
+        track_recorder = self.track_recorders.pop(object_id, None)
+        if track_recorder is None or track_recorder.has_gap:
+            return
+        video_frame_producer = self.video_frame_producer
+        has_video_ended = (video_frame_producer is not None and video_frame_producer.has_started()
+                           and not video_frame_producer.is_running() and not video_frame_producer.has_quit()
+                           and track_recorder.track.get_last_frame_number()
+                           == video_frame_producer.frame_ring_buffer.latest_frame_number)
+        if is_lost or has_video_ended:
+            await self.loop.run_in_executor(None, self.track_cache.put, track_recorder.key, track_recorder.track)
+
     async def delete_bounding_boxes(self, event: dto.DeleteBoundingBoxesEvent):
         for object_id in event.ids:
             await self.delete_bounding_box(object_id)
@@ -62,14 +314,42 @@ class Session:
     async def delete_bounding_box(self, object_id, is_error=False):
         if object_id in self.video_frame_consumers:
             consumer = self.video_frame_consumers[object_id]
-            self.video_frame_producer.remove_queue(consumer.input_queue)
-            self.tracking_update_sender.remove_queue(consumer.output_queue)
+            self.tracking_update_sender.remove_tracker(object_id)
             consumer.quit()
+            self.tracker_scheduler.unregister(self.session_id, consumer)
             self.video_frame_consumers.pop(object_id)
+            self.resource_governor.release_box(self.session_id, object_id)
+            await self.store_track(object_id, is_lost=is_error)
             if is_error:
                 answer = dto.TrackingErrorEvent(event_type=EventType.TRACKING_ERROR, message=f"Tracker lost object {object_id}", boundingBoxId=object_id)
                 await self.websocket.send_json(answer.model_dump_json())
 
+    async def track_video(self, event: dto.TrackVideoEvent):
+        """
+        runs outside of the event loop, the updates of the other boxes of this session keep being sent meanwhile.
+        The job only gets as many workers as the resource governor admits
+        """
+        try:
+            self.resource_governor.add_session(self.session_id)
+            worker_count = self.resource_governor.admit_workers(
+                self.session_id, event.request_id, max(1, min(BATCH_TRACKING_WORKERS, len(event.bounding_boxes))))
+        except OutOfResourcesError as e:
+            logger.warning(e)
+            return dto.FailureEvent(event_type=EventType.FAILURE, request_id=event.request_id, message=str(e))
+        try:
+            result = await self.loop.run_in_executor(None, batch_tracking.track_video, event.video_source,
+                                                     event.bounding_boxes, event.tracker, event.tracking_scale,
+                                                     event.grayscale, worker_count)
+        except TrackingError as e:
+            logger.error(e)
+            return dto.FailureEvent(event_type=EventType.FAILURE, request_id=event.request_id, message=str(e))
+        finally:
+            self.resource_governor.release_workers(self.session_id, event.request_id)
+        tracks = [dto.Track(id=track.object_id, positions=track.get_positions().tolist(),
+                            lost_frame_number=track.lost_frame_number) for track in result.tracks.values()]
+        return dto.TrackVideoResultEvent(event_type=EventType.TRACK_VIDEO_RESULT, request_id=event.request_id,
+                                         message="OK.", tracks=tracks, frame_count=result.frame_count, fps=result.fps)
+
     async def consume_websocket_events(self):
         try:
             logger.info(f"Session '{self.session_id}' started consuming events")
@@ -87,20 +367,35 @@ class Session:
     async def __handle_event(self, message: dict):
         answer: dto.AnswerEvent
         if message['event_type'] == dto.EventType.START_CONTROL_LOOP:
-            answer = self.start_control_loop(dto.StartControlLoopEvent.model_validate(message))
+            answer = await self.start_control_loop(dto.StartControlLoopEvent.model_validate(message))
         elif message['event_type'] == dto.EventType.ADD_BOUNDING_BOX:
-            answer = self.add_bounding_box(dto.AddBoundingBoxEvent.model_validate(message))
+            answer = await self.add_bounding_box(dto.AddBoundingBoxEvent.model_validate(message))
+        elif message['event_type'] == dto.EventType.ADD_BOUNDING_BOXES:
+            answer = await self.add_bounding_boxes(dto.AddBoundingBoxesEvent.model_validate(message))
         elif message['event_type'] == dto.EventType.DELETE_BOUNDING_BOX:
             answer = await self.delete_bounding_boxes(dto.DeleteBoundingBoxesEvent.model_validate(message))
+        elif message['event_type'] == dto.EventType.TRACK_VIDEO:
+            answer = await self.track_video(dto.TrackVideoEvent.model_validate(message))
         else:
             raise ValueError(f"Unknown event type '{message['event_type']}'")
         logger.debug(f"Session '{self.session_id}' handled {message['event_type']}")
         return answer
 
-    # callbacks vermischen den Ausführungskontext zwischen den Threads
-    async def on_video_frame_consumer_error(self, event: dto.ThreadingEvent):
+    def on_frame_published(self, frame_number: int):
+        self.frame_decode_times[frame_number % DECODE_TIME_HISTORY] = (frame_number, time.time())
+        self.tracker_scheduler.wake(self.session_id)
+
+    def publish_update(self, tracking_update: TrackingUpdate):
+        """called by the sender thread. Lets clients measure the latency from decoding to receiving the update"""
+        frame_number, decoded_at = self.frame_decode_times[tracking_update.frame_number % DECODE_TIME_HISTORY]
+        if frame_number == tracking_update.frame_number:
+            tracking_update.decoded_at = decoded_at
+        self.tracking_update_publisher.publish(tracking_update)
+
+    def on_video_frame_consumer_error(self, event: dto.ThreadingEvent):
+        """called from a scheduler worker, so the deletion is handed over to the event loop of the websocket"""
         logger.error(event.message)
-        await self.delete_bounding_box(event.source, is_error=True)
+        asyncio.run_coroutine_threadsafe(self.delete_bounding_box(event.source, is_error=True), self.loop)
 
     def on_video_frame_producer_quits(self, event: dto.ThreadingEvent):
         message = f"Session '{self.session_id}': {event.message}"
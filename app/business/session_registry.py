@@ -0,0 +1,225 @@
+"""
+Which sessions are open, for the duplicate check and the session count, and a channel to every process serving
+sessions, for broadcast events. With several uvicorn workers each of them only holds the websockets of its own
+sessions, so the registry has to be shared between them.
+"""
+import asyncio
+import glob
+import logging
+import os
+import socket
+import sqlite3
+import threading
+from abc import ABC, abstractmethod
+from typing import Awaitable, Callable, Optional
+from uuid import UUID
+
+from config.constants import LOG_FORMAT, LOG_LEVEL, SESSION_REGISTRY_BACKEND, SessionRegistryBackend, \
+    SESSION_REGISTRY_DIRECTORY, SESSION_REGISTRY_LOCK_TIMEOUT, SESSION_REGISTRY_MAX_MESSAGE_SIZE
+from models.errors import DuplicateSessionError
+
+logging.basicConfig(format=LOG_FORMAT)
+logger = logging.getLogger(__name__)
+logger.setLevel(LOG_LEVEL)
+
+WORKER_SOCKET_PREFIX = "worker-"
+
+
+def is_process_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # exists, but belongs to someone else
+        return True
+    return True
+
+
+class SessionRegistry(ABC):
+    """
+    Base class of the backends. Messages passed to broadcast() are handed to the broadcast listener of every
+    process, which sends them to the websockets of its sessions. Must be opened from the event loop of the process.
+    register() and unregister() may block and are called by executor threads.
+    """
+    broadcast_listener: Optional[Callable[[str], Awaitable[None]]]
+
+    def __init__(self):
+        self.broadcast_listener = None
+
+    def open(self, broadcast_listener: Callable[[str], Awaitable[None]]):
+        self.broadcast_listener = broadcast_listener
+
+    def close(self):
+        self.broadcast_listener = None
+
+    @abstractmethod
+    def register(self, session_id: UUID):
+        """
+        :raise DuplicateSessionError: if a session with this id is open in any process
+        """
+
+    @abstractmethod
+    def unregister(self, session_id: UUID):
+        pass
+
+    @abstractmethod
+    def get_session_count(self) -> int:
+        pass
+
+    @abstractmethod
+    async def broadcast(self, message: str):
+        pass
+
+
+class InProcessSessionRegistry(SessionRegistry):
+    """For a single worker"""
+    session_ids: set[UUID]
+    lock: threading.Lock
+
+    def __init__(self):
+        super().__init__()
+        self.session_ids = set()
+        self.lock = threading.Lock()
+
+    def register(self, session_id: UUID):
+        with self.lock:
+            if session_id in self.session_ids:
+                raise DuplicateSessionError(f"Session with ID '{session_id}' already exists")
+            self.session_ids.add(session_id)
+
+    def unregister(self, session_id: UUID):
+        with self.lock:
+            self.session_ids.discard(session_id)
+
+    def get_session_count(self) -> int:
+        return len(self.session_ids)
+
+    async def broadcast(self, message: str):
+        if self.broadcast_listener is not None:
+            await self.broadcast_listener(message)
+
+
+class SqliteSessionRegistry(SessionRegistry):
+    """
+    For several workers on one host. The sessions are rows of a SQLite database, owned by the pid of their worker, so
+    that the sessions of a worker which died without closing the registry can be told apart and are removed.
+    Broadcasts are datagrams to a unix socket per worker in the same directory. A datagram is not queued if the socket
+    of a worker is full, so broadcasts are best effort, like the websockets they are sent to.
+    """
+    directory: str
+    pid: int
+    # also used by the metrics route, which runs in a thread of the web server
+    connection: Optional[sqlite3.Connection]
+    lock: threading.Lock
+    socket_path: str
+    socket: Optional[socket.socket]
+    receive_task: Optional[asyncio.Task]
+
+    def __init__(self, directory: str = SESSION_REGISTRY_DIRECTORY):
+        super().__init__()
+        self.directory = directory
+        self.pid = os.getpid()
+        self.connection = None
+        self.lock = threading.Lock()
+        self.socket_path = os.path.join(directory, f"{WORKER_SOCKET_PREFIX}{self.pid}.sock")
+        self.socket = None
+        self.receive_task = None
+
+    def open(self, broadcast_listener: Callable[[str], Awaitable[None]]):
+        super().open(broadcast_listener)
+        os.makedirs(self.directory, exist_ok=True)
+        self.connection = sqlite3.connect(os.path.join(self.directory, "sessions.sqlite"),
+                                          timeout=SESSION_REGISTRY_LOCK_TIMEOUT, isolation_level=None,
+                                          check_same_thread=False)
+        with self.lock:
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS sessions "
+                                    "(session_id TEXT PRIMARY KEY, worker_pid INTEGER NOT NULL)")
+            self.__remove_dead_workers()
+        if os.path.exists(self.socket_path):
+            # left behind by an earlier process with the same pid
+            os.unlink(self.socket_path)
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.socket.bind(self.socket_path)
+        self.socket.setblocking(False)
+        self.receive_task = asyncio.get_running_loop().create_task(self.receive_broadcasts())
+        logger.info(f"Worker {self.pid} joined the session registry in {self.directory}")
+
+    def close(self):
+        super().close()
+        if self.receive_task is not None:
+            self.receive_task.cancel()
+            self.receive_task = None
+        if self.socket is not None:
+            self.socket.close()
+            self.socket = None
+            if os.path.exists(self.socket_path):
+                os.unlink(self.socket_path)
+        with self.lock:
+            if self.connection is not None:
+                self.connection.execute("DELETE FROM sessions WHERE worker_pid = ?", (self.pid,))
+                self.connection.close()
+                self.connection = None
+
+    def __remove_dead_workers(self):
+        """needs the lock"""
+        worker_pids = [row[0] for row in self.connection.execute("SELECT DISTINCT worker_pid FROM sessions")]
+        for worker_pid in worker_pids:
+            if worker_pid != self.pid and not is_process_alive(worker_pid):
+                logger.warning(f"Removing the sessions of worker {worker_pid}, which has exited")
+                self.connection.execute("DELETE FROM sessions WHERE worker_pid = ?", (worker_pid,))
+
+    def register(self, session_id: UUID):
+        with self.lock:
+            try:
+                self.connection.execute("INSERT INTO sessions (session_id, worker_pid) VALUES (?, ?)",
+                                        (str(session_id), self.pid))
+                return
+            except sqlite3.IntegrityError:
+                self.__remove_dead_workers()
+            try:
+                self.connection.execute("INSERT INTO sessions (session_id, worker_pid) VALUES (?, ?)",
+                                        (str(session_id), self.pid))
+            except sqlite3.IntegrityError:
+                raise DuplicateSessionError(f"Session with ID '{session_id}' already exists")
+
+    def unregister(self, session_id: UUID):
+        with self.lock:
+            self.connection.execute("DELETE FROM sessions WHERE session_id = ? AND worker_pid = ?",
+                                    (str(session_id), self.pid))
+
+    def get_session_count(self) -> int:
+        with self.lock:
+            return self.connection.execute("SELECT COUNT(*) FROM sessions").fetchone()[0]
+
+    async def broadcast(self, message: str):
+        data = message.encode()
+        if len(data) > SESSION_REGISTRY_MAX_MESSAGE_SIZE:
+            raise ValueError(f"Broadcast messages are limited to {SESSION_REGISTRY_MAX_MESSAGE_SIZE} bytes")
+        for socket_path in glob.glob(os.path.join(self.directory, f"{WORKER_SOCKET_PREFIX}*.sock")):
+            try:
+                self.socket.sendto(data, socket_path)
+            except (ConnectionRefusedError, FileNotFoundError):
+                # nobody is reading anymore, the worker has exited
+                worker_pid = int(os.path.basename(socket_path)[len(WORKER_SOCKET_PREFIX):-len(".sock")])
+                if not is_process_alive(worker_pid) and os.path.exists(socket_path):
+                    os.unlink(socket_path)
+            except BlockingIOError:
+                logger.warning(f"Broadcast to {socket_path} dropped, the worker is not keeping up")
+
+    async def receive_broadcasts(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            data = await loop.sock_recv(self.socket, SESSION_REGISTRY_MAX_MESSAGE_SIZE)
+            if self.broadcast_listener is not None:
+                try:
+                    await self.broadcast_listener(data.decode())
+                except Exception as e:
+                    logger.error(f"Broadcast could not be delivered: {e}")
+
+
+def create_session_registry(backend: SessionRegistryBackend = SESSION_REGISTRY_BACKEND) -> SessionRegistry:
+    if backend == SessionRegistryBackend.SQLITE:
+        return SqliteSessionRegistry()
+    return InProcessSessionRegistry()
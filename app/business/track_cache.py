@@ -0,0 +1,208 @@
+import hashlib
+import logging
+import os
+import threading
+from collections import OrderedDict
+from typing import Optional, Callable
+
+import numpy as np
+
+from business.frame_ring_buffer import FrameVariant
+from business.tracked_boxes import TrackedBox
+from config.constants import LOG_FORMAT, LOG_LEVEL, TRACK_CACHE_DIRECTORY, TRACK_CACHE_MAX_BYTES, \
+    TRACK_CACHE_BOX_GRID_SIZE
+from models.dto import BoundingBox, TrackerType
+
+logging.basicConfig(format=LOG_FORMAT)
+logger = logging.getLogger(__name__)
+logger.setLevel(LOG_LEVEL)
+
+VIDEO_HASH_CHUNK_SIZE = 1 << 20
+
+
+class Track:
+    """
+    The positions of one box in consecutive frames, one (frame_number, x, y, width, height) row each.
+    The first row is the box it was initialized with
+    """
+    object_id: int
+    positions: np.ndarray
+    position_count: int
+    # the frame the tracker lost the object on, None if it was tracked until the end
+    lost_frame_number: Optional[int]
+
+    def __init__(self, object_id: int, expected_frame_count: int):
+        self.object_id = object_id
+        self.positions = np.empty((max(1, expected_frame_count), 5), dtype=np.int32)
+        self.position_count = 0
+        self.lost_frame_number = None
+
+    def append(self, bounding_box: TrackedBox | BoundingBox):
+        if self.position_count == len(self.positions):
+            # the frame count of the container was wrong
+            self.positions = np.resize(self.positions, (2 * len(self.positions), 5))
+        self.positions[self.position_count] = (bounding_box.frame_number, bounding_box.x, bounding_box.y,
+                                               bounding_box.width, bounding_box.height)
+        self.position_count += 1
+
+    def get_positions(self) -> np.ndarray:
+        return self.positions[:self.position_count]
+
+    def get_last_frame_number(self) -> Optional[int]:
+        return int(self.positions[self.position_count - 1, 0]) if self.position_count else None
+
+
+class TrackRecorder:
+    """Records the boxes of a live tracker on their way to the session, so that the track can be cached once complete"""
+    key: str
+    track: Track
+    forward: Callable[[TrackedBox], None]
+    # a frame was skipped, so the track cannot be replayed
+    has_gap: bool
+
+    def __init__(self, key: str, initial_bounding_box: BoundingBox, start_frame_number: int,
+                 forward: Callable[[TrackedBox], None]):
+        self.key = key
+        self.track = Track(initial_bounding_box.id, 0)
+        self.track.append(initial_bounding_box.model_copy(update={'frame_number': start_frame_number}))
+        self.forward = forward
+        self.has_gap = False
+
+    def submit(self, bounding_box: TrackedBox):
+        if bounding_box.frame_number != self.track.get_last_frame_number() + 1:
+            self.has_gap = True
+        if not self.has_gap:
+            self.track.append(bounding_box)
+        self.forward(bounding_box)
+
+
+class TrackCache:
+    """
+    Tracks of finished trackers on disk, so that a box which is drawn again on the same video replays the stored
+    positions instead of being tracked again. Only complete tracks are stored: up to the end of the video or up to the
+    frame before the tracker lost the object, so a replayed track that ends early means the object was lost.
+    Tracks are .npy files which are memory mapped when replayed. The least recently used ones are deleted when the
+    cache grows beyond max_bytes.
+    """
+    directory: str
+    max_bytes: int
+    # file name and size, least recently used first
+    entries: OrderedDict[str, int]
+    # content hashes of video files by path, size and modification time
+    video_hashes: dict[tuple[str, int, int], str]
+    lock: threading.Lock
+
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+        file_names = [file_name for file_name in os.listdir(directory) if file_name.endswith('.npy')]
+        file_names.sort(key=lambda file_name: os.path.getmtime(os.path.join(directory, file_name)))
+        self.entries = OrderedDict((file_name, os.path.getsize(os.path.join(directory, file_name)))
+                                   for file_name in file_names)
+        self.video_hashes = {}
+        self.lock = threading.Lock()
+        logger.info(f"Track cache in {directory} holds {len(self.entries)} tracks")
+
+    def hash_video(self, video_source: str) -> Optional[str]:
+        """
+        hash the content of a video file, so that renamed or copied videos share their tracks. Can take a while
+        for large videos, but is only done once per file
+        :return: the hash or None for sources which are no files, like streams
+        """
+        if not os.path.isfile(video_source):
+            return None
+        status = os.stat(video_source)
+        file_key = (os.path.realpath(video_source), status.st_size, status.st_mtime_ns)
+        with self.lock:
+            video_hash = self.video_hashes.get(file_key)
+        if video_hash is None:
+            sha256 = hashlib.sha256()
+            with open(video_source, 'rb') as video_file:
+                while chunk := video_file.read(VIDEO_HASH_CHUNK_SIZE):
+                    sha256.update(chunk)
+            video_hash = sha256.hexdigest()
+            with self.lock:
+                self.video_hashes[file_key] = video_hash
+        return video_hash
+
+    @staticmethod
+    def make_key(video_hash: str, initial_bounding_box: BoundingBox, start_frame_number: int,
+                 tracker_type: TrackerType, frame_variant: FrameVariant) -> str:
+        """
+        boxes whose position and size fall into the same cells of a TRACK_CACHE_BOX_GRID_SIZE pixel grid share a key.
+        Boxes on either side of a cell border do not, even if they differ by a single pixel
+        """
+        box = [value // TRACK_CACHE_BOX_GRID_SIZE for value in (initial_bounding_box.x, initial_bounding_box.y,
+                                                                initial_bounding_box.width, initial_bounding_box.height)]
+        description = (f"{video_hash}:{box}:{start_frame_number}:{tracker_type.value}:"
+                       f"{frame_variant.scale}:{frame_variant.grayscale}")
+        return hashlib.sha256(description.encode()).hexdigest()
+
+    def __path(self, file_name: str) -> str:
+        return os.path.join(self.directory, file_name)
+
+    def get(self, key: str) -> Optional[np.ndarray]:
+        """:return: the memory mapped positions of the track, see Track"""
+        file_name = f"{key}.npy"
+        with self.lock:
+            if file_name not in self.entries:
+                return None
+            self.entries.move_to_end(file_name)
+        try:
+            positions = np.load(self.__path(file_name), mmap_mode='r')
+            os.utime(self.__path(file_name))
+        except (OSError, ValueError) as e:
+            logger.warning(f"Dropping unreadable track {file_name}: {e}")
+            self.__remove(file_name)
+            return None
+        return positions
+
+    def put(self, key: str, track: Track):
+        file_name = f"{key}.npy"
+        temporary_path = self.__path(f"{key}.tmp.npy")
+        try:
+            np.save(temporary_path, track.get_positions())
+            os.replace(temporary_path, self.__path(file_name))
+        except OSError as e:
+            logger.warning(f"Could not store track {file_name}: {e}")
+            return
+        with self.lock:
+            self.entries[file_name] = os.path.getsize(self.__path(file_name))
+            self.entries.move_to_end(file_name)
+            evicted_file_names = []
+            total_bytes = sum(self.entries.values())
+            while total_bytes > self.max_bytes and len(self.entries) > 1:
+                evicted_file_name, size = self.entries.popitem(last=False)
+                evicted_file_names.append(evicted_file_name)
+                total_bytes -= size
+        for evicted_file_name in evicted_file_names:
+            self.__remove(evicted_file_name)
+        logger.debug(f"Stored track of box {track.object_id} with {track.position_count} positions")
+
+    def __remove(self, file_name: str):
+        with self.lock:
+            self.entries.pop(file_name, None)
+        try:
+            # replays which still map the file keep their data
+            os.remove(self.__path(file_name))
+        except OSError:
+            pass
+
+
+__track_cache: Optional[TrackCache] = None
+__track_cache_lock = threading.Lock()
+__track_cache_failed = False
+
+
+def get_track_cache() -> Optional[TrackCache]:
+    """:return: the process wide track cache or None if it is disabled or its directory cannot be used"""
+    global __track_cache, __track_cache_failed
+    with __track_cache_lock:
+        if __track_cache is None and TRACK_CACHE_DIRECTORY is not None and not __track_cache_failed:
+            try:
+                __track_cache = TrackCache(TRACK_CACHE_DIRECTORY, TRACK_CACHE_MAX_BYTES)
+            except OSError as e:
+                logger.warning(f"Track cache disabled: {e}")
+                __track_cache_failed = True
+        return __track_cache
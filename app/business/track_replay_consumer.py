@@ -0,0 +1,78 @@
+import logging
+from typing import Callable
+
+import numpy as np
+
+from business.frame_ring_buffer import FrameReader
+from business.tracked_boxes import TrackedBox
+from config.constants import LOG_LEVEL, LOG_FORMAT
+from models.dto import BoundingBox, ThreadingEvent
+
+logging.basicConfig(format=LOG_FORMAT)
+logger = logging.getLogger(__name__)
+logger.setLevel(LOG_LEVEL)
+
+
+class TrackReplayConsumer:
+    """
+    Replays a track from the TrackCache instead of tracking the object again. It reads the frames of the producer
+    only to stay in step with the video and the other boxes of the session, and is scheduled like a VideoFrameConsumer.
+    """
+    object_id: int
+    frame_reader: FrameReader
+    # see Track, the first row is the initial box of the cached track
+    positions: np.ndarray
+    start_frame_number: int
+    # difference between the initial box drawn now and the one the track was cached for
+    offset: np.ndarray
+    output_callback: Callable[[TrackedBox], None]
+    has_failed: bool
+    error_callback: Callable
+
+    def __init__(self, object_id: int, frame_reader: FrameReader, positions: np.ndarray,
+                 initial_bounding_box: BoundingBox, output_callback: Callable[[TrackedBox], None],
+                 on_error_callback: Callable):
+        self.object_id = object_id
+        self.frame_reader = frame_reader
+        self.positions = positions
+        self.start_frame_number = int(positions[0, 0])
+        self.offset = np.array((initial_bounding_box.x, initial_bounding_box.y, initial_bounding_box.width,
+                                initial_bounding_box.height)) - positions[0, 1:]
+        self.output_callback = output_callback
+        self.has_failed = False
+        self.error_callback = on_error_callback
+        logger.debug(f"Replaying {len(positions)} cached positions for {object_id}")
+
+    def on_error(self, message: str):
+        logger.error(message)
+        self.has_failed = True
+        self.error_callback(ThreadingEvent(self.object_id, message))
+
+    def quit(self):
+        self.frame_reader.close()
+
+    def close(self):
+        # the memory map is closed when positions is garbage collected
+        logger.debug(f"Track replay {self.object_id} exited")
+
+    def step(self) -> bool:
+        """
+        pass the cached box of the next frame to the output_callback
+        :return: whether there may be another frame to process
+        """
+        if self.has_failed:
+            return False
+        frame = self.frame_reader.poll()
+        if frame is None:
+            return False
+        frame_number = frame.frame_number
+        self.frame_reader.release()
+        index = frame_number - self.start_frame_number
+        if index >= len(self.positions):
+            # tracks are only cached up to the end of the video or the frame before the object was lost
+            self.on_error("Tracking failed")
+            return False
+        if index >= 0:
+            x, y, width, height = (int(value) for value in self.positions[index, 1:] + self.offset)
+            self.output_callback(TrackedBox(self.object_id, frame_number, x, y, width, height))
+        return True
@@ -0,0 +1,35 @@
+"""
+The representation of boxes and tracking updates inside the pipeline, from the trackers through the sender to the
+publisher. Boxes are created for every tracked box on every frame, so they are plain tuples instead of pydantic
+models. They are converted to the wire format in one go when an update is sent to the client, see wire_format.
+"""
+from typing import NamedTuple, Optional
+
+
+class TrackedBox(NamedTuple):
+    """A box in source coordinates, the fields in the order of dto.BoundingBox"""
+    id: int
+    frame_number: int
+    x: int
+    y: int
+    width: int
+    height: int
+    # the latest known position of a tracker which has not caught up with the frame yet
+    stale: bool = False
+
+
+class TrackingUpdate:
+    """The boxes of all trackers of a session for one frame, see dto.UpdateTrackingEvent"""
+    __slots__ = ("frame_number", "bounding_boxes", "dropped_frames", "decoded_at")
+    frame_number: int
+    bounding_boxes: list[TrackedBox]
+    # frames since the previous update which the client did not get an update for
+    dropped_frames: int
+    # unix time the frame was decoded at, if it is still known
+    decoded_at: Optional[float]
+
+    def __init__(self, frame_number: int, bounding_boxes: list[TrackedBox]):
+        self.frame_number = frame_number
+        self.bounding_boxes = bounding_boxes
+        self.dropped_frames = 0
+        self.decoded_at = None
@@ -0,0 +1,214 @@
+import itertools
+import logging
+import multiprocessing
+import threading
+from concurrent.futures import Future
+from multiprocessing import shared_memory
+from typing import Optional, Sequence
+
+import cv2
+import numpy as np
+
+from business.frame_ring_buffer import Frame
+from business.tracker_registry import create_opencv_tracker, init_opencv_tracker
+from config.constants import LOG_FORMAT, LOG_LEVEL, TRACKER_PROCESS_COUNT, TRACKER_PROCESS_TIMEOUT
+from models.dto import TrackerType
+from models.errors import TrackingError
+
+logging.basicConfig(format=LOG_FORMAT)
+logger = logging.getLogger(__name__)
+logger.setLevel(LOG_LEVEL)
+
+INIT = "init"
+UPDATE = "update"
+DELETE = "delete"
+
+
+class SharedFrameCache:
+    """Worker side: attach to the shared memory blocks of the frame ring buffers only once"""
+    shared_memories: dict[str, shared_memory.SharedMemory]
+    users: dict[str, set[int]]
+
+    def __init__(self):
+        self.shared_memories = {}
+        self.users = {}
+
+    def get_image(self, tracker_id: int, shared_reference: tuple[str, int, tuple, str]) -> np.ndarray:
+        name, offset, shape, dtype = shared_reference
+        if name not in self.shared_memories:
+            self.shared_memories[name] = shared_memory.SharedMemory(name=name)
+            self.users[name] = set()
+        self.users[name].add(tracker_id)
+        return np.ndarray(shape, dtype=np.dtype(dtype), buffer=self.shared_memories[name].buf, offset=offset)
+
+    def remove_user(self, tracker_id: int):
+        for name, tracker_ids in list(self.users.items()):
+            tracker_ids.discard(tracker_id)
+            if not tracker_ids:
+                self.users.pop(name)
+                try:
+                    self.shared_memories.pop(name).close()
+                except BufferError:
+                    # an image of this block is still referenced, it is unmapped when that is garbage collected
+                    pass
+
+
+def run_tracker_worker(request_queue: multiprocessing.Queue, result_queue: multiprocessing.Queue):
+    """
+    Main loop of a worker process. Owns the trackers pinned to it and only sends box coordinates back.
+    :param request_queue: (command, request_id, tracker_id, payload) tuples, None to exit
+    :param result_queue: (request_id, (success, bounding_box), error) tuples
+    """
+    trackers: dict[int, cv2.Tracker] = {}
+    shared_frame_cache = SharedFrameCache()
+    while True:
+        request = request_queue.get()
+        if request is None:
+            break
+        command, request_id, tracker_id, payload = request
+        try:
+            if command == INIT:
+                tracker_type, shared_reference, bounding_box = payload
+                tracker = create_opencv_tracker(tracker_type)
+                success = init_opencv_tracker(tracker, shared_frame_cache.get_image(tracker_id, shared_reference),
+                                              bounding_box)
+                trackers[tracker_id] = tracker
+                result = (success, bounding_box)
+            elif command == UPDATE:
+                result = trackers[tracker_id].update(shared_frame_cache.get_image(tracker_id, payload))
+            elif command == DELETE:
+                trackers.pop(tracker_id, None)
+                shared_frame_cache.remove_user(tracker_id)
+                continue
+            else:
+                raise ValueError(f"Unknown tracker worker command '{command}'")
+            result_queue.put((request_id, result, None))
+        except Exception as e:
+            result_queue.put((request_id, None, f"{type(e).__name__}: {e}"))
+
+
+class PooledTracker:
+    """Proxy for a tracker living in one worker process. The tracker stays pinned to that worker for its lifetime"""
+    tracker_process_pool: 'TrackerProcessPool'
+    tracker_type: TrackerType
+    worker_index: int
+    tracker_id: int
+
+    def __init__(self, tracker_process_pool: 'TrackerProcessPool', tracker_type: TrackerType, worker_index: int,
+                 tracker_id: int):
+        self.tracker_process_pool = tracker_process_pool
+        self.tracker_type = tracker_type
+        self.worker_index = worker_index
+        self.tracker_id = tracker_id
+
+    def init(self, frame: Frame, bounding_box: tuple):
+        success, _ = self.tracker_process_pool.call(self, INIT,
+                                                    (self.tracker_type, frame.get_shared_reference(), bounding_box))
+        if not success:
+            raise TrackingError(f"{self.tracker_type.value} tracker could not be initialized")
+
+    def update(self, frame: Frame) -> tuple[bool, Sequence[int]]:
+        return self.tracker_process_pool.call(self, UPDATE, frame.get_shared_reference())
+
+    def close(self):
+        self.tracker_process_pool.remove_tracker(self)
+
+
+class TrackerProcessPool:
+    """Fixed set of worker processes running the trackers of all sessions"""
+    processes: list[multiprocessing.Process]
+    request_queues: list[multiprocessing.Queue]
+    result_queue: multiprocessing.Queue
+    tracker_counts: list[int]
+    pending_results: dict[int, Future]
+    ids: itertools.count
+    lock: threading.Lock
+    result_thread: threading.Thread
+
+    def __init__(self, process_count: int):
+        # fork would copy the locks held by the threads of this process
+        context = multiprocessing.get_context("spawn")
+        self.request_queues = [context.Queue() for _ in range(process_count)]
+        self.result_queue = context.Queue()
+        self.processes = [context.Process(target=run_tracker_worker, args=(request_queue, self.result_queue),
+                                          name=f"tracker-worker-{index}", daemon=True)
+                          for index, request_queue in enumerate(self.request_queues)]
+        self.tracker_counts = [0] * process_count
+        self.pending_results = {}
+        self.ids = itertools.count()
+        self.lock = threading.Lock()
+        self.result_thread = threading.Thread(target=self.receive_results, daemon=True)
+        for process in self.processes:
+            process.start()
+        self.result_thread.start()
+        logger.info(f"Started {process_count} tracker worker processes")
+
+    def create_tracker(self, tracker_type: TrackerType) -> PooledTracker:
+        with self.lock:
+            worker_index = self.tracker_counts.index(min(self.tracker_counts))
+            self.tracker_counts[worker_index] += 1
+            return PooledTracker(self, tracker_type, worker_index, next(self.ids))
+
+    def remove_tracker(self, tracker: PooledTracker):
+        with self.lock:
+            self.tracker_counts[tracker.worker_index] -= 1
+        self.request_queues[tracker.worker_index].put((DELETE, None, tracker.tracker_id, None))
+
+    def call(self, tracker: PooledTracker, command: str, payload):
+        """send a command to the worker of the tracker and wait for its result"""
+        future = Future()
+        with self.lock:
+            request_id = next(self.ids)
+            self.pending_results[request_id] = future
+        self.request_queues[tracker.worker_index].put((command, request_id, tracker.tracker_id, payload))
+        try:
+            return future.result(timeout=TRACKER_PROCESS_TIMEOUT)
+        except TimeoutError:
+            raise TrackingError(f"Tracker worker {tracker.worker_index} did not answer")
+        finally:
+            with self.lock:
+                self.pending_results.pop(request_id, None)
+
+    def receive_results(self):
+        while True:
+            message = self.result_queue.get()
+            if message is None:
+                break
+            request_id, result, error = message
+            with self.lock:
+                future = self.pending_results.get(request_id)
+            if future is None:
+                continue
+            if error is None:
+                future.set_result(result)
+            else:
+                future.set_exception(TrackingError(error))
+
+    def shutdown(self):
+        for request_queue in self.request_queues:
+            request_queue.put(None)
+        self.result_queue.put(None)
+        for process in self.processes:
+            process.join(TRACKER_PROCESS_TIMEOUT)
+        logger.info("Tracker worker processes stopped")
+
+
+__tracker_process_pool: Optional[TrackerProcessPool] = None
+__tracker_process_pool_lock = threading.Lock()
+
+
+def get_tracker_process_pool() -> TrackerProcessPool:
+    """the pool is process wide and only started when the first tracker needs it"""
+    global __tracker_process_pool
+    with __tracker_process_pool_lock:
+        if __tracker_process_pool is None:
+            __tracker_process_pool = TrackerProcessPool(TRACKER_PROCESS_COUNT)
+        return __tracker_process_pool
+
+
+def shutdown_tracker_process_pool():
+    global __tracker_process_pool
+    with __tracker_process_pool_lock:
+        if __tracker_process_pool is not None:
+            __tracker_process_pool.shutdown()
+            __tracker_process_pool = None
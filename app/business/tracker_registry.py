@@ -0,0 +1,41 @@
+from typing import Callable
+
+import cv2
+
+from models.dto import TrackerType
+
+# ordered from most accurate and expensive to cheapest
+TRACKER_FACTORIES: dict[TrackerType, Callable[[], cv2.Tracker]] = {
+    TrackerType.CSRT: cv2.TrackerCSRT.create,
+    TrackerType.KCF: cv2.TrackerKCF.create,
+    TrackerType.MIL: cv2.TrackerMIL.create,
+    TrackerType.BOOSTING: cv2.legacy.TrackerBoosting_create,
+    TrackerType.MEDIANFLOW: cv2.legacy.TrackerMedianFlow_create,
+    TrackerType.MOSSE: cv2.legacy.TrackerMOSSE_create,
+}
+
+# the trackers an "auto" box steps down through when updates take longer than TRACKER_UPDATE_BUDGET
+AUTO_TRACKER_FALLBACK_ORDER: list[TrackerType] = [TrackerType.CSRT, TrackerType.KCF, TrackerType.MOSSE]
+
+
+# estimated seconds one update takes on one core: a fixed part and a part per megapixel of the box in the tracked frame,
+# because the trackers search a window around the object. Used to admit boxes against TRACKER_CPU_BUDGET
+TRACKER_COST_ESTIMATES: dict[TrackerType, tuple[float, float]] = {
+    TrackerType.CSRT: (0.004, 0.2),
+    TrackerType.KCF: (0.001, 0.05),
+    TrackerType.MIL: (0.01, 0.5),
+    TrackerType.BOOSTING: (0.01, 0.5),
+    TrackerType.MEDIANFLOW: (0.002, 0.02),
+    TrackerType.MOSSE: (0.0005, 0.005),
+    # starts with the first tracker of AUTO_TRACKER_FALLBACK_ORDER
+    TrackerType.AUTO: (0.004, 0.2),
+}
+
+
+def create_opencv_tracker(tracker_type: TrackerType) -> cv2.Tracker:
+    return TRACKER_FACTORIES[tracker_type]()
+
+
+def init_opencv_tracker(tracker: cv2.Tracker, img, bounding_box: tuple) -> bool:
+    """the legacy trackers report failure through their return value, the others return None or raise"""
+    return tracker.init(img, bounding_box) is not False
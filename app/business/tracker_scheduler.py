@@ -0,0 +1,153 @@
+import logging
+import threading
+from collections import OrderedDict, deque
+from typing import Optional, Hashable
+
+from business import profiler
+from business.metrics import TRACKER_TASKS_READY
+from config.constants import LOG_FORMAT, LOG_LEVEL, TRACKER_SCHEDULER_WORKERS
+
+logging.basicConfig(format=LOG_FORMAT)
+logger = logging.getLogger(__name__)
+logger.setLevel(LOG_LEVEL)
+
+IDLE = "idle"
+READY = "ready"
+RUNNING = "running"
+# woken up while running, so there may be a new frame the running step has not seen
+RUNNING_AND_WOKEN = "running-and-woken"
+
+
+class TrackerScheduler:
+    """
+    Process wide, fixed pool of worker threads which runs the tracker updates of all sessions.
+    A task is any object with step() -> bool, which processes at most one frame and returns whether there may be more
+    work, and close(), which is called once the task has been removed and is not running anymore.
+    A task never runs on two workers at once. Ready tasks are queued per session and the sessions are served round robin,
+    so a session with many boxes cannot starve the others.
+    """
+    workers: list[threading.Thread]
+    condition: threading.Condition
+    ready_tasks: OrderedDict[Hashable, deque]
+    task_states: dict[object, str]
+    session_tasks: dict[Hashable, set]
+    is_shut_down: bool
+
+    def __init__(self, worker_count: int):
+        self.condition = threading.Condition()
+        self.ready_tasks = OrderedDict()
+        self.task_states = {}
+        self.session_tasks = {}
+        self.is_shut_down = False
+        self.workers = [threading.Thread(target=self.run_worker, name=f"tracker-scheduler-{index}", daemon=True)
+                        for index in range(worker_count)]
+        for worker in self.workers:
+            worker.start()
+        TRACKER_TASKS_READY.set_callback(self.get_ready_task_count)
+        logger.info(f"Started {worker_count} tracker scheduler workers")
+
+    def register(self, session_id: Hashable, task):
+        """add a task and run it as soon as a worker is free"""
+        with self.condition:
+            self.session_tasks.setdefault(session_id, set()).add(task)
+            self.task_states[task] = IDLE
+            self.__make_ready(session_id, task)
+
+    def unregister(self, session_id: Hashable, task):
+        """remove a task. It is closed right away or, if it is running, as soon as its current step is done"""
+        with self.condition:
+            tasks = self.session_tasks.get(session_id, set())
+            tasks.discard(task)
+            if not tasks:
+                self.session_tasks.pop(session_id, None)
+            state = self.task_states.pop(task, None)
+            if state == READY:
+                self.ready_tasks[session_id].remove(task)
+                if not self.ready_tasks[session_id]:
+                    self.ready_tasks.pop(session_id)
+        if state in (IDLE, READY):
+            task.close()
+
+    def wake(self, session_id: Hashable):
+        """there is new work, e.g. a new frame, for all tasks of a session"""
+        with self.condition:
+            for task in self.session_tasks.get(session_id, ()):
+                self.__make_ready(session_id, task)
+
+    def get_ready_task_count(self) -> int:
+        with self.condition:
+            return sum(len(tasks) for tasks in self.ready_tasks.values())
+
+    def __make_ready(self, session_id: Hashable, task):
+        state = self.task_states[task]
+        if state == IDLE:
+            self.task_states[task] = READY
+            self.ready_tasks.setdefault(session_id, deque()).append(task)
+            self.condition.notify()
+        elif state == RUNNING:
+            self.task_states[task] = RUNNING_AND_WOKEN
+
+    def __next_task(self) -> Optional[tuple[Hashable, object]]:
+        self.condition.wait_for(lambda: self.ready_tasks or self.is_shut_down)
+        if self.is_shut_down:
+            return None
+        session_id, tasks = next(iter(self.ready_tasks.items()))
+        task = tasks.popleft()
+        if tasks:
+            self.ready_tasks.move_to_end(session_id)
+        else:
+            self.ready_tasks.pop(session_id)
+        self.task_states[task] = RUNNING
+        return session_id, task
+
+    def run_worker(self):
+        while True:
+            with self.condition:
+                next_task = self.__next_task()
+            if next_task is None:
+                return
+            session_id, task = next_task
+            has_more_work = False
+            profiler.mark_thread(session_id)
+            try:
+                has_more_work = task.step()
+            except Exception as e:
+                logger.exception(f"Tracker scheduler task failed: {e}")
+            finally:
+                profiler.unmark_thread()
+            with self.condition:
+                state = self.task_states.get(task)
+                if state is not None:
+                    self.task_states[task] = IDLE
+                    if has_more_work or state == RUNNING_AND_WOKEN:
+                        self.__make_ready(session_id, task)
+            if state is None:
+                # unregistered while it was running
+                task.close()
+
+    def shutdown(self):
+        TRACKER_TASKS_READY.set_callback(None)
+        with self.condition:
+            self.is_shut_down = True
+            self.condition.notify_all()
+
+
+__tracker_scheduler: Optional[TrackerScheduler] = None
+__tracker_scheduler_lock = threading.Lock()
+
+
+def get_tracker_scheduler() -> TrackerScheduler:
+    """the scheduler is process wide and only started when the first session needs it"""
+    global __tracker_scheduler
+    with __tracker_scheduler_lock:
+        if __tracker_scheduler is None:
+            __tracker_scheduler = TrackerScheduler(TRACKER_SCHEDULER_WORKERS)
+        return __tracker_scheduler
+
+
+def shutdown_tracker_scheduler():
+    global __tracker_scheduler
+    with __tracker_scheduler_lock:
+        if __tracker_scheduler is not None:
+            __tracker_scheduler.shutdown()
+            __tracker_scheduler = None
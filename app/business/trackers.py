@@ -0,0 +1,249 @@
+import logging
+import math
+import time
+from typing import Sequence, Literal, Optional
+
+import cv2
+
+from business import tracker_process_pool
+from business.frame_ring_buffer import Frame, FrameVariant
+from business.motion import CentreKalmanFilter
+from business.tracker_process_pool import PooledTracker
+from business.tracker_registry import create_opencv_tracker, init_opencv_tracker, AUTO_TRACKER_FALLBACK_ORDER
+from config.constants import LOG_FORMAT, LOG_LEVEL, TRACKER_EXECUTION_MODE, TrackerExecutionMode, \
+    AUTO_TRACKING_SCALES, AUTO_TRACKING_MIN_OBJECT_SIZE, TRACKER_UPDATE_BUDGET, TRACKER_UPDATE_BUDGET_MIN_FRAMES, \
+    ROI_CROPPING, ROI_MARGIN, ROI_MAX_FRAME_SHARE, ROI_MAX_INNOVATION, ROI_STABLE_FRAMES
+from models.dto import TrackerType
+from models.errors import TrackingError
+
+logging.basicConfig(format=LOG_FORMAT)
+logger = logging.getLogger(__name__)
+logger.setLevel(LOG_LEVEL)
+
+
+class LocalTracker:
+    """Runs the tracker in the calling thread"""
+    tracker_type: TrackerType
+    tracker: cv2.Tracker
+
+    def __init__(self, tracker_type: TrackerType):
+        self.tracker_type = tracker_type
+        self.tracker = create_opencv_tracker(tracker_type)
+
+    def init(self, frame: Frame, bounding_box: tuple):
+        try:
+            success = init_opencv_tracker(self.tracker, frame.img, bounding_box)
+        except cv2.error as e:
+            # e.g. a box outside of the frame. Worker processes report the same as TrackingError
+            raise TrackingError(f"{self.tracker_type.value} tracker could not be initialized: {e}")
+        if not success:
+            raise TrackingError(f"{self.tracker_type.value} tracker could not be initialized")
+
+    def update(self, frame: Frame) -> tuple[bool, Sequence[int]]:
+        return self.tracker.update(frame.img)
+
+    def close(self):
+        pass
+
+
+def create_backend_tracker(tracker_type: TrackerType) -> LocalTracker | PooledTracker:
+    """create a tracker for the configured TRACKER_EXECUTION_MODE. Both kinds take frames of a FrameRingBuffer"""
+    if TRACKER_EXECUTION_MODE == TrackerExecutionMode.PROCESS:
+        return tracker_process_pool.get_tracker_process_pool().create_tracker(tracker_type)
+    return LocalTracker(tracker_type)
+
+
+class AdaptiveTracker:
+    """
+    Tracker for TrackerType.AUTO. Starts with the most accurate tracker of AUTO_TRACKER_FALLBACK_ORDER and measures how
+    long its updates take. If the moving average exceeds TRACKER_UPDATE_BUDGET, the next cheaper tracker is initialized
+    on the current frame with the box just found and replaces it.
+    """
+    fallback_order: list[TrackerType]
+    tracker: LocalTracker | PooledTracker
+    average_update_time: float
+    measured_update_count: int
+
+    def __init__(self, fallback_order: Optional[list[TrackerType]] = None):
+        self.fallback_order = list(fallback_order or AUTO_TRACKER_FALLBACK_ORDER)
+        self.tracker = create_backend_tracker(self.fallback_order.pop(0))
+        self.average_update_time = 0.0
+        self.measured_update_count = 0
+
+    @property
+    def tracker_type(self) -> TrackerType:
+        return self.tracker.tracker_type
+
+    def init(self, frame: Frame, bounding_box: tuple):
+        self.tracker.init(frame, bounding_box)
+
+    def update(self, frame: Frame) -> tuple[bool, Sequence[int]]:
+        start = time.perf_counter()
+        success, bounding_box = self.tracker.update(frame)
+        update_time = time.perf_counter() - start
+        self.measured_update_count += 1
+        if self.measured_update_count == 1:
+            self.average_update_time = update_time
+        else:
+            self.average_update_time += 0.1 * (update_time - self.average_update_time)
+        if (success and self.fallback_order and self.measured_update_count >= TRACKER_UPDATE_BUDGET_MIN_FRAMES
+                and self.average_update_time > TRACKER_UPDATE_BUDGET):
+            self.__fall_back(frame, tuple(round(value) for value in bounding_box))
+        return success, bounding_box
+
+    def __fall_back(self, frame: Frame, bounding_box: tuple):
+        tracker = create_backend_tracker(self.fallback_order.pop(0))
+        try:
+            tracker.init(frame, bounding_box)
+        except Exception as e:
+            # keep the slow tracker rather than losing the object
+            tracker.close()
+            logger.warning(f"Could not fall back to {tracker.tracker_type.value} tracker: {e}")
+            return
+        logger.info(f"{self.tracker.tracker_type.value} tracker took {self.average_update_time * 1000:.1f} ms per "
+                    f"frame, falling back to {tracker.tracker_type.value}")
+        self.tracker.close()
+        self.tracker = tracker
+        self.average_update_time = 0.0
+        self.measured_update_count = 0
+
+    def close(self):
+        self.tracker.close()
+
+
+class CroppingTracker:
+    """
+    Runs a tracker on a fixed region of interest around the object instead of the whole frame, which saves copying and
+    searching the frame for small objects in large frames. The region reaches ROI_MARGIN box sizes beyond the box.
+    OpenCV trackers keep their state in the coordinates of the image they were initialized on and some cannot take
+    images of another size, so the region does not follow the object on every frame. Instead, as soon as the box
+    comes close to its border, a new tracker is initialized on the same frame, on a region centred where a Kalman
+    filter expects the object to go.
+    When the tracked centre jumps further from the predicted one than ROI_MAX_INNOVATION box sizes, the object may be
+    about to leave any region, so the whole frame is searched until the motion has been predictable for
+    ROI_STABLE_FRAMES frames. Only for trackers which take any image, not for the worker processes.
+    """
+    tracker_type: TrackerType
+    tracker: LocalTracker | AdaptiveTracker
+    kalman_filter: CentreKalmanFilter
+    # left, top, right and bottom of the region in frame coordinates, None while the whole frame is searched
+    region: Optional[tuple[int, int, int, int]]
+    stable_frame_count: int
+
+    def __init__(self, tracker_type: TrackerType):
+        self.tracker_type = tracker_type
+        self.tracker = AdaptiveTracker() if tracker_type == TrackerType.AUTO else LocalTracker(tracker_type)
+        self.kalman_filter = CentreKalmanFilter()
+        self.region = None
+        self.stable_frame_count = 0
+
+    def __create_tracker(self) -> LocalTracker | AdaptiveTracker:
+        """a tracker to replace the current one with"""
+        if self.tracker_type != TrackerType.AUTO:
+            return LocalTracker(self.tracker_type)
+        # continue with the tracker the adaptive tracker has fallen back to
+        fallback_index = AUTO_TRACKER_FALLBACK_ORDER.index(self.tracker.tracker_type)
+        return AdaptiveTracker(AUTO_TRACKER_FALLBACK_ORDER[fallback_index:])
+
+    def __choose_region(self, frame: Frame, bounding_box: tuple) -> Optional[tuple[int, int, int, int]]:
+        frame_height, frame_width = frame.img.shape[:2]
+        x, y, width, height = bounding_box
+        margin_x, margin_y = ROI_MARGIN * width, ROI_MARGIN * height
+        # lead the object, but not so far that it is not in the region anymore
+        velocity_x, velocity_y = self.kalman_filter.state[2:] * ROI_STABLE_FRAMES
+        x += max(-margin_x / 2, min(margin_x / 2, velocity_x))
+        y += max(-margin_y / 2, min(margin_y / 2, velocity_y))
+        region = (max(0, math.floor(x - margin_x)), max(0, math.floor(y - margin_y)),
+                  min(frame_width, math.ceil(x + width + margin_x)), min(frame_height, math.ceil(y + height + margin_y)))
+        if (region[2] - region[0]) * (region[3] - region[1]) > ROI_MAX_FRAME_SHARE * frame_width * frame_height:
+            return None
+        return region
+
+    def __crop(self, frame: Frame, region: Optional[tuple[int, int, int, int]]) -> Frame:
+        if region is None:
+            return frame
+        left, top, right, bottom = region
+        return Frame(frame.frame_number, frame.img[top:bottom, left:right], frame.slot_index, None, frame.scale)
+
+    def __is_near_border(self, frame: Frame, bounding_box: Sequence[float]) -> bool:
+        frame_height, frame_width = frame.img.shape[:2]
+        left, top, right, bottom = self.region
+        x, y, width, height = bounding_box
+        margin_x, margin_y = ROI_MARGIN * width / 2, ROI_MARGIN * height / 2
+        # a border of the region which is also one of the frame does not count
+        return ((left > 0 and x - left < margin_x) or (top > 0 and y - top < margin_y)
+                or (right < frame_width and right - (x + width) < margin_x)
+                or (bottom < frame_height and bottom - (y + height) < margin_y))
+
+    def __move_region(self, frame: Frame, bounding_box: tuple, region: Optional[tuple[int, int, int, int]]):
+        """initialize a new tracker on region of the frame the box was found on"""
+        tracker = self.__create_tracker()
+        left, top = region[:2] if region is not None else (0, 0)
+        try:
+            tracker.init(self.__crop(frame, region), (bounding_box[0] - left, bounding_box[1] - top, *bounding_box[2:]))
+        except Exception as e:
+            # keep tracking in the old region rather than losing the object
+            tracker.close()
+            logger.warning(f"Could not move the region of interest: {e}")
+            return
+        self.tracker.close()
+        self.tracker = tracker
+        self.region = region
+
+    def init(self, frame: Frame, bounding_box: tuple):
+        x, y, width, height = bounding_box
+        self.kalman_filter.start(frame.frame_number, (x + width / 2, y + height / 2))
+        self.region = self.__choose_region(frame, bounding_box)
+        left, top = self.region[:2] if self.region is not None else (0, 0)
+        self.tracker.init(self.__crop(frame, self.region), (x - left, y - top, width, height))
+
+    def update(self, frame: Frame) -> tuple[bool, Sequence[int]]:
+        self.kalman_filter.predict(frame.frame_number)
+        success, bounding_box = self.tracker.update(self.__crop(frame, self.region))
+        if not success:
+            return success, bounding_box
+        left, top = self.region[:2] if self.region is not None else (0, 0)
+        x, y, width, height = bounding_box
+        bounding_box = (x + left, y + top, width, height)
+        innovation = self.kalman_filter.correct((x + left + width / 2, y + top + height / 2))
+        if innovation > ROI_MAX_INNOVATION * max(1, min(width, height)):
+            self.stable_frame_count = 0
+            if self.region is not None:
+                self.__move_region(frame, bounding_box, None)
+        else:
+            self.stable_frame_count += 1
+            if self.region is None:
+                if self.stable_frame_count >= ROI_STABLE_FRAMES:
+                    region = self.__choose_region(frame, bounding_box)
+                    if region is not None:
+                        self.__move_region(frame, bounding_box, region)
+            elif self.__is_near_border(frame, bounding_box):
+                self.__move_region(frame, bounding_box, self.__choose_region(frame, bounding_box))
+        return success, bounding_box
+
+    def close(self):
+        self.tracker.close()
+
+
+Tracker = LocalTracker | PooledTracker | AdaptiveTracker | CroppingTracker
+
+
+def create_tracker(tracker_type: TrackerType = TrackerType.CSRT) -> Tracker:
+    if ROI_CROPPING and TRACKER_EXECUTION_MODE == TrackerExecutionMode.THREAD:
+        return CroppingTracker(tracker_type)
+    if tracker_type == TrackerType.AUTO:
+        return AdaptiveTracker()
+    return create_backend_tracker(tracker_type)
+
+
+def choose_frame_variant(width: int, height: int, tracking_scale: float | Literal["auto"], grayscale: bool) -> FrameVariant:
+    """
+    :param width: width of the object in the source frame
+    :param height: height of the object in the source frame
+    :param tracking_scale: factor to reduce the frames by or "auto" to choose one based on the size of the object
+    """
+    if tracking_scale == "auto":
+        # only a few scales, so that boxes of similar size share the same frame variant
+        tracking_scale = next((scale for scale in AUTO_TRACKING_SCALES
+                               if min(width, height) * scale >= AUTO_TRACKING_MIN_OBJECT_SIZE), 1.0)
+    return FrameVariant(min(1.0, tracking_scale), grayscale)
@@ -0,0 +1,117 @@
+import asyncio
+import logging
+import threading
+import time
+from typing import Optional
+
+from fastapi import WebSocket
+
+from business.metrics import SEND_SECONDS, UPDATES_SENT, UPDATE_DROPPED_FRAMES
+from business.tracked_boxes import TrackingUpdate
+from business.wire_format import BinaryUpdateEncoder, encode_json
+from config.constants import LOG_FORMAT, LOG_LEVEL
+from models.dto import WireFormat
+
+logging.basicConfig(format=LOG_FORMAT)
+logger = logging.getLogger(__name__)
+logger.setLevel(LOG_LEVEL)
+
+
+class TrackingUpdatePublisher:
+    """
+    Sends the tracking updates of a session from the event loop which owns its websocket.
+    Updates are handed over from other threads through a single "latest state wins" slot: if the client has not
+    received the previous update yet, it is replaced instead of queued, so a slow client sees fewer frames
+    but never falls behind by more than one update.
+    """
+    websocket: WebSocket
+    loop: asyncio.AbstractEventLoop
+    binary_update_encoder: Optional[BinaryUpdateEncoder]
+    min_update_interval: float
+    latest_update: Optional[TrackingUpdate]
+    # None until the first update has been sent or after reset()
+    last_sent_frame_number: Optional[int]
+    coalesced_update_count: int
+    lock: threading.Lock
+    has_update: asyncio.Event
+    task: Optional[asyncio.Task]
+
+    def __init__(self, websocket: WebSocket, loop: asyncio.AbstractEventLoop, wire_format: WireFormat = WireFormat.JSON,
+                 max_update_rate: Optional[float] = None):
+        """
+        :param max_update_rate: maximum number of updates per second, None for as many as the client can take
+        """
+        self.websocket = websocket
+        self.loop = loop
+        if wire_format == WireFormat.JSON:
+            self.binary_update_encoder = None
+        else:
+            self.binary_update_encoder = BinaryUpdateEncoder(use_delta_encoding=wire_format == WireFormat.BINARY_DELTA)
+        self.min_update_interval = 1 / max_update_rate if max_update_rate else 0.0
+        self.latest_update = None
+        self.last_sent_frame_number = None
+        self.coalesced_update_count = 0
+        self.lock = threading.Lock()
+        self.has_update = asyncio.Event()
+        self.task = None
+
+    def set_max_update_rate(self, max_update_rate: Optional[float]):
+        self.min_update_interval = 1 / max_update_rate if max_update_rate else 0.0
+
+    def start(self):
+        """must be called from the event loop"""
+        self.task = self.loop.create_task(self.send_updates())
+
+    def quit(self):
+        if self.task is not None:
+            self.loop.call_soon_threadsafe(self.task.cancel)
+
+    def reset(self):
+        """forget the updates of the previous video, its frame numbers do not continue. Must be called from the loop"""
+        with self.lock:
+            self.latest_update = None
+        self.last_sent_frame_number = None
+        if self.binary_update_encoder is not None:
+            self.binary_update_encoder.reset()
+
+    def publish(self, tracking_update: TrackingUpdate):
+        """thread safe. The loop is only woken up if there was no update waiting already"""
+        with self.lock:
+            is_waiting = self.latest_update is not None
+            if is_waiting:
+                self.coalesced_update_count += 1
+            self.latest_update = tracking_update
+        if not is_waiting:
+            self.loop.call_soon_threadsafe(self.has_update.set)
+
+    async def send_updates(self):
+        last_sent = 0.0
+        while True:
+            await self.has_update.wait()
+            self.has_update.clear()
+            if self.min_update_interval:
+                # updates published while waiting replace each other
+                await asyncio.sleep(last_sent + self.min_update_interval - time.monotonic())
+            with self.lock:
+                tracking_update, self.latest_update = self.latest_update, None
+            if tracking_update is None:
+                continue
+            if self.last_sent_frame_number is not None:
+                tracking_update.dropped_frames = max(0, tracking_update.frame_number - self.last_sent_frame_number - 1)
+                if tracking_update.dropped_frames > 0:
+                    UPDATE_DROPPED_FRAMES.inc(tracking_update.dropped_frames)
+            self.last_sent_frame_number = tracking_update.frame_number
+            last_sent = time.monotonic()
+            try:
+                if self.binary_update_encoder is None:
+                    await self.websocket.send_json(encode_json(tracking_update))
+                else:
+                    await self.websocket.send_bytes(self.binary_update_encoder.encode(tracking_update))
+                SEND_SECONDS.observe(time.monotonic() - last_sent)
+                UPDATES_SENT.inc()
+            except Exception as e:
+                logger.warning(e)
+                if self.binary_update_encoder is not None:
+                    # the client does not have the boxes the next delta would refer to
+                    self.binary_update_encoder.reset()
+            logger.debug(f"TrackingUpdate sent for frame {tracking_update.frame_number}")
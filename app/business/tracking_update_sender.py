@@ -1,41 +1,55 @@
-import asyncio
 import logging
-import queue
 import threading
-from time import sleep
-from fastapi import WebSocket
+import time
+from typing import Optional, Callable
 
-from config.constants import LOG_FORMAT, LOG_LEVEL, NO_UPDATES_TO_SEND_TIMEOUT
-from models.dto import BoundingBox, UpdateTrackingEvent
-from models.dto import EventType
+from business.metrics import AGGREGATION_SECONDS, STALE_BOXES
+from business.tracked_boxes import TrackedBox, TrackingUpdate
+from config.constants import LOG_FORMAT, LOG_LEVEL, FRAME_AGGREGATION_DEADLINE
 
 logging.basicConfig(format=LOG_FORMAT)
 logger = logging.getLogger(__name__)
 logger.setLevel(LOG_LEVEL)
 
 
-class QueueWrapper:
-    input_queue: queue.Queue
-    latest_bounding_box: BoundingBox
-    latest_frame: int
+class PendingFrame:
+    """The boxes which have arrived for one frame so far"""
+    bounding_boxes: dict[int, TrackedBox]
+    first_box_at: float
+    deadline: float
 
-    def __init__(self, input_queue: queue.Queue):
-        self.input_queue = input_queue
-        self.latest_bounding_box = None
-        self.latest_frame = -1
+    def __init__(self, first_box_at: float):
+        self.bounding_boxes = {}
+        self.first_box_at = first_box_at
+        self.deadline = first_box_at + FRAME_AGGREGATION_DEADLINE
 
 
 class TrackingUpdateSenderThread:
-    websocket: WebSocket
-    update_queue_items: list[QueueWrapper]
+    """
+    Collects the boxes of all trackers by frame number and sends a TrackingUpdate as soon as a frame is complete,
+    i.e. every tracker has either sent a box for it or has already moved past it because it dropped the frame.
+    If a frame is still incomplete FRAME_AGGREGATION_DEADLINE seconds after its first box arrived, it is sent anyway and
+    the missing boxes are filled in with their latest known position, marked as stale.
+    Events are not written to the websocket here, but passed to publish_callback, which must be thread safe.
+    """
+    publish_callback: Callable[[TrackingUpdate], None]
+    object_ids: set[int]
+    pending_frames: dict[int, PendingFrame]
+    latest_bounding_boxes: dict[int, TrackedBox]
+    last_sent_frame_number: int
+    condition: threading.Condition
     thread: threading.Thread
     should_quit: threading.Event
 
-    def __init__(self, websocket: WebSocket):
-        self.websocket = websocket
-        self.update_queue_items = []
+    def __init__(self, publish_callback: Callable[[TrackingUpdate], None]):
+        self.publish_callback = publish_callback
+        self.object_ids = set()
+        self.pending_frames = {}
+        self.latest_bounding_boxes = {}
+        self.last_sent_frame_number = -1
+        self.condition = threading.Condition()
         self.should_quit = threading.Event()
-        self.thread = threading.Thread(target=self.run_in_async_loop)
+        self.thread = threading.Thread(target=self.send_updates, name="tracking-update-sender")
         self.thread.daemon = True
 
     def start(self):
@@ -45,72 +59,97 @@ class TrackingUpdateSenderThread:
     def is_running(self):
         return self.thread.is_alive()
 
-    def add_queue(self, input_queue: queue.Queue):
-        self.update_queue_items.append(QueueWrapper(input_queue))
-
-    def remove_queue(self, input_queue: queue.Queue):
-        temp_list = self.update_queue_items.copy()
-        for item in temp_list:
-            if item.input_queue is input_queue:
-                self.update_queue_items.remove(item)
+    def add_tracker(self, object_id: int):
+        with self.condition:
+            self.object_ids.add(object_id)
+
+    def remove_tracker(self, object_id: int):
+        with self.condition:
+            self.object_ids.discard(object_id)
+            self.latest_bounding_boxes.pop(object_id, None)
+            for pending_frame in self.pending_frames.values():
+                pending_frame.bounding_boxes.pop(object_id, None)
+            # frames may have become complete without this tracker
+            self.condition.notify()
+
+    def submit(self, bounding_box: TrackedBox):
+        """called by the trackers whenever they have processed a frame"""
+        with self.condition:
+            if bounding_box.id not in self.object_ids:
+                return
+            self.latest_bounding_boxes[bounding_box.id] = bounding_box
+            if bounding_box.frame_number <= self.last_sent_frame_number:
+                return
+            pending_frame = self.pending_frames.get(bounding_box.frame_number)
+            if pending_frame is None:
+                pending_frame = PendingFrame(time.monotonic())
+                self.pending_frames[bounding_box.frame_number] = pending_frame
+            pending_frame.bounding_boxes[bounding_box.id] = bounding_box
+            # a new deadline or a box which may complete this or an older frame
+            self.condition.notify()
 
     def quit(self):
         self.should_quit.set()
+        with self.condition:
+            self.condition.notify()
         logger.debug(f"Tracking update sender thread exiting")
 
     def has_quit(self):
         return self.should_quit.is_set()
 
-    def run_in_async_loop(self):
-        # https://stackoverflow.com/questions/59645272/how-do-i-pass-an-async-function-to-a-thread-target-in-python
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-        loop.run_until_complete(self.send_updates())
-        loop.close()
-
-    def get_current_max_frame_number(self):
-        max_frame_number: int = -1
-        for item in self.update_queue_items:
-            if item.latest_frame > max_frame_number:
-                max_frame_number = item.latest_frame
-        return max_frame_number
-
-    async def send_updates(self):
+    def join(self, timeout: float):
+        """wait until the thread has exited after quit(), if it has been started"""
+        if self.thread.ident is not None:
+            self.thread.join(timeout)
+            if self.thread.is_alive():
+                logger.warning(f"Tracking update sender thread did not exit within {timeout} seconds")
+
+    def __is_complete(self, frame_number: int, pending_frame: PendingFrame) -> bool:
+        for object_id in self.object_ids - pending_frame.bounding_boxes.keys():
+            latest_bounding_box = self.latest_bounding_boxes.get(object_id)
+            if latest_bounding_box is None or latest_bounding_box.frame_number <= frame_number:
+                return False
+        return True
+
+    def __take_next_update(self) -> Optional[TrackingUpdate]:
+        """the newest complete frame or, if its deadline has passed, the oldest incomplete one. Needs the lock"""
+        complete_frame_numbers = [frame_number for frame_number, pending_frame in self.pending_frames.items()
+                                  if self.__is_complete(frame_number, pending_frame)]
+        if complete_frame_numbers:
+            frame_number = max(complete_frame_numbers)
+        else:
+            frame_number = min(self.pending_frames)
+            if self.pending_frames[frame_number].deadline > time.monotonic():
+                return None
+        pending_frame = self.pending_frames[frame_number]
+        bounding_boxes = pending_frame.bounding_boxes
+        for object_id in self.object_ids - bounding_boxes.keys():
+            if object_id in self.latest_bounding_boxes:
+                bounding_boxes[object_id] = self.latest_bounding_boxes[object_id]._replace(stale=True)
+                STALE_BOXES.inc()
+        AGGREGATION_SECONDS.observe(time.monotonic() - pending_frame.first_box_at)
+        for obsolete_frame_number in [number for number in self.pending_frames if number <= frame_number]:
+            self.pending_frames.pop(obsolete_frame_number)
+        self.last_sent_frame_number = frame_number
+        return TrackingUpdate(frame_number, list(bounding_boxes.values()))
+
+    def __time_until_next_deadline(self) -> Optional[float]:
+        if not self.pending_frames:
+            return None
+        return max(0.0, min(pending_frame.deadline for pending_frame in self.pending_frames.values()) - time.monotonic())
+
+    def send_updates(self):
         while not self.has_quit():
-            if len(self.update_queue_items) != 0:
-                try:
-                    bounding_boxes: list[BoundingBox] = []
-
-                    for index, update_queue_item in enumerate(self.update_queue_items):
-                        # here the update sender stops trackers from tracking
-                        update_queue_item.latest_bounding_box = update_queue_item.input_queue.get(
-                            timeout=NO_UPDATES_TO_SEND_TIMEOUT)
-                        update_queue_item.latest_frame = update_queue_item.latest_bounding_box.frame_number
-
-                    max_frame_number: int = self.get_current_max_frame_number()
-                    for update_queue_item in self.update_queue_items:
-                        while not update_queue_item.latest_frame == max_frame_number:
-                            update_queue_item.latest_bounding_box = update_queue_item.input_queue.get(
-                                timeout=NO_UPDATES_TO_SEND_TIMEOUT)
-                            update_queue_item.latest_frame = update_queue_item.latest_bounding_box.frame_number
-                        bounding_boxes.append(update_queue_item.latest_bounding_box)
-
-                    for index, bounding_box in enumerate(bounding_boxes):
-                        logger.debug(f"Sending bounding box {bounding_box.frame_number} from queue {index}")
-
-                    update_tracking_event: UpdateTrackingEvent = UpdateTrackingEvent(
-                        event_type=EventType.UPDATE_TRACKING,
-                        bounding_boxes=bounding_boxes,
-                        frame_number=max_frame_number)
-                    try:
-                        await self.websocket.send_json(update_tracking_event.model_dump_json())
-                    except RuntimeError as e:
-                        logger.warning(e)
-                    logger.debug(f"UpdateTrackingEvent sent for frame {update_tracking_event.frame_number}")
-                except queue.Empty:
-                    logger.warning("Tracking update sender did not receive updates.")
-            else:
-                # busy waiting...
-                sleep(0.5)
-                logger.debug("Tracking update sender waiting...")
+            with self.condition:
+                tracking_update = None
+                while tracking_update is None and not self.has_quit():
+                    if self.pending_frames:
+                        tracking_update = self.__take_next_update()
+                    if tracking_update is None:
+                        # only wakes up for new boxes or when the oldest frame is due
+                        self.condition.wait(self.__time_until_next_deadline())
+            if tracking_update is None:
+                break
+            self.publish_callback(tracking_update)
+            logger.debug(f"TrackingUpdate published for frame {tracking_update.frame_number}")
         logger.debug(f"Tracking update sender thread exited")
@@ -0,0 +1,153 @@
+import logging
+import threading
+import time
+from typing import Optional
+
+import cv2
+
+from business.decoder_process import open_video_capture
+from business.metrics import RESOURCE_CREATION_SECONDS, RESOURCES_ACQUIRED, RESOURCE_CREATION_SECONDS_SAVED, \
+    IDLE_VIDEO_CAPTURES
+from config.constants import LOG_FORMAT, LOG_LEVEL, VIDEO_CAPTURE_POOL_SIZE, VIDEO_CAPTURE_IDLE_SECONDS
+
+logging.basicConfig(format=LOG_FORMAT)
+logger = logging.getLogger(__name__)
+logger.setLevel(LOG_LEVEL)
+
+VIDEO_CAPTURE = "video_capture"
+
+
+class IdleVideoCapture:
+    video_source: str
+    video_capture: cv2.VideoCapture
+    # what opening it took, which the next user does not have to wait for
+    open_seconds: float
+    idle_since: float
+
+    def __init__(self, video_source: str, video_capture: cv2.VideoCapture, open_seconds: float):
+        self.video_source = video_source
+        self.video_capture = video_capture
+        self.open_seconds = open_seconds
+        self.idle_since = time.monotonic()
+
+
+class VideoCapturePool:
+    """
+    Keeps the captures of seekable videos open after their PastFrameReader or producer is done with them, so that the
+    next reader of the same video seeks instead of opening it again, which probes the container and sets up a decoder.
+    Streams cannot seek, their captures are released right away.
+    At most max_idle_captures are kept, the least recently used one is released first, and captures which have been
+    idle for VIDEO_CAPTURE_IDLE_SECONDS are released on the next acquire() or release().
+    """
+    max_idle_captures: int
+    # least recently used first
+    idle_captures: list[IdleVideoCapture]
+    # id() of the captures which are in use -> seconds it took to open them
+    open_seconds: dict[int, float]
+    lock: threading.Lock
+    is_shut_down: bool
+
+    def __init__(self, max_idle_captures: int = VIDEO_CAPTURE_POOL_SIZE):
+        self.max_idle_captures = max_idle_captures
+        self.idle_captures = []
+        self.open_seconds = {}
+        self.lock = threading.Lock()
+        self.is_shut_down = False
+        IDLE_VIDEO_CAPTURES.set_callback(self.get_idle_capture_count)
+
+    def acquire(self, video_source: str, start_frame_number: int = 1) -> tuple[cv2.VideoCapture, bool]:
+        """
+        an open capture of video_source, which must be given back with release()
+        :param start_frame_number: the frame the capture should read next
+        :return: the capture and whether it could be moved to start_frame_number
+        """
+        with self.lock:
+            idle_capture = next((idle_capture for idle_capture in reversed(self.idle_captures)
+                                 if idle_capture.video_source == video_source), None)
+            if idle_capture is not None:
+                self.idle_captures.remove(idle_capture)
+            expired_captures = self.__remove_expired_captures()
+        self.__release_captures(expired_captures)
+        if idle_capture is not None:
+            # frame numbers start with 1, positions with 0
+            if idle_capture.video_capture.set(cv2.CAP_PROP_POS_FRAMES, start_frame_number - 1):
+                RESOURCES_ACQUIRED.labels(VIDEO_CAPTURE, "pooled").inc()
+                RESOURCE_CREATION_SECONDS_SAVED.labels(VIDEO_CAPTURE).inc(idle_capture.open_seconds)
+                with self.lock:
+                    self.open_seconds[id(idle_capture.video_capture)] = idle_capture.open_seconds
+                return idle_capture.video_capture, True
+            idle_capture.video_capture.release()
+        opened_at = time.perf_counter()
+        video_capture = open_video_capture(video_source)
+        open_seconds = time.perf_counter() - opened_at
+        RESOURCE_CREATION_SECONDS.labels(VIDEO_CAPTURE).observe(open_seconds)
+        RESOURCES_ACQUIRED.labels(VIDEO_CAPTURE, "created").inc()
+        with self.lock:
+            self.open_seconds[id(video_capture)] = open_seconds
+        if start_frame_number == 1:
+            return video_capture, True
+        return video_capture, video_capture.set(cv2.CAP_PROP_POS_FRAMES, start_frame_number - 1)
+
+    def release(self, video_source: str, video_capture: cv2.VideoCapture):
+        """give a capture back. It is kept open if it may be reused, may be called from any thread"""
+        with self.lock:
+            open_seconds = self.open_seconds.pop(id(video_capture), 0.0)
+            is_reusable = (not self.is_shut_down and self.max_idle_captures > 0 and video_capture.isOpened()
+                           # streams have no frame count
+                           and video_capture.get(cv2.CAP_PROP_FRAME_COUNT) > 0)
+            if is_reusable:
+                self.idle_captures.append(IdleVideoCapture(video_source, video_capture, open_seconds))
+            released_captures = self.__remove_expired_captures()
+            while len(self.idle_captures) > self.max_idle_captures:
+                released_captures.append(self.idle_captures.pop(0))
+        if not is_reusable:
+            video_capture.release()
+        self.__release_captures(released_captures)
+
+    def __remove_expired_captures(self) -> list[IdleVideoCapture]:
+        """needs the lock"""
+        expires_before = time.monotonic() - VIDEO_CAPTURE_IDLE_SECONDS
+        expired_captures = [idle_capture for idle_capture in self.idle_captures
+                            if idle_capture.idle_since < expires_before]
+        if expired_captures:
+            self.idle_captures = [idle_capture for idle_capture in self.idle_captures
+                                  if idle_capture.idle_since >= expires_before]
+        return expired_captures
+
+    @staticmethod
+    def __release_captures(idle_captures: list[IdleVideoCapture]):
+        """outside of the lock, closing the decoder of a capture may take a moment"""
+        for idle_capture in idle_captures:
+            idle_capture.video_capture.release()
+            logger.debug(f"Released idle capture of {idle_capture.video_source}")
+
+    def get_idle_capture_count(self) -> int:
+        return len(self.idle_captures)
+
+    def shutdown(self):
+        IDLE_VIDEO_CAPTURES.set_callback(None)
+        with self.lock:
+            self.is_shut_down = True
+            idle_captures = self.idle_captures
+            self.idle_captures = []
+        self.__release_captures(idle_captures)
+
+
+__video_capture_pool: Optional[VideoCapturePool] = None
+__video_capture_pool_lock = threading.Lock()
+
+
+def get_video_capture_pool() -> VideoCapturePool:
+    global __video_capture_pool
+    with __video_capture_pool_lock:
+        if __video_capture_pool is None:
+            __video_capture_pool = VideoCapturePool()
+        return __video_capture_pool
+
+
+def shutdown_video_capture_pool():
+    global __video_capture_pool
+    with __video_capture_pool_lock:
+        if __video_capture_pool is not None:
+            __video_capture_pool.shutdown()
+            __video_capture_pool = None
@@ -1,116 +1,163 @@
-import asyncio
 import logging
-import queue
-import threading
+import time
 from collections.abc import Sequence
-from typing import Callable
-
-import cv2
-
-from config.constants import LOG_LEVEL, LOG_FORMAT, QUEUE_SIZE, PRODUCER_THREAD_SEEMS_DEAD_TIMEOUT
-from models.dto import BoundingBox, VideoFrame, ThreadingEvent
+from typing import Callable, Optional
+
+from business import trackers
+from business.frame_ring_buffer import FrameReader, Frame
+from business.metrics import TRACKING_SECONDS, TRACKER_FAILURES, PREDICTED_BOXES
+from business.motion import KeyframeSchedule
+from business.tracked_boxes import TrackedBox
+from business.video_frame_producer import PastFrameReader
+from config.constants import LOG_LEVEL, LOG_FORMAT, PRODUCER_THREAD_SEEMS_DEAD_TIMEOUT
+from models.dto import BoundingBox, ThreadingEvent, TrackerType
 from models.errors import TrackingError
 
 logging.basicConfig(format=LOG_FORMAT)
 logger = logging.getLogger(__name__)
 logger.setLevel(LOG_LEVEL)
 
-SAFETY_TIMEOUT = 0.3
 
-
-class VideoFrameConsumerThread:
-    tracker: cv2.Tracker
+class VideoFrameConsumer:
+    """Tracks one object. Does not own a thread: the TrackerScheduler calls step() whenever there may be a new frame"""
+    tracker: trackers.Tracker
     object_id: int
-    input_queue: queue.Queue[VideoFrame]
-    output_queue: queue.Queue[BoundingBox]
-    thread: threading.Thread
-    should_quit: threading.Event
+    frame_reader: FrameReader
+    # frames from the one the box was drawn on up to the first one of frame_reader, tracked first to catch up
+    past_frame_reader: Optional[PastFrameReader]
+    open_past_frame_reader: Optional[Callable[[], PastFrameReader]]
+    output_callback: Callable[[TrackedBox], None]
+    keyframe_schedule: KeyframeSchedule
+    has_failed: bool
     error_callback: Callable
 
-    def __init__(self, object_id: int, on_error_callback: Callable):
+    def __init__(self, object_id: int, frame_reader: FrameReader, output_callback: Callable[[TrackedBox], None],
+                 on_error_callback: Callable, tracker_type: TrackerType = TrackerType.CSRT,
+                 open_past_frame_reader: Optional[Callable[[], PastFrameReader]] = None, keyframe_interval: int = 1):
         """
-        initialize object tracker thread, but do not run it yet.
-        on_error will be called whenever there is an error which prevents this thread from continuing it's work.
+        initialize object tracker, but do not run it yet. Frames are read from frame_reader and every tracked
+        bounding box is passed to output_callback.
+        on_error will be called whenever there is an error which prevents this consumer from continuing it's work.
         It should contain a method which deletes this object cleanly.
-        :return: created tracker instance
+        :param tracker_type: the OpenCV tracker to use, or TrackerType.AUTO to pick one by its cost
+        :param open_past_frame_reader: opens a reader which is read before frame_reader, if the box was drawn on a frame
+        which is no longer in the ring. Called by start(), because opening it seeks the video
+        :param keyframe_interval: track on up to every n-th frame only and predict the box in between, see KeyframeSchedule
         """
-        self.tracker = cv2.TrackerCSRT.create()
+        self.tracker = trackers.create_tracker(tracker_type)
         self.object_id = object_id
-        self.input_queue = queue.Queue(QUEUE_SIZE)
-        self.output_queue = queue.Queue(QUEUE_SIZE)
-        self.thread: threading.Thread = threading.Thread(target=self.run_in_async_loop)
-        self.thread.daemon = True
-        self.should_quit = threading.Event()
+        self.frame_reader = frame_reader
+        self.past_frame_reader = None
+        self.open_past_frame_reader = open_past_frame_reader
+        self.output_callback = output_callback
+        self.keyframe_schedule = KeyframeSchedule(keyframe_interval)
+        self.has_failed = False
         self.error_callback = on_error_callback
 
-    async def on_error(self, message: str):
-        """This method should be called whenever there is an error which means that this thread cannot continue its work.
-        The error_callback should be set by the session-object which should handle the deletion of this object"""
+    def on_error(self, message: str):
+        """This method should be called whenever there is an error which means that this consumer cannot continue its work.
+        The error_callback should be set by the session-object which should handle the deletion of this object.
+        It is called from a scheduler worker thread."""
         logger.error(message)
+        self.has_failed = True
         e = ThreadingEvent(self.object_id, message)
-        await self.error_callback(e)
+        self.error_callback(e)
+
+    def __current_reader(self) -> FrameReader | PastFrameReader:
+        return self.past_frame_reader if self.past_frame_reader is not None else self.frame_reader
+
+    def __close_past_frame_reader(self):
+        if self.past_frame_reader is not None:
+            self.past_frame_reader.close()
+            self.past_frame_reader = None
 
     def start(self, initial_bounding_box: BoundingBox):
+        """
+        initialize the tracker on the first frame of the readers, which is the frame the box was drawn on unless
+        that frame could not be read anymore. The consumer has to be registered at the scheduler afterwards
+        """
         logger.debug(
-            f"Starting video frame consumer thread for {initial_bounding_box.id} on frame {initial_bounding_box.frame_number}")
-        frame: VideoFrame = self.input_queue.get()
+            f"Starting video frame consumer for {initial_bounding_box.id} on frame {initial_bounding_box.frame_number}")
+        frame: Optional[Frame] = None
+        if self.open_past_frame_reader is not None:
+            self.past_frame_reader = self.open_past_frame_reader()
+            self.open_past_frame_reader = None
+        if self.past_frame_reader is not None:
+            frame = self.past_frame_reader.read()
+            if frame is None:
+                self.__close_past_frame_reader()
+        if frame is None:
+            frame = self.frame_reader.read(timeout=PRODUCER_THREAD_SEEMS_DEAD_TIMEOUT)
+        if frame is None:
+            raise TrackingError(f"Video ended before tracker {self.object_id} could be initialized")
+        logger.debug(f"Initializing tracker {self.object_id} on frame {frame.frame_number}")
+        scale_x, scale_y = frame.scale
         bounding_box_coordinates: tuple = (
-            initial_bounding_box.x, initial_bounding_box.y, initial_bounding_box.width, initial_bounding_box.height)
-        self.tracker.init(frame.img, bounding_box_coordinates)
-        self.thread.start()
+            round(initial_bounding_box.x * scale_x), round(initial_bounding_box.y * scale_y),
+            max(1, round(initial_bounding_box.width * scale_x)), max(1, round(initial_bounding_box.height * scale_y)))
+        try:
+            self.tracker.init(frame, bounding_box_coordinates)
+        finally:
+            self.__current_reader().release()
+        self.keyframe_schedule.start(frame.frame_number, (initial_bounding_box.x, initial_bounding_box.y,
+                                                          initial_bounding_box.width, initial_bounding_box.height))
 
     def quit(self):
-        self.should_quit.set()
-        # only join if the thread has been started
-        logger.debug(f"Video frame consumer thread exiting")
-
-    def has_quit(self):
-        return self.should_quit.is_set()
-
-    def update_tracking(self, img):
-        success, bounding_box = self.tracker.update(img)
+        # lets the producer overwrite our frames right away, the tracker is closed by the scheduler
+        self.frame_reader.close()
+        logger.debug("Video frame consumer exiting")
+
+    def close(self):
+        self.__close_past_frame_reader()
+        self.tracker.close()
+        logger.debug(f"Video frame consumer {self.object_id} exited")
+
+    def update_tracking(self, frame: Frame):
+        update_started_at = time.perf_counter()
+        success, bounding_box = self.tracker.update(frame)
+        TRACKING_SECONDS.observe(time.perf_counter() - update_started_at)
         if success:
             return bounding_box
         else:
             logger.warning("Tracking failed")
             raise TrackingError("Tracking failed")
 
-    def run_in_async_loop(self):
-        # https://stackoverflow.com/questions/59645272/how-do-i-pass-an-async-function-to-a-thread-target-in-python
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-        loop.run_until_complete(self.run_tracking_loop())
-        loop.close()
-
-    async def run_tracking_loop(self):
+    def step(self) -> bool:
         """
-        Run the tracking loop and fill the output_queue with tracking data
+        Track the object in the next frame, if it has already been published, and pass the result to the output_callback
+        :return: whether there may be another frame to process
         """
-        while not self.has_quit():
+        if self.has_failed:
+            return False
+        frame_reader = self.__current_reader()
+        frame = frame_reader.poll()
+        if frame is None:
+            if frame_reader is self.past_frame_reader:
+                # caught up, continue with the live frames
+                self.__close_past_frame_reader()
+                return True
+            return False
+        if not self.keyframe_schedule.is_keyframe(frame.frame_number):
+            frame_reader.release()
+            x, y, width, height = self.keyframe_schedule.predict(frame.frame_number)
+            PREDICTED_BOXES.inc()
+            self.output_callback(TrackedBox(self.object_id, frame.frame_number, x, y, width, height))
+            return True
+        try:
             try:
-                frame = self.input_queue.get(timeout=PRODUCER_THREAD_SEEMS_DEAD_TIMEOUT)
-                bounding_box: Sequence[int] = self.update_tracking(frame.img)
-                self.output_queue.put(
-                    BoundingBox(id=self.object_id, frame_number=frame.frame_number, x=bounding_box[0],
-                                y=bounding_box[1],
-                                width=bounding_box[2], height=bounding_box[3]))
-                logger.debug(f"Tracker {self.object_id} processed frame {frame.frame_number}")
-            except Exception as e:
-                await self.on_error(f"Video frame consumer error: {e}")
-        self.read_queue_to_empty()
-        logger.debug(f"Video frame consumer thread exited")
-
-    def read_queue_to_empty(self):
-        queue_is_empty = False
-        while not queue_is_empty:
-            try:
-                self.input_queue.get(timeout=SAFETY_TIMEOUT)
-            except queue.Empty:
-                queue_is_empty = True
-
-# Frames droppen um den neuen wieder zu bekommen
-# numdropped = 0
-# while pipe.poll:
-#   pipe.receive
-#   numdropped++
-# return numdropped
+                bounding_box: Sequence[int] = self.update_tracking(frame)
+            finally:
+                frame_reader.release()
+            # back to source coordinates if the tracker runs on a reduced frame variant
+            scale_x, scale_y = frame.scale
+            source_bounding_box = (bounding_box[0] / scale_x, bounding_box[1] / scale_y,
+                                   bounding_box[2] / scale_x, bounding_box[3] / scale_y)
+            self.keyframe_schedule.update(frame.frame_number, source_bounding_box)
+            x, y, width, height = (round(value) for value in source_bounding_box)
+            self.output_callback(TrackedBox(self.object_id, frame.frame_number, x, y, width, height))
+            logger.debug(f"Tracker {self.object_id} processed frame {frame.frame_number}")
+        except Exception as e:
+            TRACKER_FAILURES.labels(self.tracker.tracker_type.value).inc()
+            self.on_error(f"Video frame consumer error: {e}")
+            return False
+        return True
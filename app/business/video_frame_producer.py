@@ -1,47 +1,185 @@
 import logging
-import queue
 import threading
-from typing import Callable
+import time
+from typing import Callable, Optional
 
 import cv2
 
-from config.constants import LOG_FORMAT, LOG_LEVEL
-from models.dto import VideoFrame, ThreadingEvent
+from business.decoder_process import PrefetchingVideoCapture
+from business.frame_ring_buffer import FrameRingBuffer, FrameReader, FrameVariant, SOURCE, Frame
+from business.metrics import DECODE_SECONDS, DECODER_DROPPED_FRAMES, FRAMES_DECODED
+from business.video_capture_pool import VideoCapturePool, get_video_capture_pool
+from config.constants import LOG_FORMAT, LOG_LEVEL, QUEUE_SIZE, TRACKER_EXECUTION_MODE, TrackerExecutionMode, \
+    DECODE_IN_SUBPROCESS, DEFAULT_FPS
+from models.dto import ThreadingEvent
 
 logging.basicConfig(format=LOG_FORMAT)
 logger = logging.getLogger(__name__)
 logger.setLevel(LOG_LEVEL)
 
 
+def decode_frame(video_capture: cv2.VideoCapture | PrefetchingVideoCapture, frame_ring_buffer: FrameRingBuffer,
+                 frame_number: int) -> Optional[float]:
+    """
+    decode the next frame of video_capture into the slot of frame_number, allocating the ring on the first frame.
+    The frame still has to be published
+    :return: the seconds decoding took, without waiting for the slot, or None at the end of the video, if the frame
+    cannot be read or if the ring has been closed
+    :raise ValueError: if the frame does not have the shape of the frames before
+    """
+    if frame_ring_buffer.is_allocated():
+        # this blocks until no reader needs the frame in the slot anymore
+        slot = frame_ring_buffer.acquire_slot(frame_number)
+        if slot is None:
+            return None
+        decode_started_at = time.perf_counter()
+        success, img = video_capture.read(slot)
+        decode_time = time.perf_counter() - decode_started_at
+        if not success:
+            return None
+        if img is not slot:
+            raise ValueError(f"Frame {frame_number} has the unexpected shape {img.shape}")
+        return decode_time
+    decode_started_at = time.perf_counter()
+    success, img = video_capture.read()
+    decode_time = time.perf_counter() - decode_started_at
+    if not success:
+        return None
+    frame_ring_buffer.allocate(img.shape, img.dtype)
+    slot = frame_ring_buffer.acquire_slot(frame_number)
+    if slot is None:
+        return None
+    slot[:] = img
+    return decode_time
+
+
+class PastFrameReader:
+    """
+    Reads frames which are older than the ring of the producer from a capture of its own, so that a tracker can start
+    on the frame its box was drawn on and catch up to the live frames.
+    The FFmpeg backend of OpenCV seeks to the last keyframe before the first frame and decodes forward from there,
+    so the video is not decoded from the beginning. The frames pass through a small ring of their own, which reduces
+    them to the frame variant and makes them available to worker processes like live frames.
+    The capture comes from the VideoCapturePool, so a video which has been read before is only seeked, not opened.
+    Not thread safe, but only used by the consumer it belongs to.
+    """
+    video_source: str
+    video_capture: Optional[cv2.VideoCapture]
+    video_capture_pool: VideoCapturePool
+    frame_ring_buffer: FrameRingBuffer
+    frame_reader: FrameReader
+    next_frame_number: int
+    end_frame_number: int
+
+    def __init__(self, video_source: str, start_frame_number: int, end_frame_number: int, frame_variant: FrameVariant,
+                 use_shared_memory: bool = False):
+        """
+        :param end_frame_number: the first frame which is not read anymore, usually the first one of the live reader
+        """
+        self.video_source = video_source
+        self.video_capture_pool = get_video_capture_pool()
+        self.video_capture, can_seek = self.video_capture_pool.acquire(video_source, start_frame_number)
+        if not can_seek:
+            logger.warning(f"{video_source} cannot seek to frame {start_frame_number}")
+            end_frame_number = start_frame_number
+        self.frame_ring_buffer = FrameRingBuffer(1, use_shared_memory)
+        self.frame_reader = self.frame_ring_buffer.add_reader(frame_variant, start_frame_number)
+        self.next_frame_number = start_frame_number
+        self.end_frame_number = end_frame_number
+
+    def read(self, timeout: Optional[float] = None) -> Optional[Frame]:
+        """
+        decode the next frame. Does not wait for anything, the timeout is only there to be used like a FrameReader
+        :return: the frame (valid until release() is called) or None once end_frame_number has been reached
+        """
+        if self.next_frame_number >= self.end_frame_number:
+            return None
+        try:
+            if decode_frame(self.video_capture, self.frame_ring_buffer, self.next_frame_number) is None:
+                return None
+        except ValueError as e:
+            logger.error(f"{self.video_source}: {e}")
+            return None
+        self.frame_ring_buffer.publish(self.next_frame_number)
+        self.next_frame_number += 1
+        return self.frame_reader.read(0)
+
+    def poll(self) -> Optional[Frame]:
+        return self.read()
+
+    def release(self):
+        self.frame_reader.release()
+
+    def close(self):
+        if self.video_capture is not None:
+            self.video_capture_pool.release(self.video_source, self.video_capture)
+            self.video_capture = None
+        self.frame_ring_buffer.free()
+
+
 class VideoFrameProducerThread:
-    """Produce video frames. Does not support changing the video source"""
+    """
+    Produce video frames. Does not support changing the video source.
+    A producer may be shared by several sessions (see VideoFrameProducerRegistry), so it reports to listeners
+    instead of a single owner.
+    In real time mode the frames are produced at the fps of the video, no matter how fast the trackers are:
+    the trackers skip to the newest frame and if even decoding cannot keep up, frames are skipped without decoding.
+    With DECODE_IN_SUBPROCESS the frames are decoded ahead by a PrefetchingVideoCapture and this thread only copies
+    them into the ring and publishes them. Otherwise the capture comes from the VideoCapturePool and goes back to it
+    when the producer is done.
+    """
     video_source: str
-    video_capture: cv2.VideoCapture
+    # None until load() has been called
+    video_capture: Optional[cv2.VideoCapture | PrefetchingVideoCapture]
+    video_capture_pool: VideoCapturePool
+    # frames per second of the video, 0 if the container does not tell
+    fps: float
+    real_time: bool
     should_quit: threading.Event
     thread: threading.Thread
-    queues: list[queue.Queue[VideoFrame]]
-    quit_callback: Callable
+    frame_ring_buffer: FrameRingBuffer
+    quit_listeners: list[Callable[[ThreadingEvent], None]]
 
-    def __init__(self, on_quit_callback: Callable):
+    def __init__(self):
         self.should_quit = threading.Event()
-        self.thread = threading.Thread(target=self.read_video_frames)
+        self.thread = threading.Thread(target=self.read_video_frames, name="video-frame-producer")
         self.thread.daemon = True
-        self.queues = []
-        self.quit_callback = on_quit_callback
+        self.video_capture = None
+        self.video_capture_pool = get_video_capture_pool()
+        self.real_time = False
+        self.fps = 0.0
+        # worker processes can only see the frames if they are in shared memory
+        self.frame_ring_buffer = FrameRingBuffer(QUEUE_SIZE,
+                                                 use_shared_memory=TRACKER_EXECUTION_MODE == TrackerExecutionMode.PROCESS)
+        self.quit_listeners = []
+
+    def add_quit_listener(self, listener: Callable[[ThreadingEvent], None]):
+        """listener is called from the producer thread when it stops reading the video on its own"""
+        self.quit_listeners = [*self.quit_listeners, listener]
+
+    def remove_quit_listener(self, listener: Callable[[ThreadingEvent], None]):
+        self.quit_listeners = [other for other in self.quit_listeners if other != listener]
 
     def on_quit(self, message: str):
         """This method should be called whenever there is an error which means that this thread cannot continue its work.
-        The error_callback should be set by the session-object which should handle the deletion of this object"""
+        The quit listeners are the sessions which should handle this"""
         logger.info(message)
         e = ThreadingEvent(self.video_source, message)
-        self.quit_callback(e)
+        for listener in self.quit_listeners:
+            listener(e)
 
-    def load(self, video_source: str):
+    def load(self, video_source: str, real_time: bool = False):
         logger.debug(f"Loading {video_source}")
         if self.thread.is_alive():
             return
         self.video_source: str = video_source
-        self.video_capture: cv2.VideoCapture = cv2.VideoCapture(self.video_source)
+        if DECODE_IN_SUBPROCESS:
+            self.video_capture = PrefetchingVideoCapture(self.video_source)
+        else:
+            self.video_capture, _ = self.video_capture_pool.acquire(self.video_source)
+        self.fps = self.video_capture.get(cv2.CAP_PROP_FPS)
+        self.real_time = real_time
+        self.frame_ring_buffer.drop_stale_frames = real_time
 
     def start(self):
         self.thread.start()
@@ -49,27 +187,60 @@ class VideoFrameProducerThread:
     def is_running(self):
         return self.thread.is_alive()
 
-    def add_queue(self, output_queue: queue.Queue[VideoFrame]):
-        self.queues.append(output_queue)
+    def has_started(self):
+        return self.thread.ident is not None
 
-    def remove_queue(self, queue_to_remove: queue.Queue[VideoFrame]):
-        self.queues.remove(queue_to_remove)
+    def add_reader(self, frame_variant: FrameVariant = SOURCE, start_frame_number: Optional[int] = None) -> FrameReader:
+        return self.frame_ring_buffer.add_reader(frame_variant, start_frame_number)
+
+    def read_past_frames(self, start_frame_number: int, end_frame_number: int,
+                         frame_variant: FrameVariant = SOURCE) -> PastFrameReader:
+        """read frames which are no longer in the ring, see PastFrameReader"""
+        return PastFrameReader(self.video_source, start_frame_number, end_frame_number, frame_variant,
+                               self.frame_ring_buffer.use_shared_memory)
 
     def quit(self):
         self.should_quit.set()
+        self.frame_ring_buffer.free()
+        if not self.has_started() and self.video_capture is not None:
+            # otherwise the thread releases it
+            self.release_video_capture()
         logger.debug(f"Video frame producer thread exiting")
 
     def has_quit(self):
         return self.should_quit.is_set()
 
+    def release_video_capture(self):
+        if isinstance(self.video_capture, PrefetchingVideoCapture):
+            self.video_capture.release()
+        else:
+            self.video_capture_pool.release(self.video_source, self.video_capture)
+
     def read_video_frames(self):
         frame_number: int = 0
-        fps = self.video_capture.get(cv2.CAP_PROP_FPS)
-        total_frames = self.video_capture.get(cv2.CAP_PROP_FRAME_COUNT)
         try:
+            total_frames = self.video_capture.get(cv2.CAP_PROP_FRAME_COUNT)
+            # videos which cannot be opened or do not tell their frame rate report 0
+            frame_interval = 1 / (self.fps or DEFAULT_FPS)
+            next_frame_due = time.monotonic()
             while not self.has_quit():
-                success, img = self.video_capture.read()
-                if not success:
+                if self.real_time:
+                    # more than a frame behind the wall clock: skip frames without decoding them
+                    while time.monotonic() - next_frame_due > frame_interval and self.video_capture.grab():
+                        frame_number += 1
+                        next_frame_due += frame_interval
+                        DECODER_DROPPED_FRAMES.inc()
+                    self.should_quit.wait(max(0.0, next_frame_due - time.monotonic()))
+                    next_frame_due += frame_interval
+                try:
+                    decode_time = decode_frame(self.video_capture, self.frame_ring_buffer, frame_number + 1)
+                except ValueError as e:
+                    self.on_quit(f"Video frame producer stopped: {e}. exiting")
+                    return
+                if decode_time is None:
+                    if self.has_quit():
+                        # the ring has been closed
+                        break
                     if frame_number >= total_frames:
                         self.on_quit("Video frame producer finished")
                         return
@@ -77,14 +248,17 @@ class VideoFrameProducerThread:
                         self.on_quit(f"Video frame producer could not read next frame. exiting")
                         return
                 frame_number += 1
-                # this blocks until the queue has a free slot
-                if self.queues:
-                    for output_queue in self.queues:
-                        output_queue.put(VideoFrame(frame_number=frame_number, img=img))
-                        logger.debug(f"Frame {frame_number} of {total_frames} read")
+                if frame_number == 1:
+                    # the clock starts with the first frame, opening the video may take a while
+                    next_frame_due = time.monotonic() + frame_interval
+                DECODE_SECONDS.observe(decode_time)
+                FRAMES_DECODED.inc()
+                self.frame_ring_buffer.publish(frame_number)
+                if self.frame_ring_buffer.readers or self.real_time:
+                    logger.debug(f"Frame {frame_number} of {total_frames} read")
                 else:
-                    threading.Event().wait(1 / fps)
+                    threading.Event().wait(frame_interval)
                     logger.debug(f"Frame {frame_number} of {total_frames} ignored")
         finally:
-            self.video_capture.release()
+            self.release_video_capture()
             logger.debug(f"Video frame producer thread exited")
@@ -0,0 +1,147 @@
+import logging
+import threading
+from typing import Optional
+
+from business.metrics import DECODERS, FRAMES_QUEUED
+from business.video_frame_producer import VideoFrameProducerThread
+from config.constants import LOG_FORMAT, LOG_LEVEL, SHARED_DECODER_JOIN_WINDOW
+
+logging.basicConfig(format=LOG_FORMAT)
+logger = logging.getLogger(__name__)
+logger.setLevel(LOG_LEVEL)
+
+
+class ProducerLoad:
+    """A producer which is being loaded outside of the lock of the registry. Sessions joining it wait for it"""
+    done: threading.Event
+    # set if load() has failed
+    error: Optional[Exception]
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.error = None
+
+
+class VideoFrameProducerRegistry:
+    """
+    Lets sessions which watch the same video source share one decoder. A session joins a running producer if it has
+    not read more than SHARED_DECODER_JOIN_WINDOW frames yet, otherwise it gets a producer of its own.
+    Producers are reference counted and quit when the last session releases them.
+    Sessions sharing a producer which is not real time are paced by the slowest tracker of all of them.
+    Opening a video may take seconds, so producers are loaded outside of the lock: a new producer is registered
+    first and sessions which join it before it is loaded wait for it.
+    """
+    producers: dict[tuple[str, bool], list[VideoFrameProducerThread]]
+    reference_counts: dict[VideoFrameProducerThread, int]
+    # the producers which are still being loaded
+    loads: dict[VideoFrameProducerThread, ProducerLoad]
+    lock: threading.Lock
+
+    def __init__(self):
+        self.producers = {}
+        self.reference_counts = {}
+        self.loads = {}
+        self.lock = threading.Lock()
+        DECODERS.set_callback(self.get_decoder_count)
+        FRAMES_QUEUED.set_callback(self.get_queued_frame_count)
+
+    @staticmethod
+    def __can_join(video_frame_producer: VideoFrameProducerThread) -> bool:
+        if video_frame_producer.has_quit():
+            return False
+        if not video_frame_producer.has_started():
+            return True
+        return (video_frame_producer.is_running()
+                and video_frame_producer.frame_ring_buffer.latest_frame_number <= SHARED_DECODER_JOIN_WINDOW)
+
+    def acquire(self, video_source: str, real_time: bool = False) -> VideoFrameProducerThread:
+        """
+        :return: a loaded producer for video_source, which must be given back with release()
+        """
+        key = (video_source, real_time)
+        with self.lock:
+            video_frame_producer: Optional[VideoFrameProducerThread] = next(
+                (producer for producer in self.producers.get(key, []) if self.__can_join(producer)), None)
+            is_new = video_frame_producer is None
+            if is_new:
+                video_frame_producer = VideoFrameProducerThread()
+                self.producers.setdefault(key, []).append(video_frame_producer)
+                self.reference_counts[video_frame_producer] = 0
+                self.loads[video_frame_producer] = ProducerLoad()
+                logger.debug(f"Created producer for {video_source}")
+            else:
+                logger.debug(f"Sharing producer for {video_source} with "
+                             f"{self.reference_counts[video_frame_producer]} other sessions")
+            self.reference_counts[video_frame_producer] += 1
+            producer_load = self.loads.get(video_frame_producer)
+        if is_new:
+            try:
+                video_frame_producer.load(video_source=video_source, real_time=real_time)
+            except Exception as e:
+                producer_load.error = e
+                # nobody may join it anymore
+                video_frame_producer.quit()
+            with self.lock:
+                self.loads.pop(video_frame_producer)
+            producer_load.done.set()
+        elif producer_load is not None:
+            producer_load.done.wait()
+        if producer_load is not None and producer_load.error is not None:
+            self.release(video_frame_producer)
+            raise producer_load.error
+        return video_frame_producer
+
+    def release(self, video_frame_producer: VideoFrameProducerThread):
+        with self.lock:
+            if video_frame_producer not in self.reference_counts:
+                return
+            self.reference_counts[video_frame_producer] -= 1
+            if self.reference_counts[video_frame_producer]:
+                return
+            self.reference_counts.pop(video_frame_producer)
+            # not taken from the producer, its load() may have failed before it knew its video source
+            key = next(key for key, producers in self.producers.items() if video_frame_producer in producers)
+            self.producers[key].remove(video_frame_producer)
+            if not self.producers[key]:
+                self.producers.pop(key)
+        video_frame_producer.quit()
+        logger.debug(f"Last session left producer for {key[0]}")
+
+    def get_decoder_count(self) -> int:
+        return len(self.reference_counts)
+
+    def get_queued_frame_count(self) -> int:
+        with self.lock:
+            video_frame_producers = list(self.reference_counts)
+        return sum(video_frame_producer.frame_ring_buffer.get_queued_frame_count()
+                   for video_frame_producer in video_frame_producers)
+
+    def shutdown(self):
+        DECODERS.set_callback(None)
+        FRAMES_QUEUED.set_callback(None)
+        with self.lock:
+            video_frame_producers = list(self.reference_counts)
+            self.producers = {}
+            self.reference_counts = {}
+        for video_frame_producer in video_frame_producers:
+            video_frame_producer.quit()
+
+
+__video_frame_producer_registry: Optional[VideoFrameProducerRegistry] = None
+__video_frame_producer_registry_lock = threading.Lock()
+
+
+def get_video_frame_producer_registry() -> VideoFrameProducerRegistry:
+    global __video_frame_producer_registry
+    with __video_frame_producer_registry_lock:
+        if __video_frame_producer_registry is None:
+            __video_frame_producer_registry = VideoFrameProducerRegistry()
+        return __video_frame_producer_registry
+
+
+def shutdown_video_frame_producer_registry():
+    global __video_frame_producer_registry
+    with __video_frame_producer_registry_lock:
+        if __video_frame_producer_registry is not None:
+            __video_frame_producer_registry.shutdown()
+            __video_frame_producer_registry = None
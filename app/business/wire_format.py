@@ -0,0 +1,85 @@
+"""
+Binary encoding of UpdateTrackingEvents, negotiated with ?format=binary or ?format=binary-delta on the websocket.
+All values are little endian.
+
+Header (12 bytes):  uint8 version, uint8 flags, uint16 dropped_frames, uint32 frame_number, uint32 box_count
+Box (24 bytes each): int32 id, int32 x, int32 y, int32 width, int32 height, int32 box_flags
+
+flags:     DELTA_ENCODED - x, y, width and height are differences to the box with the same id in the previous message
+box_flags: STALE         - the box is the latest known position of a tracker which has not caught up yet
+           ABSOLUTE      - only in delta encoded messages: the box was not in the previous message, values are absolute
+
+The JSON format is the model_dump_json() of a dto.UpdateTrackingEvent.
+"""
+import itertools
+import json
+import struct
+import numpy as np
+
+from business.tracked_boxes import TrackedBox, TrackingUpdate
+from models.dto import EventType
+
+VERSION = 1
+HEADER = struct.Struct('<BBHII')
+BOX_DTYPE = np.dtype('<i4')
+BOX_FIELDS = 6
+
+# the JSON of a dto.BoundingBox, formatted from the first six fields of a TrackedBox
+BOX_JSON = '{"id":%d,"frame_number":%d,"x":%d,"y":%d,"width":%d,"height":%d,"stale":false}'
+STALE_BOX_JSON = BOX_JSON.replace('"stale":false', '"stale":true')
+# the columns of an array of TrackedBoxes which are sent, stale becomes the STALE flag
+BOX_COLUMNS = [TrackedBox._fields.index(field) for field in ('id', 'x', 'y', 'width', 'height', 'stale')]
+
+DELTA_ENCODED = 1
+
+STALE = 1
+ABSOLUTE = 2
+
+
+class BinaryUpdateEncoder:
+    """Encodes the updates of one session. With delta encoding it remembers the boxes of the last encoded message"""
+    use_delta_encoding: bool
+    # ids of the boxes of the last message, sorted, and their x, y, width and height
+    previous_ids: np.ndarray
+    previous_values: np.ndarray
+
+    def __init__(self, use_delta_encoding: bool = False):
+        self.use_delta_encoding = use_delta_encoding
+        self.reset()
+
+    def reset(self):
+        """forget the last message, e.g. because it could not be sent. The next one has absolute values only"""
+        self.previous_ids = np.empty(0, dtype=BOX_DTYPE)
+        self.previous_values = np.empty((0, 4), dtype=BOX_DTYPE)
+
+    def encode(self, tracking_update: TrackingUpdate) -> bytes:
+        """encode an update. With delta encoding, reset() must be called if the message is not sent"""
+        bounding_boxes = tracking_update.bounding_boxes
+        # much faster than np.array(), which inspects every box for the array protocols
+        boxes = np.fromiter(itertools.chain.from_iterable(bounding_boxes), dtype=BOX_DTYPE,
+                            count=len(bounding_boxes) * len(TrackedBox._fields))
+        boxes = boxes.reshape(-1, len(TrackedBox._fields))[:, BOX_COLUMNS]
+        flags = 0
+        if self.use_delta_encoding:
+            flags |= DELTA_ENCODED
+            order = np.argsort(boxes[:, 0], kind="stable")
+            current_ids, current_values = boxes[order, 0], boxes[order, 1:5]
+            indices = np.minimum(np.searchsorted(self.previous_ids, boxes[:, 0]), len(self.previous_ids) - 1)
+            has_previous = (self.previous_ids[indices] == boxes[:, 0]) if len(self.previous_ids) \
+                else np.zeros(len(boxes), dtype=bool)
+            boxes[has_previous, 1:5] -= self.previous_values[indices[has_previous]]
+            boxes[~has_previous, 5] |= ABSOLUTE
+            self.previous_ids, self.previous_values = current_ids, current_values
+        dropped_frames = min(max(tracking_update.dropped_frames, 0), 0xFFFF)
+        header = HEADER.pack(VERSION, flags, dropped_frames, tracking_update.frame_number, len(boxes))
+        return header + boxes.tobytes()
+
+
+def encode_json(tracking_update: TrackingUpdate) -> str:
+    """the JSON of the dto.UpdateTrackingEvent of an update, formatted directly from the boxes"""
+    bounding_boxes = ",".join([(STALE_BOX_JSON if box.stale else BOX_JSON) % box[:6]
+                               for box in tracking_update.bounding_boxes])
+    decoded_at = json.dumps(tracking_update.decoded_at)
+    return (f'{{"event_type":"{EventType.UPDATE_TRACKING.value}","frame_number":{tracking_update.frame_number},'
+            f'"bounding_boxes":[{bounding_boxes}],"dropped_frames":{tracking_update.dropped_frames},'
+            f'"decoded_at":{decoded_at}}}')
@@ -1,3 +1,6 @@
+import os
+import tempfile
+from enum import Enum
 from logging import INFO, DEBUG
 
 LOG_LEVEL = DEBUG
@@ -5,5 +8,106 @@ LOG_LEVEL = DEBUG
 LOG_FORMAT = '%(levelname)s [%(name)s]:     %(message)s'
 VIDEO_SOURCE = '.resources/race_car.mp4'
 QUEUE_SIZE = 10
+# sessions on the same video source share the decoder if it has not read more than this many frames yet.
+# Joining sessions skip these frames, so this should be about a second of video
+SHARED_DECODER_JOIN_WINDOW = 30
 PRODUCER_THREAD_SEEMS_DEAD_TIMEOUT = 5
-NO_UPDATES_TO_SEND_TIMEOUT = 1
+# decode every video in a process of its own, which reads DECODER_PREFETCH_FRAMES frames ahead into shared memory
+DECODE_IN_SUBPROCESS = False
+DECODER_PREFETCH_FRAMES = QUEUE_SIZE
+DECODER_PROCESS_TIMEOUT = 5
+# threads FFmpeg decodes a video with, 0 for its default
+DECODER_THREAD_COUNT = 0
+# decoder processes started ahead of time, so that a new video does not wait for Python and OpenCV to start in one
+DECODER_SPARE_PROCESSES = 1
+# captures of seekable videos are kept open this long after use, so that the next reader of the video only seeks.
+# At most VIDEO_CAPTURE_POOL_SIZE of them, 0 to release every capture right away
+VIDEO_CAPTURE_POOL_SIZE = 8
+VIDEO_CAPTURE_IDLE_SECONDS = 60
+# decode times are kept for this many recent frames, to tell clients how old the frame of an update is
+DECODE_TIME_HISTORY = 4 * QUEUE_SIZE
+# an incomplete frame is sent with stale boxes this many seconds after its first box has been tracked
+FRAME_AGGREGATION_DEADLINE = 0.2
+# updates per second and session, None for as many as the client can receive
+MAX_UPDATE_RATE = None
+# a closed session waits this long for its sender thread to exit, so that no update is sent after it was closed
+SESSION_TEARDOWN_TIMEOUT = 1
+# the admin route which profiles sessions is not authenticated, it may only be enabled where nobody else can reach it
+PROFILER_ROUTE_ENABLED = False
+# profiles of sessions taken with the admin route are written here as folded stacks, which flamegraph.pl, speedscope
+# and similar tools read
+PROFILE_DIRECTORY = os.path.join(tempfile.gettempdir(), 'the-everything-tracker', 'profiles')
+# seconds between two stack samples of a profiled session
+PROFILER_SAMPLE_INTERVAL = 0.01
+PROFILER_MAX_SECONDS = 300
+# upper bounds in seconds of the buckets of the stage timing histograms on /metrics
+METRICS_LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+
+# uvicorn worker processes started by main.py. More than one needs a session registry which is shared between them
+WORKER_COUNT = 1
+
+
+class SessionRegistryBackend(str, Enum):
+    IN_PROCESS = "in-process"
+    # a SQLite database and unix datagram sockets in SESSION_REGISTRY_DIRECTORY, shared by all workers of the host
+    SQLITE = "sqlite"
+
+
+SESSION_REGISTRY_BACKEND = SessionRegistryBackend.SQLITE if WORKER_COUNT > 1 else SessionRegistryBackend.IN_PROCESS
+SESSION_REGISTRY_DIRECTORY = os.path.join(tempfile.gettempdir(), 'the-everything-tracker', 'sessions')
+# seconds a worker waits for another one which is writing to the session database
+SESSION_REGISTRY_LOCK_TIMEOUT = 5
+# broadcast events are sent as one datagram each
+SESSION_REGISTRY_MAX_MESSAGE_SIZE = 1 << 16
+
+
+class TrackerExecutionMode(str, Enum):
+    THREAD = "thread"
+    PROCESS = "process"
+
+
+# PROCESS runs the trackers in a pool of worker processes instead of the consumer threads
+TRACKER_EXECUTION_MODE = TrackerExecutionMode.THREAD
+# the CPUs are divided between the workers
+TRACKER_PROCESS_COUNT = max(1, os.cpu_count() // WORKER_COUNT)
+TRACKER_PROCESS_TIMEOUT = 5
+# threads running the tracker updates of all sessions of a worker
+TRACKER_SCHEDULER_WORKERS = max(1, os.cpu_count() // WORKER_COUNT)
+# "auto" tracking scale: the smallest of these scales at which the object is still at least this many pixels wide and high
+AUTO_TRACKING_SCALES = (0.25, 0.5, 1.0)
+AUTO_TRACKING_MIN_OBJECT_SIZE = 32
+# boxes with a keyframe interval above 1 are only tracked on every k-th frame while they move by less than this share
+# of their size from one tracked frame to the next, see KeyframeSchedule
+KEYFRAME_MAX_MOTION = 0.1
+# run the trackers on a region around the object, which reaches ROI_MARGIN box sizes beyond the box on each side,
+# if the region is smaller than ROI_MAX_FRAME_SHARE of the frame. Only in thread mode, the worker processes take whole
+# frames from shared memory. Makes CSRT updates on small objects in 1080p frames about 10 % cheaper, but every move
+# of the region starts a new tracker, which costs some accuracy
+ROI_CROPPING = False
+ROI_MARGIN = 2.0
+ROI_MAX_FRAME_SHARE = 0.25
+# the whole frame is searched while the tracked centre is further than this share of the box size from the one the
+# motion model predicted, until it has been close for ROI_STABLE_FRAMES tracked frames
+ROI_MAX_INNOVATION = 0.5
+ROI_STABLE_FRAMES = 10
+# seconds per frame a tracker of an "auto" box may take on average before a cheaper tracker is used
+TRACKER_UPDATE_BUDGET = 0.02
+TRACKER_UPDATE_BUDGET_MIN_FRAMES = 10
+# seconds of tracker updates per second all sessions of a worker together may need, by the estimates of the resource
+# governor. Each worker gets its part of the CPUs of the host
+TRACKER_CPU_BUDGET = 0.8 * os.cpu_count() / WORKER_COUNT
+# above this share of the budget, sessions only get new boxes while they are within their fair share of it
+# and new sessions are rejected, so that the rest is left to sessions which have fewer boxes
+FAIR_SHARE_THRESHOLD = 0.75
+# boxes which do not fit are tracked at a smaller scale or with a cheaper tracker instead of being rejected
+DEGRADE_BOXES_OVER_BUDGET = True
+# frame rate assumed for videos which do not tell theirs
+DEFAULT_FPS = 30
+# threads running the trackers of the boxes of a "track whole video" request in parallel
+BATCH_TRACKING_WORKERS = os.cpu_count()
+# finished tracks are stored here and replayed when the same box is drawn on the same video again, None to disable
+TRACK_CACHE_DIRECTORY = os.path.join(tempfile.gettempdir(), 'the-everything-tracker', 'tracks')
+TRACK_CACHE_MAX_BYTES = 1 << 30
+# initial boxes are snapped to a grid of this many pixels, boxes in the same cell of it replay the same track
+TRACK_CACHE_BOX_GRID_SIZE = 4
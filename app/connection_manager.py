@@ -1,40 +1,101 @@
-"""Not using a class, because we want connection_manager to be a Singleton"""
-
+"""
+Not using a class, because we want connection_manager to be a Singleton.
+Holds the websockets and sessions of this worker. Which sessions are open in any worker is kept by the
+SessionRegistry, see SESSION_REGISTRY_BACKEND.
+"""
+import asyncio
+import logging
+from typing import Optional
 from uuid import UUID
 
 from fastapi import WebSocket
+
+from business.session import Session
+from business.session_registry import SessionRegistry, create_session_registry
+from config.constants import LOG_FORMAT, LOG_LEVEL
 from models import dto
 from models.websocket_status_codes import WebsocketStatusCode
-from models.errors import DuplicateSessionError
+
+logging.basicConfig(format=LOG_FORMAT)
+logger = logging.getLogger(__name__)
+logger.setLevel(LOG_LEVEL)
 
 __active_connections: dict[UUID, WebSocket] = {}
+__active_sessions: dict[UUID, Session] = {}
+__session_registry: Optional[SessionRegistry] = None
+
+
+def open_session_registry():
+    """must be called from the event loop of the worker, before the first connection"""
+    global __session_registry
+    if __session_registry is None:
+        __session_registry = create_session_registry()
+        __session_registry.open(__send_to_connections)
+
+
+def close_session_registry():
+    global __session_registry
+    if __session_registry is not None:
+        __session_registry.close()
+        __session_registry = None
 
 
 def get_session_count() -> int:
-    return len(__active_connections)
+    """sessions of all workers"""
+    if __session_registry is None:
+        return len(__active_connections)
+    return __session_registry.get_session_count()
 
 
 async def connect(connection_id: UUID, websocket: WebSocket):
     await websocket.accept()
-    if connection_id not in __active_connections:
-        __active_connections[connection_id] = websocket
-    else:
-        raise DuplicateSessionError(f"Session with ID '{connection_id}' already exists")
+    open_session_registry()
+    # the registry may wait for a database lock, which must not block the other websockets of this worker
+    await asyncio.get_running_loop().run_in_executor(None, __session_registry.register, connection_id)
+    __active_connections[connection_id] = websocket
 
 
-def remove_connection(connection_id: UUID):
+def add_session(connection_id: UUID, session: Session):
+    """the session which serves a connection"""
+    __active_sessions[connection_id] = session
+
+
+def get_session(connection_id: UUID) -> Session:
+    """
+    :raise KeyError: if the session is not served by this worker
+    """
+    return __active_sessions[connection_id]
+
+
+async def remove_connection(connection_id: UUID):
     """remove but don't close connection"""
     __active_connections.pop(connection_id)
+    __active_sessions.pop(connection_id, None)
+    await asyncio.get_running_loop().run_in_executor(None, __session_registry.unregister, connection_id)
 
 
 async def close_connection(connection_id: UUID):
     """close and remove connection"""
-    await __active_connections.pop(connection_id).close(code=WebsocketStatusCode.NORMAL_CLOSE.value)
+    websocket = __active_connections.pop(connection_id)
+    __active_sessions.pop(connection_id, None)
+    await asyncio.get_running_loop().run_in_executor(None, __session_registry.unregister, connection_id)
+    await websocket.close(code=WebsocketStatusCode.NORMAL_CLOSE.value)
 
 
 async def broadcast_event(event: dto.Event):
-    for connection in __active_connections.values():
-        await connection.send_json(event)
+    """send an event to the sessions of all workers"""
+    open_session_registry()
+    await __session_registry.broadcast(event.model_dump_json())
+
+
+async def __send_to_connections(message: str):
+    """the broadcast listener of this worker. Messages are sent JSON encoded, like the answers of the sessions"""
+    connections = list(__active_connections.values())
+    results = await asyncio.gather(*(connection.send_json(message) for connection in connections),
+                                   return_exceptions=True)
+    for result in results:
+        if isinstance(result, Exception):
+            logger.warning(f"Broadcast could not be sent: {result}")
 
 
 def get_by_id(connection_id: UUID) -> WebSocket:
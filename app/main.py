@@ -1,12 +1,23 @@
 import logging
+import os
 from uuid import UUID
 
 import uvicorn
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect
+from fastapi import FastAPI, WebSocket, WebSocketDisconnect, Query, HTTPException
+from fastapi.responses import PlainTextResponse
 
 import connection_manager
+from business.metrics import metrics_registry, SESSIONS
+from business.profiler import get_sampling_profiler
 from business.session import Session
-from config.constants import LOG_LEVEL, LOG_FORMAT
+from business.decoder_process import get_decoder_process_pool, shutdown_decoder_process_pool
+from business.tracker_process_pool import get_tracker_process_pool, shutdown_tracker_process_pool
+from business.tracker_scheduler import get_tracker_scheduler, shutdown_tracker_scheduler
+from business.video_capture_pool import shutdown_video_capture_pool
+from business.video_frame_producer_registry import shutdown_video_frame_producer_registry
+from config.constants import LOG_LEVEL, LOG_FORMAT, WORKER_COUNT, PROFILER_MAX_SECONDS, TRACKER_EXECUTION_MODE, \
+    TrackerExecutionMode, DECODE_IN_SUBPROCESS, PROFILER_ROUTE_ENABLED
+from models.dto import WireFormat
 from models.errors import DuplicateSessionError
 from models.websocket_status_codes import WebsocketStatusCode
 
@@ -15,10 +26,58 @@ logger = logging.getLogger(__name__)
 logger.setLevel(LOG_LEVEL)
 
 app: FastAPI = FastAPI(title="TheEverythingTracker")
+SESSIONS.set_callback(connection_manager.get_session_count)
+
+
+@app.on_event("startup")
+async def startup():
+    connection_manager.open_session_registry()
+    # started with the server instead of when the first session needs them
+    get_tracker_scheduler()
+    if TRACKER_EXECUTION_MODE == TrackerExecutionMode.PROCESS:
+        get_tracker_process_pool()
+    if DECODE_IN_SUBPROCESS:
+        get_decoder_process_pool()
+
+
+@app.on_event("shutdown")
+def shutdown():
+    connection_manager.close_session_registry()
+    shutdown_video_frame_producer_registry()
+    shutdown_tracker_scheduler()
+    shutdown_tracker_process_pool()
+    shutdown_decoder_process_pool()
+    shutdown_video_capture_pool()
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+def get_metrics():
+    """stage timings, queue depths, dropped frames and tracker failures in the Prometheus text format"""
+    return PlainTextResponse(metrics_registry.render(), media_type="text/plain; version=0.0.4")
+
+
+@app.post("/admin/sessions/{session_id}/profile")
+def profile_session(session_id: UUID, seconds: float = Query(10.0, gt=0, le=PROFILER_MAX_SECONDS)):
+    """
+    sample the stacks of the decoder, trackers and sender of a session for some seconds and write them to a file in
+    PROFILE_DIRECTORY as folded stacks, e.g. for flamegraph.pl. Only available with PROFILER_ROUTE_ENABLED
+    """
+    if not PROFILER_ROUTE_ENABLED:
+        raise HTTPException(status_code=404, detail="Not Found")
+    try:
+        session = connection_manager.get_session(session_id)
+    except KeyError:
+        raise HTTPException(status_code=404, detail=f"Session '{session_id}' is not served by this worker")
+    try:
+        profile = get_sampling_profiler().start_profile(session_id, seconds, session.get_thread_idents)
+    except ValueError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    return {"session_id": session_id, "seconds": seconds, "path": profile.path}
 
 
 @app.websocket("/websocket/{session_id}")
-async def connect_websocket(websocket: WebSocket, session_id: UUID):
+async def connect_websocket(websocket: WebSocket, session_id: UUID,
+                            wire_format: WireFormat = Query(WireFormat.JSON, alias="format")):
     try:
         await connection_manager.connect(session_id, websocket)
     except DuplicateSessionError as e:
@@ -26,17 +85,23 @@ async def connect_websocket(websocket: WebSocket, session_id: UUID):
         await websocket.close(code=WebsocketStatusCode.PROTOCOL_ERROR, reason=str(e))
         logger.info(f"Session '{session_id}' rejected")
         return
-    session = Session(session_id, websocket)
+    session = Session(session_id, websocket, wire_format)
+    connection_manager.add_session(session_id, session)
     try:
         logger.info(f"Session '{session_id}' opened")
         await session.consume_websocket_events()
     except WebSocketDisconnect as e:
         logger.warning(f"WebsocketDisconnect with Reason: {e}")
     finally:
-        connection_manager.remove_connection(session_id)
-        session.cleanup_session()
+        await connection_manager.remove_connection(session_id)
+        await session.cleanup_session()
         logger.info(f"Session '{session_id}' closed")
 
 
 if __name__ == '__main__':
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    if WORKER_COUNT > 1:
+        # the workers import the app themselves
+        uvicorn.run("main:app", host="0.0.0.0", port=8000, workers=WORKER_COUNT,
+                    app_dir=os.path.dirname(os.path.abspath(__file__)))
+    else:
+        uvicorn.run(app, host="0.0.0.0", port=8000)
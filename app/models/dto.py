@@ -1,24 +1,46 @@
 from enum import Enum
-from typing import List, Any, Optional
+from typing import Annotated, List, Optional, Literal
 from uuid import UUID
 
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
+
+# a factor frames are reduced by before tracking
+TrackingScale = Annotated[float, Field(gt=0, le=1)]
+# track on every n-th frame
+KeyframeInterval = Annotated[int, Field(ge=1)]
 
 
 class EventType(str, Enum):
     START_CONTROL_LOOP = "start-control-loop"
     ADD_BOUNDING_BOX = "add-bounding-box"
+    ADD_BOUNDING_BOXES = "add-bounding-boxes"
+    ADD_BOUNDING_BOXES_RESULT = "add-bounding-boxes-result"
     DELETE_BOUNDING_BOX = "delete-bounding-boxes"
     UPDATE_TRACKING = "update-tracking"
     STOP_CONTROL_LOOP = "stop-control-loop"
+    TRACK_VIDEO = "track-video"
+    TRACK_VIDEO_RESULT = "track-video-result"
     SUCCESS = "success"
     FAILURE = "failure"
     TRACKING_ERROR = "tracking-error"
 
 
-class VideoFrame(BaseModel):
-    frame_number: int
-    img: Any
+class WireFormat(str, Enum):
+    """how UpdateTrackingEvents are sent, chosen with the format query parameter of the websocket"""
+    JSON = "json"
+    BINARY = "binary"
+    BINARY_DELTA = "binary-delta"
+
+
+class TrackerType(str, Enum):
+    CSRT = "csrt"
+    KCF = "kcf"
+    MIL = "mil"
+    BOOSTING = "boosting"
+    MEDIANFLOW = "medianflow"
+    MOSSE = "mosse"
+    # start with CSRT and move to cheaper trackers while the updates take too long
+    AUTO = "auto"
 
 
 class Event(BaseModel):
@@ -36,6 +58,15 @@ class IdEvent(Event):
 
 class StartControlLoopEvent(IdEvent):
     video_source: str  # todo validation?
+    # updates per second, overrides MAX_UPDATE_RATE for this session
+    max_update_rate: Optional[float] = None
+    # play at the fps of the video and drop frames the trackers cannot keep up with
+    real_time: bool = False
+    # defaults for the boxes of this session: track on frames reduced by this factor, "auto" chooses by object size
+    tracking_scale: TrackingScale | Literal["auto"] = 1.0
+    grayscale: bool = False
+    # track the boxes on up to every n-th frame only, as long as they move slowly, and predict them in between
+    keyframe_interval: KeyframeInterval = 1
 
 
 class BoundingBox(BaseModel):
@@ -45,11 +76,29 @@ class BoundingBox(BaseModel):
     y: int
     width: int
     height: int
+    # set in updates if the tracker has not caught up with the frame yet and the box is the latest known position
+    stale: bool = False
 
 
 class AddBoundingBoxEvent(IdEvent):
     frame_number: int
     bounding_box: BoundingBox
+    tracker: TrackerType = TrackerType.CSRT
+    # override the defaults of the session for this box
+    tracking_scale: TrackingScale | Literal["auto"] | None = None
+    grayscale: Optional[bool] = None
+    keyframe_interval: Optional[KeyframeInterval] = None
+
+
+class AddBoundingBoxesEvent(IdEvent):
+    """add several boxes drawn on the same frame, their trackers are initialized in parallel"""
+    frame_number: int
+    bounding_boxes: List[BoundingBox]
+    tracker: TrackerType = TrackerType.CSRT
+    # override the defaults of the session for these boxes
+    tracking_scale: TrackingScale | Literal["auto"] | None = None
+    grayscale: Optional[bool] = None
+    keyframe_interval: Optional[KeyframeInterval] = None
 
 
 class DeleteBoundingBoxesEvent(IdEvent):
@@ -59,12 +108,26 @@ class DeleteBoundingBoxesEvent(IdEvent):
 class UpdateTrackingEvent(Event):
     frame_number: int
     bounding_boxes: List[BoundingBox]
+    # frames since the previous update which the client did not get an update for
+    dropped_frames: int = 0
+    # unix time the frame was decoded at, if it is still known. Not part of the binary wire formats
+    decoded_at: Optional[float] = None
 
 
 class StopControlLoopEvent(IdEvent):
     pass
 
 
+class TrackVideoEvent(IdEvent):
+    """track boxes through a whole recorded video at once, as fast as possible"""
+    video_source: str
+    # the frame_number of each box is the frame it is drawn on
+    bounding_boxes: List[BoundingBox]
+    tracker: TrackerType = TrackerType.CSRT
+    tracking_scale: TrackingScale | Literal["auto"] = 1.0
+    grayscale: bool = False
+
+
 class AnswerEvent(IdEvent):
     message: str
 
@@ -77,6 +140,30 @@ class FailureEvent(AnswerEvent):
     pass
 
 
+class BoundingBoxResult(BaseModel):
+    id: int
+    success: bool
+    message: str
+
+
+class AddBoundingBoxesResultEvent(AnswerEvent):
+    # one per box, in the order of the AddBoundingBoxesEvent
+    results: List[BoundingBoxResult]
+
+
+class Track(BaseModel):
+    id: int
+    # one [frame_number, x, y, width, height] per tracked frame
+    positions: List[List[int]]
+    lost_frame_number: Optional[int] = None
+
+
+class TrackVideoResultEvent(AnswerEvent):
+    tracks: List[Track]
+    frame_count: int
+    fps: float
+
+
 class ThreadingEvent:
     source: int | str
     message: str
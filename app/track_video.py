@@ -0,0 +1,61 @@
+"""
+Track boxes through a whole recorded video from the command line, without a websocket:
+
+    python track_video.py video.mp4 --box 50,100,60,60 --box 280,180,40,40@20 --output tracks.npz
+
+Each box is x,y,width,height, optionally followed by @ and the frame it is drawn on.
+The positions of box i are written to the array "box_i" of the output file, one (frame, x, y, width, height) row per frame.
+"""
+import argparse
+import logging
+
+import numpy as np
+
+from business.batch_tracking import track_video
+from business.tracker_process_pool import shutdown_tracker_process_pool
+from config.constants import LOG_FORMAT, LOG_LEVEL, BATCH_TRACKING_WORKERS
+from models.dto import BoundingBox, TrackerType
+
+logging.basicConfig(format=LOG_FORMAT)
+logger = logging.getLogger(__name__)
+logger.setLevel(LOG_LEVEL)
+
+
+def parse_box(object_id: int, text: str) -> BoundingBox:
+    coordinates, _, frame_number = text.partition('@')
+    x, y, width, height = (int(value) for value in coordinates.split(','))
+    return BoundingBox(id=object_id, frame_number=int(frame_number) if frame_number else 1, x=x, y=y, width=width,
+                       height=height)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Track boxes through a whole video as fast as possible")
+    parser.add_argument('video_source')
+    parser.add_argument('--box', action='append', required=True, help="x,y,width,height[@frame]")
+    parser.add_argument('--tracker', type=TrackerType, default=TrackerType.CSRT,
+                        choices=list(TrackerType), metavar='|'.join(tracker_type.value for tracker_type in TrackerType))
+    parser.add_argument('--tracking-scale', default='1.0', help="factor to reduce the frames by or auto")
+    parser.add_argument('--grayscale', action='store_true')
+    parser.add_argument('--workers', type=int, default=BATCH_TRACKING_WORKERS)
+    parser.add_argument('--output', help="write the tracks to this .npz file")
+    args = parser.parse_args()
+
+    bounding_boxes = [parse_box(object_id, text) for object_id, text in enumerate(args.box)]
+    tracking_scale = args.tracking_scale if args.tracking_scale == 'auto' else float(args.tracking_scale)
+    try:
+        result = track_video(args.video_source, bounding_boxes, args.tracker, tracking_scale, args.grayscale,
+                             args.workers)
+    finally:
+        shutdown_tracker_process_pool()
+    for track in result.tracks.values():
+        positions = track.get_positions()
+        lost = f", lost on frame {track.lost_frame_number}" if track.lost_frame_number is not None else ""
+        print(f"box {track.object_id}: {len(positions)} frames{lost}")
+    print(f"{result.frame_count} frames in {result.elapsed_seconds:.2f} s, {result.fps:.1f} fps")
+    if args.output:
+        np.savez_compressed(args.output, **{f"box_{track.object_id}": track.get_positions()
+                                            for track in result.tracks.values()})
+
+
+if __name__ == '__main__':
+    main()